@@ -1,4 +1,4 @@
 # pgtree package
 __author__='Franck Jouvanceau'
 
-from .pgtree import Proctree, Treedisplay, runcmd, main
\ No newline at end of file
+from .pgtree import Proctree, Snapshot, Treedisplay, runcmd, main
\ No newline at end of file
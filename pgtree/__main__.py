@@ -0,0 +1,6 @@
+# pgtree fast start: python -m pgtree (compiled package, no bash preamble)
+import sys
+
+from .pgtree import main
+
+main(sys.argv[1:])
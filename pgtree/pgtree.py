@@ -1,24 +1,38 @@
 #!/usr/bin/env bash
 # coding: utf-8
 # pylint: disable=C0114,C0413,R0902,C0209
-# determine available python executable
-# determine ps -o options
+# determine available python executable (no fork), ps -o options detected by python
 _=''''
 #[ "$1" = -W ] && shift && exec watch -x -c -- "$0" -C y "$@"
 export LANG=en_US.UTF-8 PYTHONUTF8=1 PYTHONIOENCODING=utf8
-PGT_PGREP=$(type -p pgrep)
-ps -p $$ -o ucomm >/dev/null 2>&1 && PGT_COMM=ucomm
-[ ! "$PGT_COMM" ] && ps -p $$ -o comm >/dev/null 2>&1 && PGT_COMM=comm
-[ "$PGT_COMM" ] && {
-    ps -p $$ -o stime >/dev/null 2>&1 && PGT_STIME=stime
-    [ ! "$PGT_STIME" ] && ps -p $$ -o start >/dev/null 2>&1 && PGT_STIME=start
-    [ ! "$PGT_STIME" ] && PGT_STIME=time
-}
-# busybox no -p option
-[ ! "$PGT_COMM" ] && ! ps -p $$ >/dev/null 2>&1 && PGT_COMM=comm && PGT_STIME=etime
-export PGT_COMM PGT_STIME PGT_PGREP
-read python <<<"$(type -p python3 python python2)"
-[ "$python" ] && exec $python "$0" "$@"
+# script loaded as module: compiled code cached in user cache (pycache prefix),
+# never beside the script, not cached for script without .py suffix
+for python in python3 python python2; do
+    command -v $python >/dev/null && exec $python -c 'import os, sys
+sys.argv = sys.argv[1:]
+try:
+    from importlib.machinery import SourceFileLoader
+    from importlib.util import module_from_spec, spec_from_loader
+except ImportError:
+    sys.dont_write_bytecode = True
+    execfile(sys.argv[0], {"__name__": "__main__"})
+    sys.exit()
+path = os.path.realpath(sys.argv[0])
+loader = SourceFileLoader("pgtree", path)
+pgtree = module_from_spec(spec_from_loader("pgtree", loader))
+cached = (getattr(sys, "pycache_prefix", None), sys.dont_write_bytecode)
+if hasattr(sys, "pycache_prefix") and not cached[0]:
+    sys.pycache_prefix = os.path.join(os.environ.get("PGT_CACHE_DIR") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "pgtree"), "pycache")
+if not path.endswith(".py") or not getattr(sys, "pycache_prefix", None):
+    sys.dont_write_bytecode = True
+code = loader.get_code("pgtree")
+if hasattr(sys, "pycache_prefix"):
+    sys.pycache_prefix = cached[0]
+sys.dont_write_bytecode = cached[1]
+exec(code, pgtree.__dict__)
+pgtree.main(sys.argv[1:])' "$0" "$@"
+done
 echo "ERROR: cannot find python interpreter" >&2
 exit 1
 '''
@@ -55,40 +69,194 @@ __author__ = "Franck Jouvanceau"
 __copyright__ = "Copyright 2020, Franck Jouvanceau"
 __license__ = "MIT"
 
+# modules not needed by all runs (re, getopt, signal, json, csv...) imported when used
 import sys
 import os
-import platform
-import getopt
-import re
+import errno
 try:
     import time
 except ImportError:
     pass
-try:
-    from shlex import join as shlex_join
-except ImportError:
-    import pipes
-    def shlex_join(cmd_list):
-        """shlex.join for python2"""
-        return ' '.join([pipes.quote(c) for c in cmd_list])
+
+def shlex_join(cmd_list):
+    """shlex.join (python2 pipes.quote)"""
+    try:
+        from shlex import quote
+    except ImportError:
+        from pipes import quote
+    return ' '.join([quote(c) for c in cmd_list])
 
 # impossible detection using ps for AIX/MacOS
 # stime is not start time of process
-system = platform.system()
+try:
+    system = os.uname()[0]
+except AttributeError:
+    import platform
+    system = platform.system()
 PS_OPTION = 'ax'
 if system in ['AIX', 'Darwin']:
     os.environ['PGT_STIME'] = 'start'
 elif system == 'SunOS': # ps ax -o not supported
     PS_OPTION = '-e'
     os.environ['PGT_COMM'] = 'fname' # comm header width not respected
+# ps columns padded to header width (ps truncates or overflows longer values):
+# user, comm and fields with spaces or truncated values (OPT_WIDTHS),
+# widths doubled up to MAX_WIDTH and ps run again when a value fills its column,
+# other fields values have no spaces and are split on spaces
+USER_WIDTH = 32
+COMM_WIDTH = 16
+MAX_WIDTH = 256
+OPT_WIDTHS = {
+    'stime': 10, 'start': 10, 'bsdstart': 10, 'lstart': 25,
+    'ruser': 32, 'group': 32, 'cgroup': 64,
+}
+NUMERIC_FIELDS = set(['pid', 'ppid', 'pgid', 'sid', 'uid', 'ruid', 'rgid', 'spid', 'nlwp',
+                      'thcount', '%cpu', 'pcpu', '%mem', 'pmem', 'rss', 'vsz', 'etime', 'time'])
+OUTPUT_CHUNK = 65536  # output buffer size
+PS_LINE_MAX = 131072  # procps line buffer, args truncated to fit
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (ValueError, OSError, AttributeError):
+    PAGE_SIZE = 4096
+
+def cpu_time():
+    """process cpu time (user + system)"""
+    try:
+        return time.process_time()
+    except AttributeError:
+        times = os.times()
+        return times[0] + times[1]
+
+class Profiler:
+    """
+    stage timings: calls, items count, wall time (total and self), cpu time
+    enabled with --profile or PGT_PROFILE env: text/json summary on stderr
+    """
+
+    def __init__(self):
+        """constructor"""
+        self.stages = {}   # stage: [calls, count, wall, self wall, cpu]
+        self.order = []    # stages in first call order
+        self.running = []  # time spent in sub stages of running stages
+
+    def run(self, stage, count, func, *args, **kwargs):
+        """run func as stage, count(result) items processed"""
+        if stage not in self.stages:
+            self.stages[stage] = [0, 0, 0.0, 0.0, 0.0]
+            self.order.append(stage)
+        self.running.append(0.0)
+        wall = time.time()
+        cpu = cpu_time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            cpu = cpu_time() - cpu
+            wall = time.time() - wall
+            sub = self.running.pop()
+            if self.running:
+                self.running[-1] += wall
+            stats = self.stages[stage]
+            stats[0] += 1
+            stats[2] += wall
+            stats[3] += wall - sub
+            stats[4] += cpu
+        if count:
+            stats[1] += count(result)
+        return result
+
+    def records(self):
+        """stages statistics"""
+        records = []
+        for stage in self.order:
+            calls, count, wall, self_wall, cpu = self.stages[stage]
+            records.append({'stage': stage, 'calls': calls, 'count': count,
+                            'wall': round(wall, 6), 'self': round(self_wall, 6),
+                            'cpu': round(cpu, 6)})
+        return records
+
+    def report(self, output='text', out=None):
+        """write summary (text or json) to stderr"""
+        out = out or sys.stderr
+        records = self.records()
+        if output == 'json':
+            import json
+            out.write(json.dumps({'argv': sys.argv, 'stages': records}) + '\n')
+            return
+        out.write('%-16s %7s %8s %10s %10s %10s\n' % (
+            'stage', 'calls', 'count', 'wall(s)', 'self(s)', 'cpu(s)'))
+        for record in records:
+            out.write('%-16s %7d %8d %10.4f %10.4f %10.4f\n' % (
+                record['stage'][:16], record['calls'], record['count'],
+                record['wall'], record['self'], record['cpu']))
+
+PROFILER = None  # Profiler when profiling enabled
+
+def profiled(stage, count=None):
+    """decorator: function timed as stage when profiling enabled"""
+    def decorate(func):
+        """profiled func"""
+        def wrapper(*args, **kwargs):
+            """run func, timed if profiling"""
+            if PROFILER is None:
+                return func(*args, **kwargs)
+            return PROFILER.run(stage, count, func, *args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorate
+
+def lines_count(result):
+    """lines of command output"""
+    return result[1].count('\n') + 1
 
 def runcmd(cmd):
     """run command"""
+    if PROFILER is not None:
+        return PROFILER.run('cmd ' + cmd.split(' ')[0], lines_count, _runcmd, cmd)
+    return _runcmd(cmd)
+
+def _runcmd(cmd):
+    """run command, returns (exit status, output)"""
     pipe = os.popen(cmd, 'r')
     std_out = pipe.read()
     res = pipe.close()
     return res, std_out.rstrip('\n')
 
+def runcmd_lines(cmd, status):
+    """run command, generate output lines (not kept in memory), exit status appended to status"""
+    pipe = os.popen(cmd, 'r')
+    for line in pipe:
+        yield line.rstrip('\n')
+    status.append(pipe.close())
+
+def runcmd_timeout(cmd, timeout):
+    """run command (and its children) killed after timeout seconds,
+       returns (exit status, output), status 'timeout' if killed"""
+    import subprocess
+    import threading
+    import signal
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            preexec_fn=os.setsid)
+    killed = []
+    def kill():
+        """kill command process group"""
+        killed.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        std_out, std_err = proc.communicate()
+    finally:
+        timer.cancel()
+    if killed:
+        return 'timeout', ''
+    if proc.returncode:
+        return std_err.decode('utf-8', 'replace').strip() or proc.returncode, ''
+    return None, std_out.decode('utf-8', 'replace').rstrip('\n')
+
 def ask(prompt):
     """input text"""
     try:
@@ -108,11 +276,13 @@ class Treedisplay:
         """choose tree characters"""
         if use_ascii:
             self.selected = '>'
+            self.total = 'sum'
             self.child = '|_'
             self.notchild = '| '
             self.lastchild = '\\_'
         else:
             self.selected = '►' # ⇒ 🠖 🡆 ➤ ➥ ► ▶
+            self.total = 'Σ'
             self.child = '├─'
             self.notchild = '│ '
             self.lastchild = '└─'
@@ -125,73 +295,143 @@ class Treedisplay:
             'vsz': '35',
             '%mem': '35',
             'time': '35',
+            'total': '35',
+            'group': '33',
+            'pattern': '32',
             'default': '36', # 8
+            '+': '42',     # watch: new process
+            '-': '41',     # watch: exited process
+            '~': '43',     # watch: reparented process
         }
 
+        self.prefix = {}
+        self.reset = ''
+        if use_color:
+            self.reset = self.COLOR_RESET
+        for field in self.colors:
+            self.prefix[field] = self.color_prefix(field)
+        self.opt_colors = {}
+
+    def color_prefix(self, field):
+        """color escape sequence of field"""
+        if not self.use_color:
+            return ''
+        if field in self.colors:
+            return self.COLOR_FG + self.colors[field] + "m"
+        return self.COLOR_FG + self.colors['default'] + "m"
+
+    def field_colors(self, fields):
+        """[(field, color prefix)] of fields (computed once)"""
+        fields = tuple(fields)
+        if fields not in self.opt_colors:
+            self.opt_colors[fields] = [(field, self.color_prefix(field)) for field in fields]
+        return self.opt_colors[fields]
+
+    def mark(self, mark):
+        """watch change mark column"""
+        if mark == ' ' or not self.use_color:
+            return mark
+        return self.prefix[mark] + mark + self.COLOR_RESET
+
     def colorize(self, field, value):
         """colorize fields"""
         if not self.use_color:
             return value
-        if field in self.colors:
-            return self.COLOR_FG + self.colors[field] + "m" + value + self.COLOR_RESET
-        return self.colorize('default', value)
+        return self.color_prefix(field) + value + self.COLOR_RESET
 
 
-class Proctree:
+def readfile(path, binary=False):
+    """read file content (bytes if binary), empty string if not readable"""
+    try:
+        fd = open(path, 'rb')
+        try:
+            data = fd.read()
+        finally:
+            fd.close()
+    except (IOError, OSError):
+        if binary:
+            return b''
+        return ''
+    if not binary and not isinstance(data, str):
+        data = data.decode('utf-8', 'replace')
+    return data
+
+
+class PsSource:
     """
-    Manage process tree of pids
-    Proctree([ 'pid1', 'pid2' ])
+    Process source using ps command (portable)
+    read() returns [pid, ppid, user, comm, <opt fields>..., args] per process
     """
+    name = 'ps'
+    live = True
 
-    # pylint: disable=R0913
-    def __init__(self, use_uid=False, use_ascii=False, use_color=False,
-                 pid_zero=True, opt_fields=None, threads=False):
-        """constructor"""
-        self.pids = []
-        self.ps_info = {}        # ps command info stored
-        self.children = {}       # children of pid
-        self.selected_pids = []  # pids and their children
-        self.pids_tree = {}
-        self.top_parents = []
-        self.treedisp = Treedisplay(use_ascii, use_color)
-        self.ps_fields = self.get_fields(opt_fields, use_uid, threads)
-        self.get_psinfo(pid_zero)
+    def available(self):
+        """ps is always available"""
+        return True
 
-    def get_fields(self, opt_fields=None, use_uid=False, threads=False):
-        """ Get ps fields from OS / optionnal fields """
-        if use_uid:
-            user = 'uid'
-        else:
-            user = 'user'
-        if threads:
-            pid = 'spid'
-        else:
-            pid = 'pid'
-        if not opt_fields or not os.environ.get('PGT_COMM'):
-            opt_fields = [os.environ.get('PGT_STIME') or 'stime']
-
-        return [pid, 'ppid', user, os.environ.get('PGT_COMM') or 'ucomm'] + opt_fields
+    def supports(self, ps_fields):
+        """any field supported by ps -o"""
+        return True
 
-    def run_ps(self, widths):
+    def ps_command(self, ps_fields, widths=None):
         """
-            run ps command detected setting columns widths
-            guess columns for ps command not supporting -o (mingw/msys2)
+            ps command detected with compact columns:
+            user and optional fields with spaces (OPT_WIDTHS) first with widths set in header,
+            pid/ppid (spid) split on spaces, comm width, other fields split on spaces, args
+            widths: [user, spaced fields..., comm] widths
+            returns (widths, ps command)
         """
-        if os.environ.get('PGT_COMM'):
-            ps_cmd = 'ps ' + PS_OPTION + ' ' + ' '.join(
-                    ['-o '+ o +'='+ widths[i]*'-' for i,o in enumerate(self.ps_fields)]
-                ) + ' -o args'
-            err, ps_out = runcmd(ps_cmd)
-            if err:
-                print('Error: executing ps ' + PS_OPTION + ' -o ' + ",".join(self.ps_fields))
-                sys.exit(1)
-            return ps_out.splitlines()
+        self.spaced = [i for i,o in enumerate(ps_fields) if i > 3 and o in OPT_WIDTHS]
+        self.tokens = [i for i,o in enumerate(ps_fields)
+                       if i > 3 and not o in OPT_WIDTHS and o != 'spid']
+        if not widths:
+            widths = [USER_WIDTH] + [OPT_WIDTHS[ps_fields[i]] for i in self.spaced] \
+                     + [COMM_WIDTH]
+        ps_option = PS_OPTION
+        ids = ['-o '+ ps_fields[0] +'=', '-o ppid=']
+        if 'spid' in ps_fields:  # threads rows
+            ps_option += ' -T'
+            ids.append('-o spid=')
+        self.nids = len(ids)
+        ps_cmd = 'ps ' + ps_option + ' ' + ' '.join(
+                ['-o '+ ps_fields[i] +'='+ widths[j]*'-' for j,i in enumerate([2] + self.spaced)]
+                + ids + ['-o '+ ps_fields[3] +'='+ widths[-1]*'-']
+                + ['-o '+ ps_fields[i] +'=' for i in self.tokens]
+            ) + ' -o args'
+        return (widths, ps_cmd)
+
+    def execute(self, ps_cmd, ps_fields):
+        """run ps command, returns ps output lines"""
+        err, ps_out = runcmd(ps_cmd)
+        if err:
+            print('Error: executing ' + ps_cmd.split(' -o ')[0] + ' -o ' + ",".join(ps_fields))
+            sys.exit(1)
+        return ps_out.splitlines()
+
+    @profiled('run_ps')
+    def run_ps(self, ps_fields, widths=None):
+        """run ps command, returns (widths, ps output lines)"""
+        widths, ps_cmd = self.ps_command(ps_fields, widths)
+        return (widths, self.execute(ps_cmd, ps_fields))
+
+    def widened(self):
+        """widths with full columns doubled (None if no wider columns to try)"""
+        widths = list(self.widths)
+        for i in self.full:
+            widths[i] = min(MAX_WIDTH, widths[i] * 2)
+        if widths == self.widths:
+            return None
+        return widths
+
+    def guess_ps(self, ps_fields):
+        """guess columns for ps command not supporting -o (mingw/msys2)"""
+        import re
         _, out = runcmd('ps aux') # try to use header to guess columns
         out = out.splitlines()
         if not 'PPID' in out[0]:
             _, out = runcmd('ps -ef')
             out = out.splitlines()
-        ps_out = []
+        procs = []
         fields = {}
         for i,field in enumerate(out[0].strip().lower().split()):
             field = re.sub("command|cmd", "args", field)
@@ -201,7 +441,7 @@ class Proctree:
             print("Error: command 'ps aux' does not provides PPID")
             sys.exit(1)
         fields["ucomm"] = len(fields)
-        for line in out:
+        for line in out[1:]:
             ps_info = line.strip().split(None, len(fields)-2)
             if "stime" in fields:
                 if ps_info[fields["stime"]] in ["Jan","Feb","Mar","Apr","May","Jun",
@@ -209,157 +449,2504 @@ class Proctree:
                     ps_info = line.strip().split(None, len(fields)-1)
                     ps_info[fields["stime"]] += ps_info.pop(fields["stime"]+1)
             ps_info.append(os.path.basename(ps_info[fields["args"]].split()[0]))
-            ps_out.append(' '.join(
-                [('%-'+ str(widths[i]) +'s') % ps_info[fields[opt]]
-                 for i,opt in enumerate(self.ps_fields)] + [ps_info[fields["args"]]]
-            ))
-        return ps_out
+            procs.append([ps_info[fields[opt]] for opt in ps_fields] + [ps_info[fields["args"]]])
+        return procs
 
-    def get_psinfo(self, pid_zero):
-        """parse unix ps command"""
-        widths = [30, 30, 30, 130] + [50 for i in self.ps_fields[4:]]
-        ps_out = self.run_ps(widths)
-        pid_z = ["0", "0"] + self.ps_fields[2:]
-        ps_out[0] = ' '.join(
-                [('%-'+ str(widths[i]) +'s') % opt for i,opt in enumerate(pid_z)] + ['args']
-        )
-        ps_opts = ['pid', 'ppid', 'user', 'comm'] + self.ps_fields[4:]
-        for line in ps_out:
-            infos = {}
-            col = 0
-            for i,field in enumerate(ps_opts):
-                infos[field] = line[col:col+widths[i]].strip()
-                col = col + widths[i] + 1
-            infos['args'] = line[col:len(line)]
-            infos['comm'] = os.path.basename(infos['comm'])
-            pid = infos['pid']
-            ppid = infos['ppid']
-            if pid == str(os.getpid()):
+    @profiled('read ps', len)
+    def read(self, ps_fields):
+        """
+        parse unix ps command (header line skipped)
+        only pid/ppid (and spid for threads) are parsed, other fields parsed on access (lazy)
+        """
+        self.lazy = False
+        if not os.environ.get('PGT_COMM'):
+            return self.guess_ps(ps_fields)
+        self.lazy = True
+        widths = getattr(self, 'probed', None)
+        while True:
+            self.widths, ps_out = self.run_ps(ps_fields, widths)
+            procs = list(self.rows(ps_fields, ps_out[1:]))
+            widths = self.widened()
+            if not widths:
+                return procs
+
+    def stream(self, ps_fields):
+        """
+        ps command output parsed line by line (lazy rows like read), not kept in memory
+        columns found full are widened for next ps run (no rerun, rows already yielded)
+        """
+        if not os.environ.get('PGT_COMM'):
+            for proc in self.guess_ps(ps_fields):
+                yield proc
+            return
+        self.lazy = True
+        self.widths, ps_cmd = self.ps_command(ps_fields, getattr(self, 'probed', None))
+        status = []
+        lines = runcmd_lines(ps_cmd, status)
+        next(lines, None)  # header
+        for row in self.rows(ps_fields, lines):
+            yield row
+        if status[0]:
+            print('Error: executing ' + ps_cmd.split(' -o ')[0] + ' -o ' + ",".join(ps_fields))
+            sys.exit(1)
+        self.probed = self.widened() or self.widths
+
+    def rows(self, ps_fields, lines):
+        """
+        (values, line) of ps output lines, only pid/ppid (and spid) parsed
+        columns filled up to their width (value may be truncated) set in self.full
+        """
+        col = sum(self.widths[:-1]) + len(self.widths) - 1
+        ends = [sum(self.widths[:i+1]) + i for i in range(len(self.widths) - 1)]
+        starts = [end - width for end, width in zip(ends, self.widths)]
+        comm = len(self.widths) - 1
+        comm_width = self.widths[-1]
+        nvalues = len(ps_fields) + 1
+        nids = self.nids
+        spid = None
+        if 'spid' in ps_fields:
+            spid = ps_fields.index('spid')
+        self.full = set()
+        for line in lines:
+            values = [None] * nvalues
+            ids = line[col:].split(None, nids)
+            values[0:2] = ids[:2]
+            if spid:
+                values[spid] = ids[2]
+            for i, end in enumerate(ends):  # value filling column (truncated) or overflowing
+                if line[end:end+1].strip() or line[starts[i]].strip() and line[end-1].strip():
+                    self.full.add(i)
+            if ids[-1][comm_width-1:comm_width].strip():
+                self.full.add(comm)
+            yield (values, line)
+
+    @profiled('parse ps')
+    def parse(self, values, line):
+        """parse ps line fields (pid/ppid already parsed)"""
+        values[2] = line[:self.widths[0]].strip()
+        col = self.widths[0] + 1
+        for i, width in zip(self.spaced, self.widths[1:-1]):
+            values[i] = line[col:col+width].strip()
+            col = col + width + 1
+        line = line[col:].split(None, self.nids)[self.nids]
+        comm_width = self.widths[-1]
+        values[3] = line[:comm_width].rstrip()
+        tokens = line[comm_width+1:].split(None, len(self.tokens))
+        tokens += [''] * (len(self.tokens) + 1 - len(tokens))
+        for i, value in zip(self.tokens, tokens):
+            values[i] = value
+        values[-1] = tokens[-1]
+
+
+class ProcSource:
+    """
+    Process source reading Linux /proc/<pid>/stat, status and cmdline
+    avoids forking ps, uid to user resolved once per uid
+    """
+    name = 'proc'
+    live = True
+    lazy = True
+    fields = ['pid', 'ppid', 'user', 'uid', 'ucomm', 'comm', 'stime', 'etime', 'time',
+              'pgid', 'sid', 'nlwp', 'rss', 'vsz', '%cpu', '%mem',
+              'ruid', 'ruser', 'rgid', 'rgroup', 'tty', 'spid', 'cgroup', 'pidns', 'lstart']
+    stat_fields = {'ppid': 1, 'pgid': 2, 'sid': 3, 'nlwp': 17}
+    status_fields = ['user', 'uid', 'ruser', 'ruid', 'rgroup', 'rgid']
+    ps_widths = {'uid': 5, 'ruid': 5, 'rgid': 5, 'nlwp': 4, 'rss': 5, 'vsz': 6, '%cpu': 4,
+                 '%mem': 4, 'etime': 11, 'time': 8, 'tty': 8, 'rgroup': 8,
+                 'pidns': 10}  # procps columns
+
+    def __init__(self, root='/proc'):
+        """constructor, root: proc filesystem directory"""
+        import re
+        self.ctrl_chars = re.compile(u'[\x00-\x1f\x7f-\x9f]')
+        self.non_ascii = re.compile(b'[\x80-\xff]')
+        self.wide_chars = re.compile(u'[^\x00-\x9f]')
+        self.root = root
+        self.users = {}
+        self.groups = {}
+        self.ps_fields = []
+        self.need_status = True
+        self.need_rss = False
+        self.keep = False        # keep status/cmdline of parsed processes
+        self.spaced = [2]        # user and fields with spaces (PsSource padded columns)
+        self.widths = {2: USER_WIDTH, 3: COMM_WIDTH}  # PsSource column widths of values
+        self.pid_width = 5
+        self.cache = {}          # pid: (start, comm, ids, args) of parsed processes
+        self.previous = {}       # cache of previous read
+        self.hertz = 100
+        self.boot_time = 0
+        self.uptime = 0
+        self.mem_total = 0
+        self.now = 0
+
+    def available(self):
+        """Linux with /proc mounted"""
+        return system == 'Linux' and os.path.isfile(self.root + '/self/stat')
+
+    def supports(self, ps_fields):
+        """all fields must be computable from /proc"""
+        for field in ps_fields:
+            if field not in self.fields:
+                return False
+        return True
+
+    @profiled('user')
+    def user(self, uid):
+        """uid to user name (cached)"""
+        if uid not in self.users:
+            try:
+                import pwd
+                self.users[uid] = pwd.getpwuid(int(uid))[0]
+            except (ImportError, KeyError, ValueError):
+                self.users[uid] = uid
+        return self.users[uid]
+
+    def group(self, gid):
+        """gid to group name (cached)"""
+        if gid not in self.groups:
+            try:
+                import grp
+                self.groups[gid] = grp.getgrgid(int(gid))[0]
+            except (ImportError, KeyError, ValueError):
+                self.groups[gid] = gid
+        return self.groups[gid]
+
+    def get_clock(self):
+        """system values needed for time/memory fields"""
+        try:
+            self.hertz = os.sysconf('SC_CLK_TCK')
+        except (ValueError, OSError, AttributeError):
+            pass
+        for line in readfile(self.root + '/stat').splitlines():
+            if line.startswith('btime'):
+                self.boot_time = int(line.split()[1])
+        for line in readfile(self.root + '/meminfo').splitlines():
+            if line.startswith('MemTotal:'):
+                self.mem_total = int(line.split()[1])
+        uptime = readfile(self.root + '/uptime').split()
+        if uptime:
+            self.uptime = float(uptime[0])
+        self.pid_width = len(readfile(self.root + '/sys/kernel/pid_max').strip()) or 5
+        self.now = time.time()
+
+    def stime(self, start):
+        """process start time formatted like ps -o stime"""
+        start_time = time.localtime(self.boot_time + start)
+        now = time.localtime(self.now)
+        if now[0] != start_time[0]:
+            return time.strftime("%Y", start_time)
+        if now[7] != start_time[7]:
+            return time.strftime("%b%d", start_time)
+        return time.strftime("%H:%M", start_time)
+
+    def lstart(self, start):
+        """process start time formatted like ps -o lstart"""
+        start_time = time.localtime(self.boot_time + start)
+        return time.strftime("%a %b ", start_time) + '%2d' % start_time[2] + \
+            time.strftime(" %H:%M:%S %Y", start_time)
+
+    def duration(self, seconds, etime):
+        """[[dd-]hh:]mm:ss (etime) or [dd-]hh:mm:ss (time)"""
+        days = seconds // 86400
+        hours = seconds // 3600 % 24
+        out = '%02d:%02d' % (seconds // 60 % 60, seconds % 60)
+        if hours or days or not etime:
+            out = '%02d:' % hours + out
+        if days:
+            out = '%d-' % days + out
+        return out
+
+    def percent(self, value):
+        """per-mille to ps percent format (no decimal above 99.9)"""
+        if value > 999:
+            return str(value // 10)
+        return '%d.%d' % (value // 10, value % 10)
+
+    def elapsed(self, stat):
+        """seconds since process start"""
+        return max(self.uptime - float(stat[19]) / self.hertz, 0)
+
+    def tty(self, tty_nr):
+        """controlling terminal name from device number"""
+        major = (tty_nr >> 8) & 0xfff
+        minor = (tty_nr & 0xff) | ((tty_nr >> 12) & 0xfff00)
+        if tty_nr == 0:
+            return '?'
+        if 136 <= major <= 143:
+            return 'pts/' + str((major - 136) * 256 + minor)
+        if major == 4 and minor < 64:
+            return 'tty' + str(minor)
+        if major == 4:
+            return 'ttyS' + str(minor - 64)
+        if major == 5 and minor == 1:
+            return 'console'
+        return '?'
+
+    def cmdline(self, pid, comm, state, values):
+        """process arguments like ps -o args in UTF-8 locale: NULs and newlines as spaces,
+           non printable characters as ?, non ASCII bytes as ? if not valid UTF-8,
+           truncated to fit ps line"""
+        data = readfile(self.root + '/' + pid + '/cmdline', True).rstrip(b'\0')
+        if not data:
+            args = '[' + comm + ']'
+            if state == 'Z':
+                args += ' <defunct>'
+            return args
+        data = data.replace(b'\0', b' ').replace(b'\n', b' ')
+        try:
+            data.decode('utf-8')
+        except UnicodeDecodeError:
+            data = self.non_ascii.sub(b'?', data)
+        if len(data) > PS_LINE_MAX // 2:
+            data = data[:PS_LINE_MAX - self.args_column(values)]
+        args = self.ctrl_chars.sub(u'?', data.decode('utf-8', 'replace'))
+        if len(args) < len(data):  # multibyte characters
+            args = self.wide_chars.sub(self.printable, args)
+        if not isinstance(args, str):  # python2 unicode
+            args = args.encode('utf-8')
+        return args
+
+    def printable(self, match):
+        """unassigned, separator and surrogate characters as ? (not printable for ps)"""
+        import unicodedata
+        if unicodedata.category(match.group()) in ('Cn', 'Zl', 'Zp', 'Cs'):
+            return u'?'
+        return match.group()
+
+    def widen(self, i, value):
+        """width of column i in PsSource layout: doubled while value fills it"""
+        width = self.widths[i]
+        while len(value) >= width and width < MAX_WIDTH:
+            width = min(MAX_WIDTH, width * 2)
+        self.widths[i] = width
+
+    def args_column(self, values):
+        """position of args in ps line of values (PsSource layout, procps widths),
+           overflowing values shift next columns"""
+        column = 0
+        for i, field in enumerate(self.ps_fields):
+            width = self.widths.get(i) or self.ps_widths.get(field, self.pid_width)
+            column += max(width, len(values[i])) + 1
+        return column
+
+    def read_pid(self, pid, ps_fields, tid=None):
+        """
+        read /proc/<pid>/stat (/proc/<pid>/task/<tid>/stat for thread): (values, raw),
+        None if vanished, status/cmdline are read and fields computed on access (parse)
+        """
+        path = pid
+        if tid is not None:
+            path = pid + '/task/' + tid
+        stat = readfile(self.root + '/' + path + '/stat')
+        rpar = stat.rfind(')')
+        if rpar < 0:
+            return None
+        comm = stat[stat.find('(')+1:rpar]
+        if len(comm) >= self.widths[3]:
+            self.widen(3, comm)
+        text = stat[rpar+2:]  # kept as text until parsed (split list is 10 times larger)
+        stat = text.split()
+        args = None
+        values = [None] * (len(ps_fields) + 1)
+        for i, field in enumerate(ps_fields):
+            if field in self.stat_fields:
+                values[i] = stat[self.stat_fields[field]]
+            elif field in ('ucomm', 'comm'):
+                values[i] = comm
+            elif field == 'spid':
+                values[i] = tid or pid
+            elif field == 'lstart':  # process identity with pid (delta)
+                values[i] = self.lstart(int(stat[19]) // self.hertz)
+        values[0] = pid
+        return (values, (path, comm, text, args))
+
+    def read_threads(self, pid, ps_fields):
+        """read threads of process pid (main thread excluded)"""
+        threads = []
+        try:
+            tids = os.listdir(self.root + '/' + pid + '/task')
+        except OSError:
+            return threads
+        for tid in tids:
+            if tid == pid:
                 continue
-            if ppid == pid:
-                ppid = '-1'
-                infos['ppid'] = '-1'
-            if ppid not in self.children:
-                self.children[ppid] = []
-            self.children[ppid].append(pid)
-            self.ps_info[pid] = infos
-        if not self.ps_info.get('1'):
-            self.ps_info['1'] = self.ps_info['0']
-        if not pid_zero:
-            del self.ps_info['0']
-            del self.children['0']
+            thread = self.read_pid(pid, ps_fields, tid)
+            if thread:
+                threads.append(thread)
+        threads.sort(key=lambda thread: int(thread[0][ps_fields.index('spid')]))
+        return threads
 
-    def pgrep(self, argv):
-        """mini built-in pgrep if pgrep command not available
-           [-f] [-x] [-i] [-u <user>] [pattern]"""
-        if "PGT_PGREP" not in os.environ or os.environ["PGT_PGREP"]:
-            _, pgrep = runcmd('pgrep ' + shlex_join(argv))
-            return pgrep.split("\n")
+    @profiled('parse proc')
+    def parse(self, values, raw):
+        """read status/cmdline and compute fields not read from stat"""
+        pid, comm, stat, args = raw
+        stat = stat.split()
+        ids = {}
+        status = None
+        cached = self.previous.get(pid)
+        if cached and cached[0] == stat[19] and cached[1] == comm:  # same process
+            ids = cached[2]
+            if args is None:
+                args = cached[3]
+        elif self.need_status:
+            status = readfile(self.root + '/' + pid + '/status')
+            for line in status.splitlines():
+                if line.startswith('Uid:'):
+                    uids = line.split()
+                    ids['ruid'] = uids[1]
+                    ids['uid'] = uids[2]
+                elif line.startswith('Gid:'):
+                    ids['rgid'] = line.split()[1]
+                    break
+            if not 'uid' in ids:  # vanished
+                ids = {'uid': '?', 'ruid': '?', 'rgid': '?'}
+        rss = None
+        if self.need_rss:  # resident size of status like ps (stat rss is not synced)
+            if status is None:
+                status = readfile(self.root + '/' + pid + '/status')
+            start = status.find('\nVmRSS:')
+            if start >= 0:
+                rss = int(status[start:start+64].split()[1])
+        for i, field in enumerate(self.ps_fields):
+            if values[i] is not None:
+                continue
+            if field in ids:
+                values[i] = ids[field]
+            elif field in ('cgroup', 'pidns'):
+                values[i] = self.membership(pid, field)
+            else:
+                values[i] = self.compute(field, stat, ids, rss)
+        for i in self.spaced:
+            if len(values[i]) >= self.widths[i]:
+                self.widen(i, values[i])
+        if args is None:
+            args = self.cmdline(pid, comm, stat[0], values)
+        values[-1] = args
+        if self.keep:
+            self.cache[pid] = (stat[19], comm, ids, args)
+
+    def membership(self, path, field):
+        """pid namespace id or cgroups (non root hierarchies comma separated like ps)"""
+        if field == 'pidns':
+            try:
+                return os.readlink(self.root + '/' + path + '/ns/pid').split('[')[-1].rstrip(']')
+            except OSError:
+                return '-'
+        cgroups = [line for line in readfile(self.root + '/' + path + '/cgroup').splitlines()
+                   if line and not line.endswith(':/')]
+        return ','.join(cgroups) or '-'
 
+    def compute(self, field, stat, ids, rss=None):
+        """fields computed from stat or resolved names (rss KiB of status if read)"""
+        start = int(stat[19]) // self.hertz
+        if rss is None:
+            rss = int(stat[21]) * PAGE_SIZE // 1024
+        if field == 'user':
+            return self.user(ids['uid'])
+        if field == 'ruser':
+            return self.user(ids['ruid'])
+        if field == 'rgroup':
+            return self.group(ids['rgid'])
+        if field == 'tty':
+            return self.tty(int(stat[4]))
+        if field == 'stime':
+            return self.stime(start)
+        if field == 'lstart':
+            return self.lstart(start)
+        if field == 'etime':  # truncated elapsed like ps (start tick not rounded)
+            return self.duration(int(self.elapsed(stat)), True)
+        if field == 'time':
+            return self.duration((int(stat[11]) + int(stat[12])) // self.hertz, False)
+        if field == 'vsz':
+            return str(int(stat[20]) // 1024)
+        if field == 'rss':
+            return str(rss)
+        if field == '%cpu':  # truncated cpu per-mille like ps
+            elapsed = self.elapsed(stat)
+            if not elapsed:
+                return '0.0'
+            return self.percent(int((int(stat[11]) + int(stat[12])) * 1000 // self.hertz
+                                    / elapsed))
+        if field == '%mem':
+            if not self.mem_total:
+                return '0.0'
+            return self.percent(rss * 1000 // self.mem_total)
+        return ''
+
+    @profiled('read proc', len)
+    def read(self, ps_fields):
+        """read all processes (and threads if spid field) from /proc (lazy)
+           status/cmdline not read again for processes parsed in previous read if keep"""
+        procs = list(self.stream(ps_fields))
+        procs.sort(key=lambda proc: int(proc[0][0]))  # threads kept after their process
+        return procs
+
+    def stream(self, ps_fields):
+        """processes (and threads) read one by one from /proc (lazy), directory order"""
+        self.get_clock()
+        self.previous = self.cache
+        self.cache = {}
+        self.ps_fields = ps_fields
+        self.spaced = [2] + [i for i, field in enumerate(ps_fields) if field in OPT_WIDTHS]
+        self.widths = {2: USER_WIDTH, 3: COMM_WIDTH}
+        for i in self.spaced[1:]:
+            self.widths[i] = OPT_WIDTHS[ps_fields[i]]
+        self.need_status = False
+        self.need_rss = 'rss' in ps_fields or '%mem' in ps_fields
+        for field in ps_fields:
+            if field in self.status_fields:
+                self.need_status = True
+        threads = 'spid' in ps_fields
+        for pid in os.listdir(self.root):
+            if not pid.isdigit():
+                continue
+            proc = self.read_pid(pid, ps_fields)
+            if proc:
+                yield proc
+                if threads:
+                    for thread in self.read_threads(pid, ps_fields):
+                        yield thread
+
+
+class RemoteSource(PsSource):
+    """
+    Process source running ps command on host through transport command
+    (default ssh, PGT_TRANSPORT env), ps killed after timeout seconds
+    """
+    live = False
+    transport = 'ssh -o BatchMode=yes -o ConnectTimeout=5'
+
+    def __init__(self, host, transport=None, timeout=10):
+        self.host = host
+        self.name = 'remote-' + host
+        self.transport = transport or os.environ.get('PGT_TRANSPORT') or self.transport
+        self.timeout = timeout
+
+    def execute(self, ps_cmd, ps_fields):
+        """run ps command on host, IOError if failed or timed out"""
+        err, ps_out = runcmd_timeout(self.transport + ' ' + shlex_join([self.host, ps_cmd]),
+                                     self.timeout)
+        if err:
+            raise IOError(str(err))
+        return ps_out.splitlines()
+
+
+class FileSource(object):
+    """
+    Process source reading a saved process table (no ps output parsing):
+    snapshot file written by --record (snapshot index: 0 first, -1 last)
+    or json snapshot {fields, rows} (--cache file)
+    rows start with pid, ppid, user, comm, other fields not saved are '?'
+    fields of snapshot file rows are split when accessed (lazy)
+    """
+    live = False
+    lazy = True
+
+    def __init__(self, path, index=-1):
+        self.path = path
+        self.index = index
+        self.name = 'file-' + os.path.basename(path)
+        self.time = None      # time of snapshot read
+        self.columns = []     # saved column of fields
+
+    def available(self):
+        """saved file exists"""
+        return os.path.isfile(self.path)
+
+    def set_columns(self, saved_fields, ps_fields):
+        """saved columns of fields (pid ppid user comm first)"""
+        index = {}
+        for i, field in enumerate(saved_fields):
+            index[field] = i
+        self.columns = [0, 1, 2, 3] + [index.get(field) for field in ps_fields[4:]]
+
+    def read(self, ps_fields):
+        """saved rows with requested fields"""
+        text = read_snapshot_file(self.path)
+        if text.startswith('{'):
+            return self.read_json(text, ps_fields)
+        snapshots = ('\n' + text).split('\n' + SNAPSHOT_HEADER + ' ')[1:]
+        lines = snapshots[self.snapshot_index(len(snapshots))].split('\n')
+        self.check_version(lines[0])
+        return list(self.rows(ps_fields, lines[1:]))
+
+    def stream(self, ps_fields):
+        """rows of snapshot read line by line from file (json snapshot read at once)"""
+        count = 0
+        for line in snapshot_file_lines(self.path):
+            if not count and line.startswith('{'):
+                for row in self.read(ps_fields):
+                    yield row
+                return
+            if line.startswith(SNAPSHOT_HEADER + ' '):
+                count += 1
+        index = self.snapshot_index(count)
+        lines = snapshot_file_lines(self.path)
+        for line in lines:
+            if line.startswith(SNAPSHOT_HEADER + ' '):
+                if not index:
+                    self.check_version(line.split(' ')[1])
+                    break
+                index -= 1
+        for row in self.rows(ps_fields, lines):
+            yield row
+
+    def snapshot_index(self, count):
+        """index of snapshot in file of count snapshots, exits if not found"""
+        if not -count <= self.index < count:
+            print('Error: no snapshot ' + str(self.index) + ' in ' + self.path +
+                  ' (' + str(count) + ' snapshots)')
+            sys.exit(1)
+        return self.index % count
+
+    def check_version(self, version):
+        """exits if snapshot version not supported"""
+        if int(version) > SNAPSHOT_VERSION:
+            print('Error: snapshot version ' + version + ' not supported')
+            sys.exit(1)
+
+    def rows(self, ps_fields, lines):
+        """(values, line) of snapshot lines (until next snapshot), pid/ppid split
+           other fields split on access (all if spid field: threads rows known by spid)"""
+        nvalues = len(ps_fields) + 1
+        threads = 'spid' in ps_fields
+        for line in lines:
+            if line.startswith('#time '):
+                self.time = float(line[6:])
+            elif line.startswith('#fields\t'):
+                self.set_columns(line.split('\t')[1:], ps_fields)
+            elif line.startswith(SNAPSHOT_HEADER + ' '):
+                return
+            elif line:
+                values = [None] * nvalues
+                values[0:2] = line.split('\t', 2)[:2]
+                if threads:
+                    self.parse(values, line)
+                yield (values, line)
+
+    def read_json(self, text, ps_fields):
+        """rows of json snapshot"""
+        import json
+        snapshot = json.loads(text)
+        self.set_columns(snapshot['fields'], ps_fields)
+        procs = []
+        for row in snapshot['rows']:
+            values = [None] * (len(ps_fields) + 1)
+            self.fill(values, row)
+            procs.append(values)
+        return procs
+
+    def fill(self, values, row, start=0):
+        """values of fields from saved row (from field index start)"""
+        for i, column in enumerate(self.columns[start:], start):
+            if column is None:
+                values[i] = '?'
+            else:
+                values[i] = row[column]
+        values[-1] = row[-1]
+
+    def parse(self, values, line):
+        """split snapshot file row (pid/ppid already split, may be prefixed by hosts)"""
+        self.fill(values, line.split('\t'), 2)
+
+
+SNAPSHOT_HEADER = '#pgtree-snapshot'
+SNAPSHOT_VERSION = 1
+
+def read_snapshot_file(path):
+    """snapshot file text (gzip compressed or not)"""
+    with open(path, 'rb') as saved:
+        data = saved.read()
+    if data[:2] == b'\x1f\x8b':
+        import gzip
+        import io
+        data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+    return data.decode('utf-8', 'replace')
+
+def snapshot_file_lines(path):
+    """lines of snapshot file read one by one (gzip compressed or not)"""
+    with open(path, 'rb') as saved:
+        compressed = saved.read(2) == b'\x1f\x8b'
+    if compressed:
+        import gzip
+        saved = gzip.open(path, 'rb')
+    else:
+        saved = open(path, 'rb')
+    with saved:
+        for line in saved:
+            yield line.decode('utf-8', 'replace').rstrip('\n')
+
+
+class HostsSource(object):
+    """
+    Process source merging processes of several hosts read concurrently in threads
+    hosts: localhost/local, saved snapshot file or host name (ps through transport)
+    each host is a process under pid 0, its processes pids prefixed host:pid
+    host not read within timeout displayed with error
+    """
+    live = False
+    lazy = True
+
+    def __init__(self, hosts, transport=None, timeout=10, workers=32):
+        self.hosts = []
+        for host in hosts:
+            if host not in self.hosts:
+                self.hosts.append(host)
+        self.transport = transport
+        self.timeout = timeout
+        self.workers = workers
+        self.name = 'hosts-' + '-'.join(hosts)
+        self.errors = {}      # error of host
+
+    def host_source(self, host, ps_fields):
+        """source of host"""
+        if host in ('localhost', 'local'):
+            return get_source(None, ps_fields)
+        if os.path.isfile(host):
+            return FileSource(host)
+        return RemoteSource(host, self.transport, self.timeout)
+
+    def read_hosts(self, ps_fields):
+        """{host: (source, procs)} read by worker threads, hosts not read within timeout
+           or failed are in self.errors
+           each worker queues its host result, results queued after timeout are ignored"""
+        import threading
+        try:
+            from queue import Queue, Empty
+        except ImportError:
+            from Queue import Queue, Empty
+        done = Queue()
+        pending = list(reversed(self.hosts))
+        lock = threading.Lock()
+        def worker():
+            """read hosts until none left"""
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    host = pending.pop()
+                try:
+                    source = self.host_source(host, ps_fields)
+                    done.put((host, (source, source.read(ps_fields)), None))
+                except (IOError, OSError, ValueError, KeyError, SystemExit):
+                    done.put((host, None, str(sys.exc_info()[1]) or 'error'))
+        for _ in range(min(self.workers, len(self.hosts))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True  # stuck local ps not waited
+            thread.start()
+        deadline = time.time() + self.timeout * (len(self.hosts) // self.workers + 1) + 1
+        results = {}
+        for _ in self.hosts:
+            try:
+                host, result, error = done.get(True, max(deadline - time.time(), 0))
+            except Empty:
+                break
+            if error:
+                self.errors[host] = error
+            else:
+                results[host] = result
+        for host in self.hosts:
+            if host not in results and host not in self.errors:
+                self.errors[host] = 'timeout'
+            if host in self.errors:
+                sys.stderr.write('pgtree: ' + host + ': ' + self.errors[host] + '\n')
+        return results
+
+    @profiled('read hosts', len)
+    def read(self, ps_fields):
+        """processes of all hosts, pids prefixed by host"""
+        results = self.read_hosts(ps_fields)
+        spid = None
+        if 'spid' in ps_fields:
+            spid = ps_fields.index('spid')
+        procs = []
+        mypid = str(os.getpid())
+        for host in self.hosts:
+            (source, rows) = results.get(host, (None, []))
+            label = os.path.basename(host)
+            node = [label, '0', 'host', label] + [''] * (len(ps_fields) - 4)
+            node.append(self.errors.get(host) or str(len(rows)) + ' processes')
+            procs.append(node)
+            live = getattr(source, 'live', False)
+            for values in rows:
+                raw = None
+                if isinstance(values, tuple):
+                    values, raw = values
+                if live and values[0] == mypid:
+                    continue
+                if values[1] == '0' or values[1] == values[0]:
+                    values[1] = label
+                else:
+                    values[1] = label + ':' + values[1]
+                values[0] = label + ':' + values[0]
+                if spid and values[spid] is not None:
+                    values[spid] = label + ':' + values[spid]
+                if raw is None:
+                    procs.append(values)
+                else:
+                    procs.append((values, (source, raw)))
+        return procs
+
+    def parse(self, values, raw):
+        """parse fields by host source"""
+        raw[0].parse(values, raw[1])
+
+
+SOURCES = {
+    'ps': PsSource,
+    'proc': ProcSource,
+}
+
+def get_source(name=None, ps_fields=None):
+    """
+    process source from --source option or PGT_SOURCE env variable
+    auto (default): proc if available and supporting fields, else ps
+    file:<path>[@<index>]: snapshot saved with --record
+    or any object with read(ps_fields) method
+    """
+    if hasattr(name, 'read'):  # source object
+        return name
+    name = name or os.environ.get('PGT_SOURCE') or 'auto'
+    if name.startswith('file:'):  # file:<path>[@<index>]
+        path, _, index = name[5:].partition('@')
+        source = FileSource(path, int(index or -1))
+        if not source.available():
+            print('Error: snapshot file ' + path + ' not found')
+            sys.exit(1)
+        return source
+    if name == 'auto':
+        source = ProcSource()
+        if source.available() and source.supports(ps_fields or []):
+            return source
+        return PsSource()
+    if name not in SOURCES:
+        print('Error: unknown process source ' + name)
+        sys.exit(1)
+    source = SOURCES[name]()
+    if not source.available() or not source.supports(ps_fields or []):
+        print('Error: process source ' + name + ' cannot provide ' + ",".join(ps_fields or []))
+        sys.exit(1)
+    return source
+
+
+def cache_dir():
+    """persistent cache directory (PGT_CACHE_DIR env, default ~/.cache/pgtree)"""
+    return os.environ.get('PGT_CACHE_DIR') or \
+        (os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')) + '/pgtree'
+
+def caps_file():
+    """OS capabilities cache file of host/OS version (as written by bash preamble)"""
+    uname = os.uname()
+    return cache_dir() + '/caps-' + \
+        ' '.join([uname[0], uname[1], uname[2]]).replace(' ', '_').replace('/', '_')
+
+def load_caps(path=None):
+    """set PGT_* variables from OS capabilities cache file (KEY=value lines)
+       returns False if no cache"""
+    try:
+        with open(path or caps_file()) as caps:
+            lines = caps.read().splitlines()
+    except (OSError, IOError):
+        return False
+    for line in lines:
+        key, sep, value = line.partition('=')
+        if sep and key.startswith('PGT_'):
+            os.environ.setdefault(key, value.strip('"\''))
+    return True
+
+def store_caps(caps):
+    """write OS capabilities cache file (sourceable KEY=value lines)"""
+    path = caps_file()
+    tmp = path + '.' + str(os.getpid())
+    try:
+        if not os.path.isdir(cache_dir()):
+            os.makedirs(cache_dir())
+        with open(tmp, 'w') as out:
+            out.write(''.join([key + '=' + value + '\n' for key, value in caps]))
+        os.rename(tmp, path)
+    except (OSError, IOError):
+        pass
+
+def detect_caps():
+    """probe ps -o options and pgrep command supported by OS,
+       returns [(PGT_COMM, comm), (PGT_STIME, stime), (PGT_PGREP, pgrep path)]"""
+    def ps_accepts(options):
+        cmd = 'ps -p ' + str(os.getpid()) + options + ' >/dev/null 2>&1'
+        return runcmd(cmd)[0] is None
+    comm = ''
+    stime = ''
+    for name in ('ucomm', 'comm'):
+        if ps_accepts(' -o ' + name):
+            comm = name
+            break
+    if comm:
+        stime = 'time'
+        for name in ('stime', 'start'):
+            if ps_accepts(' -o ' + name):
+                stime = name
+                break
+    elif not ps_accepts(''):  # busybox no -p option
+        comm = 'comm'
+        stime = 'etime'
+    pgrep = ''
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        if directory and os.access(directory + '/pgrep', os.X_OK):
+            pgrep = directory + '/pgrep'
+            break
+    return [('PGT_COMM', comm), ('PGT_STIME', stime), ('PGT_PGREP', pgrep)]
+
+def capabilities():
+    """set each of PGT_COMM/PGT_STIME/PGT_PGREP not in environment:
+       from OS capabilities cache, or probed once and cached"""
+    keys = ['PGT_COMM', 'PGT_STIME', 'PGT_PGREP']
+    missing = [key for key in keys if key not in os.environ]
+    if not missing:
+        return
+    if load_caps() and not [key for key in missing if key not in os.environ]:
+        return
+    caps = detect_caps()
+    store_caps(caps)
+    for key, value in caps:
+        os.environ.setdefault(key, value)
+
+def runtime_dir():
+    """private directory of processes snapshots cache ($XDG_RUNTIME_DIR/pgtree)
+       None if not owned by user"""
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        directory = runtime + '/pgtree'
+    else:
+        directory = '/tmp/pgtree-' + str(os.getuid())
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError:
+        pass
+    try:
+        if os.stat(directory).st_uid != os.getuid():
+            return None
+    except OSError:
+        return None
+    return directory
+
+def clear_cache():
+    """invalidate OS capabilities and processes snapshots caches"""
+    paths = [caps_file()]
+    directory = runtime_dir()
+    if directory:
+        paths += [directory + '/' + name for name in os.listdir(directory)
+                  if name.startswith('snapshot-')]
+    for path in paths:
         try:
-            opts, args = getopt.getopt(argv, "ifxu:")
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class CachedSource(object):
+    """
+    processes table shared by invocations within ttl seconds (--cache)
+    source read stored in runtime directory, all fields parsed before store
+    """
+    name = 'cache'
+
+    def __init__(self, source=None, ttl=2, directory=None):
+        self.source = source
+        self.ttl = ttl
+        self.directory = directory or runtime_dir()
+        self.hit = False  # last read from cache
+
+    def path(self, source, ps_fields):
+        """cache file of source and fields"""
+        import re
+        key = source.name + '-' + '-'.join(ps_fields)
+        return self.directory + '/snapshot-' + re.sub('[^A-Za-z0-9]', '_', key) + '.json'
+
+    @profiled('read cache', len)
+    def read(self, ps_fields):
+        """cached processes if fresh, else read source and store"""
+        import json
+        source = get_source(self.source, ps_fields)
+        self.hit = False
+        if not self.directory:
+            return source.read(ps_fields)
+        path = self.path(source, ps_fields)
+        try:
+            if time.time() - os.stat(path).st_mtime < self.ttl:
+                with open(path) as cache:
+                    snapshot = json.load(cache)
+                if snapshot['fields'] == ps_fields:
+                    self.hit = True
+                    return snapshot['rows']
+        except (OSError, IOError, ValueError, KeyError):
+            pass
+        procs = source.read(ps_fields)
+        lazy = getattr(source, 'lazy', False)
+        mypid = str(os.getpid())
+        rows = []
+        for values in procs:
+            if lazy and isinstance(values, tuple):
+                source.parse(values[0], values[1])
+                values = values[0]
+            if values[0] != mypid or not getattr(source, 'live', False):
+                rows.append(values)
+        self.store(path, ps_fields, rows)
+        return rows
+
+    def store(self, path, ps_fields, rows):
+        """write cache file atomically (readable by user only)"""
+        import json
+        tmp = path + '.' + str(os.getpid())
+        try:
+            out = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w')
+            with out:
+                json.dump({'fields': ps_fields, 'rows': rows}, out)
+            os.rename(tmp, path)
+        except (OSError, IOError):
+            pass
+
+
+class Psinfo(object):
+    """
+    Compact process record: list of values sharing field index with
+    all records of the process table, dict like access: info['user']
+    values not yet parsed (None) are parsed by source from raw data on first access
+    """
+    __slots__ = ('values', 'fields', 'raw', 'source')
+
+    def __init__(self, values, fields, raw=None, source=None):
+        """values: [pid, ppid, user, comm, <opt fields>..., args]"""
+        self.values = values
+        self.fields = fields
+        self.raw = raw
+        self.source = source
+
+    def load(self):
+        """parse values not loaded by source"""
+        self.source.parse(self.values, self.raw)
+        self.raw = None
+        if '/' in self.values[3]:
+            self.values[3] = os.path.basename(self.values[3])
+
+    def __getitem__(self, field):
+        value = self.values[self.fields[field]]
+        if value is None and self.raw is not None:
+            self.load()
+            value = self.values[self.fields[field]]
+        return value
+
+    def __setitem__(self, field, value):
+        self.values[self.fields[field]] = value
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def get(self, field, default=None):
+        """dict get"""
+        if field in self.fields:
+            return self[field]
+        return default
+
+    def keys(self):
+        """fields names"""
+        return list(self.fields.keys())
+
+    def items(self):
+        """(field, value) list"""
+        if self.raw is not None:
+            self.load()
+        return [(field, self.values[i]) for field,i in self.fields.items()]
+
+    def __eq__(self, other):
+        if not hasattr(other, 'items'):
+            return False
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def user_uid(user):
+    """user name to uid"""
+    try:
+        import pwd
+        return str(pwd.getpwnam(user)[2])
+    except (ImportError, KeyError):
+        return user
+
+def is_process(pid):
+    """pid or host:pid, not host node of --hosts"""
+    return pid.isdigit() or ':' in pid
+
+def pid_key(pid):
+    """sort key of pid, host:pid (--hosts) sorted by host then pid"""
+    host, _, number = pid.rpartition(':')
+    if not number.isdigit():  # host node before its processes
+        return (pid, -1)
+    return (host, int(number))
+
+def etime_seconds(etime):
+    """ps etime [[dd-]hh:]mm:ss to seconds"""
+    days = 0
+    if '-' in etime:
+        days, etime = etime.split('-', 1)
+    seconds = 0
+    for value in etime.split(':'):
+        seconds = seconds * 60 + int(value)
+    return int(days) * 86400 + seconds
+
+def field_number(value):
+    """numeric value of ps field (durations in seconds), 0 if not numeric"""
+    try:
+        if ':' in value:
+            return etime_seconds(value)
+        return float(value)
+    except ValueError:
+        return 0
+
+def cgroup_paths(cgroup):
+    """paths of ps -o cgroup value (hierarchy:controllers:path,...), unified hierarchy first"""
+    import re
+    paths = []
+    for hierarchy in re.split(',(?=[0-9]+:)', cgroup):
+        hierarchy = hierarchy.split(':', 2)
+        if len(hierarchy) < 3 or hierarchy[2] in ('', '/'):
+            continue
+        if hierarchy[0] == '0':
+            paths.insert(0, hierarchy[2])
+        elif hierarchy[2] not in paths:
+            paths.append(hierarchy[2])
+    return paths
+
+def cgroup_label(path):
+    """container runtime:short id of cgroup path, else last path component"""
+    import re
+    container = re.search('(docker|containerd|crio|libpod)?[-/]?([0-9a-f]{64})', path)
+    if container:
+        return (container.group(1) or 'container') + ':' + container.group(2)[:12]
+    return path.rstrip('/').rsplit('/', 1)[-1] or '/'
+
+def format_number(value):
+    """number without useless decimals"""
+    if value == int(value):
+        return str(int(value))
+    return '%.1f' % value
+
+
+class Pgrep:
+    """
+    Built-in pgrep matching the already loaded process table
+    [-f] [-x] [-i] [-v] [-n|-o] [-w] [-u|-U|-g|-G|-P|-s|-t <value>,...] [-F <pidfile>]
+    [--ns <pid> [--nslist <ns>,...]] [--cgroup <cgroup>,...] [--pattern-file <file>]
+    [pattern ...]
+    several patterns matched in one pass (one regex alternation, dict lookup for -x
+    literals, patterns with inline flags/backreferences compiled separately),
+    tags: pattern of matched pids
+    """
+    REGEX_CHARS = set('.^$*+?{}[]\\|()')
+    SEPARATE = r'\(\?[aiLmsux]+\)|\\[1-9]|\(\?P='  # not combined in alternation
+    NAMESPACES = ['ipc', 'mnt', 'net', 'pid', 'user', 'uts']
+
+    def __init__(self, argv):
+        """parse pgrep options, compile pattern and selection filters"""
+        import getopt
+        import re
+        try:
+            opts, args = getopt.getopt(argv, "fxivnowu:U:g:G:P:s:t:F:", ["ns=", "nslist=",
+                                                                          "cgroup=",
+                                                                          "pattern-file="])
         except getopt.GetoptError:
             print("bad pgrep parameters")
             sys.exit(2)
-        psfield = "comm"
+        self.psfield = "comm"
+        self.negate = False
+        self.newest = None
+        self.filters = []      # (field, values) alternatives, all filters must match
+        self.fields = []       # ps fields needed
+        self.namespace = None
+        self.nslist = self.NAMESPACES
+        self.cgroups = None
         flag = 0
         exact = False
-        user = ".*"
-        pattern = ".*"
         for opt, arg in opts:
             if opt == "-f":
-                psfield = "args"
+                self.psfield = "args"
             elif opt == "-i":
                 flag = re.IGNORECASE
             elif opt == "-x":
                 exact = True
+            elif opt == "-v":
+                self.negate = True
+            elif opt == "-n":
+                self.newest = True
+            elif opt == "-o":
+                self.newest = False
             elif opt == "-u":
-                user = arg
-        if args:
-            pattern = args[0]
+                self.add_filter(arg, 'user', 'uid')
+            elif opt == "-U":
+                self.add_filter(arg, 'ruser', 'ruid')
+            elif opt == "-g":
+                self.add_filter(arg, 'pgid', own=str(os.getpgrp()))
+            elif opt == "-G":
+                self.add_filter(arg, 'rgroup', 'rgid')
+            elif opt == "-P":
+                self.add_filter(arg, 'ppid')
+            elif opt == "-s":
+                self.add_filter(arg, 'sid', own=str(os.getsid(0)))
+            elif opt == "-t":
+                self.add_filter(arg.replace('/dev/', ''), 'tty')
+            elif opt == "-F":
+                pid = readfile(arg).strip().split('\n')[0].strip()
+                if not pid.isdigit():  # missing, empty or not a pid (like pgrep)
+                    sys.stderr.write('pgrep: pidfile not valid\n')
+                    sys.exit(1)
+                self.add_filter(pid, 'pid')
+            elif opt == "--ns":
+                self.namespace = arg
+            elif opt == "--nslist":
+                self.nslist = arg.split(',')
+            elif opt == "--cgroup":
+                self.cgroups = set(arg.split(','))
+                self.fields.append('cgroup')
+            elif opt == "--pattern-file":
+                args += [line for line in readfile(arg).splitlines()
+                         if line and not line.startswith('#')]
+        if self.newest is not None:
+            self.fields.append('etime')
+        self.patterns = args
+        self.tags = {}         # pid: matched pattern (several patterns)
+        self.pattern = None
+        self.regexes = None    # patterns compiled separately
+        self.literals = None   # exact literal patterns: {value: pattern}
+        if len(args) > 1 and exact and not [p for p in args if self.REGEX_CHARS & set(p)]:
+            self.literals = {}
+            for pattern in reversed(args):
+                if flag:
+                    self.literals[pattern.lower()] = pattern
+                else:
+                    self.literals[pattern] = pattern
+        elif len(args) > 1:
+            if not [p for p in args if re.search(self.SEPARATE, p)]:
+                pattern = '|'.join(['(?P<p' + str(i) + '>' + p + ')' for i, p in enumerate(args)])
+                if exact:
+                    pattern = '^(?:' + pattern + ')$'
+                try:
+                    self.pattern = re.compile(pattern, flag)
+                except re.error:  # invalid pattern reported by separate compile
+                    pass
+            if not self.pattern:
+                self.regexes = [self.compile(p, flag, exact) for p in args]
+        elif args:
+            self.pattern = self.compile(args[0], flag, exact)
+        self.ignorecase = flag
+
+    def compile(self, pattern, flag, exact):
+        """compiled pattern (whole value if exact), exits if invalid like pgrep"""
+        import re
         if exact:
-            pattern = "^" + pattern + "$"
-        pids = []
-        for pid,info in self.ps_info.items():
-            if pid == '0':
+            flags = re.match(r'\(\?[aiLmsux]+\)', pattern)  # global flags kept first
+            prefix = ''
+            if flags:
+                prefix = flags.group(0)
+            pattern = prefix + '^(?:' + pattern[len(prefix):] + ')$'
+        try:
+            return re.compile(pattern, flag)
+        except re.error as err:
+            sys.stderr.write('pgrep: regex error: ' + str(err) + '\n')
+            sys.exit(2)
+
+    def tag(self, found):
+        """pattern of alternation match"""
+        name = found.lastgroup
+        if not name or not name.startswith('p') or not name[1:].isdigit():  # inner group
+            for i in range(len(self.patterns)):
+                if found.group('p' + str(i)) is not None:
+                    return self.patterns[i]
+        return self.patterns[int(name[1:])]
+
+    def add_filter(self, arg, field, idfield=None, own=None):
+        """comma separated values, numeric values are ids (uid/gid), 0 is own pgid/sid"""
+        alternatives = {}
+        for value in arg.split(','):
+            if own and value == '0':
+                value = own
+            if idfield and value.isdigit():
+                name = idfield
+            else:
+                name = field
+            if name not in alternatives:
+                alternatives[name] = []
+                if name not in self.fields and name not in ('pid', 'ppid'):
+                    self.fields.append(name)
+            alternatives[name].append(value)
+        self.filters.append(alternatives)
+
+    def supported(self, ptree):
+        """check loaded process table has fields needed"""
+        for field in self.fields:
+            if field not in ptree.fields:
+                return False
+        if self.namespace and not os.path.isdir('/proc/self/ns'):
+            return False
+        return True
+
+    def namespaces(self, pid):
+        """namespaces ids of pid"""
+        nsids = []
+        for nstype in self.nslist:
+            try:
+                nsids.append(os.readlink('/proc/' + pid + '/ns/' + nstype))
+            except OSError:
+                nsids.append(None)
+        return nsids
+
+    def in_cgroups(self, cgroup):
+        """cgroup path (any hierarchy) or its container label in selected cgroups"""
+        for path in cgroup_paths(cgroup) or ['/']:
+            if path in self.cgroups or cgroup_label(path) in self.cgroups:
+                return True
+        return False
+
+    @profiled('pgrep', len)
+    def match(self, ptree):
+        """pids matching pattern and filters, sorted by pid"""
+        candidates = None
+        for alternatives in self.filters:
+            pids = set()
+            for field, values in alternatives.items():
+                if field == 'pid':
+                    pids.update([v for v in values if v in ptree.ps_info])
+                    continue
+                if field == 'user' and ptree.ps_fields[2] == 'uid':
+                    field = 'uid'
+                    values = [user_uid(v) for v in values]
+                index = ptree.index(field)
+                for value in values:
+                    pids.update(index.get(value, []))
+            if candidates is not None:
+                pids &= candidates
+            candidates = pids
+        if candidates is None:
+            candidates = ptree.ps_info
+        nsids = None
+        if self.namespace:
+            nsids = self.namespaces(self.namespace)
+        matched = set()
+        for pid in candidates:
+            info = ptree.ps_info[pid]
+            if pid == '0' or info['pid'] != pid or not is_process(pid):
+                continue
+            if self.literals is not None:
+                value = info[self.psfield]
+                if self.ignorecase:
+                    value = value.lower()
+                if value not in self.literals:
+                    continue
+                self.tags[pid] = self.literals[value]
+            elif self.pattern:
+                found = self.pattern.search(info[self.psfield])
+                if not found:
+                    continue
+                if len(self.patterns) > 1:
+                    self.tags[pid] = self.tag(found)
+            elif self.regexes:
+                value = info[self.psfield]
+                tags = [self.patterns[i] for i, regex in enumerate(self.regexes)
+                        if regex.search(value)]
+                if not tags:
+                    continue
+                self.tags[pid] = tags[0]
+            if nsids and self.namespaces(pid) != nsids:
+                continue
+            if self.cgroups and not self.in_cgroups(info['cgroup']):
                 continue
-            if re.search(pattern, info[psfield], flag) and \
-               re.match(user, info["user"]):
-                pids.append(pid)
+            matched.add(pid)
+        if self.negate:
+            self.tags = {}
+            matched = set([pid for pid,info in ptree.ps_info.items()
+                           if pid not in matched and pid != '0' and info['pid'] == pid
+                           and is_process(pid)])
+        pids = list(matched)
+        if self.newest is not None and pids:
+            def age(pid):
+                """elapsed time, younger pid first for same start time"""
+                return (etime_seconds(ptree.ps_info[pid]['etime']), -pid_key(pid)[1])
+            pids.sort(key=age)
+            if self.newest:
+                return pids[:1]
+            return pids[-1:]
+        pids.sort(key=pid_key)
         return pids
 
-    def get_parents(self):
-        """get parents list of pids"""
-        last_ppid = None
-        for pid in self.pids:
-            if pid not in self.ps_info:
+
+def get_fields(opt_fields=None, use_uid=False):
+    """ Get ps fields from OS / optionnal fields """
+    capabilities()
+    if use_uid:
+        user = 'uid'
+    else:
+        user = 'user'
+    if not opt_fields or not os.environ.get('PGT_COMM'):
+        opt_fields = [os.environ.get('PGT_STIME') or 'stime']
+
+    return ['pid', 'ppid', user, os.environ.get('PGT_COMM') or 'ucomm'] + opt_fields
+
+
+def field_indexes(ps_fields):
+    """index of fields in process values (comm and user/uid at fixed index)"""
+    fields = {'args': len(ps_fields)}
+    for i,field in enumerate(['pid', 'ppid', 'user', 'comm'] + ps_fields[4:]):
+        if field not in fields:
+            fields[field] = i
+    if ps_fields[2] not in fields:  # uid
+        fields[ps_fields[2]] = 2
+    return fields
+
+def pgrep_command(argv, matcher, ptree, external=False):
+    """pids of pgrep command if external or options not supported by built-in, else None"""
+    if not external and not matcher.supported(ptree):
+        external = os.environ.get('PGT_PGREP', 'pgrep')
+        if not external:
+            print('Error: pgrep options not supported by built-in pgrep')
+            sys.exit(2)
+    if external:
+        _, pgrep = runcmd('pgrep ' + shlex_join(argv))
+        return pgrep.split("\n")
+    return None
+
+
+class Snapshot(object):
+    """
+    Process table read once from process source, queries do not modify it
+    (event watch inserts/removes processes), saved to snapshot file with save()
+    snap = Snapshot(source='proc')
+    snap.descendants(snap.pgrep(['sshd']))
+    """
+
+    def __init__(self, ps_fields=None, source=None, pid_zero=True):
+        """read processes from source"""
+        self.ps_fields = ps_fields or get_fields()
+        self.ps_info = {}        # ps command info stored
+        self.children = {}       # children of pid
+        self.threads = {}        # threads infos of pid (spid field, main thread excluded)
+        self.fields = {}         # field index of ps_info records
+        self.indexes = {}        # pids by field value
+        self.source = get_source(source, self.ps_fields)
+        self.get_psinfo(pid_zero)
+
+    @profiled('get_psinfo')
+    def get_psinfo(self, pid_zero):
+        """parse processes from process source"""
+        fields = field_indexes(self.ps_fields)
+        self.fields = fields
+        mypid = None
+        if getattr(self.source, 'live', False):  # hide pgtree process
+            mypid = str(os.getpid())
+        basename = os.path.basename
+        procs = self.source.read(self.ps_fields)
+        lazy = getattr(self.source, 'lazy', False)
+        spid = fields.get('spid')
+        raw = None
+        for values in [["0", "0"] + self.ps_fields[2:] + ['args']] + procs:
+            if lazy and isinstance(values, tuple):
+                values, raw = values
+            pid = values[0]
+            ppid = values[1]
+            if pid == mypid:
+                continue
+            if spid and values[spid] != pid and pid != '0':  # thread of process pid
+                if pid not in self.threads:
+                    self.threads[pid] = []
+                if raw is None:
+                    self.threads[pid].append(Psinfo(values, fields))
+                else:
+                    self.threads[pid].append(Psinfo(values, fields, raw, self.source))
+                continue
+            if values[3] and '/' in values[3]:
+                values[3] = basename(values[3])
+            if ppid == pid:
+                ppid = '-1'
+                values[1] = '-1'
+            if ppid not in self.children:
+                self.children[ppid] = []
+            self.children[ppid].append(pid)
+            if raw is None:
+                self.ps_info[pid] = Psinfo(values, fields)
+            else:
+                self.ps_info[pid] = Psinfo(values, fields, raw, self.source)
+        if not self.ps_info.get('1'):
+            self.ps_info['1'] = self.ps_info['0']
+        if not pid_zero:
+            del self.ps_info['0']
+            del self.children['0']
+
+    def added(self, infos):
+        """new snapshot with processes infos {pid: Psinfo} added"""
+        snapshot = Snapshot.__new__(Snapshot)
+        snapshot.__dict__.update(self.__dict__)
+        snapshot.ps_info = dict(self.ps_info)
+        snapshot.children = dict(self.children)
+        snapshot.indexes = {}
+        for pid,info in infos.items():
+            snapshot.ps_info[pid] = info
+            snapshot.children[info['ppid']] = snapshot.children.get(info['ppid'], []) + [pid]
+        return snapshot
+
+    def save(self, path):
+        """
+        append process table to snapshot file (gzip compressed if path ends with .gz)
+        #pgtree-snapshot <version>, #time <epoch>, #fields<tab><fields>...<tab>args
+        and one tab separated row per process/thread
+        """
+        lines = [SNAPSHOT_HEADER + ' ' + str(SNAPSHOT_VERSION), '#time %.3f' % time.time(),
+                 '\t'.join(['#fields'] + self.ps_fields + ['args'])]
+        header = self.ps_info.get('0')
+        for pid in sorted(self.ps_info, key=pid_key):
+            info = self.ps_info[pid]
+            if info is header:
                 continue
+            for info in [info] + self.threads.get(pid, []):
+                if info.raw is not None:
+                    info.load()
+                lines.append('\t'.join([value.replace('\t', ' ').replace('\n', ' ')
+                                        for value in info.values]))
+        data = '\n'.join(lines) + '\n'
+        if path.endswith('.gz'):
+            import gzip
+            out = gzip.open(path, 'ab')
+            data = data.encode('utf-8')
+        else:
+            out = open(path, 'a')
+        with out:
+            out.write(data)
+
+    def read_pid(self, pid):
+        """process pid read again from source, None if exited (or source reads all only)"""
+        if not hasattr(self.source, 'read_pid'):
+            return None
+        proc = self.source.read_pid(pid, self.ps_fields)
+        if not proc:
+            return None
+        values, raw = proc
+        if values[1] == pid:
+            values[1] = '-1'
+        return Psinfo(values, self.fields, raw, self.source)
+
+    def insert(self, pid, info):
+        """add or replace process pid under its parent (kept in place if same parent)"""
+        previous = self.ps_info.get(pid)
+        if previous is not None and previous['ppid'] == info['ppid']:  # exec
+            self.ps_info[pid] = info
+            self.indexes = {}
+            return
+        self.remove(pid)
+        self.ps_info[pid] = info
+        if info['ppid'] not in self.children:
+            self.children[info['ppid']] = []
+        self.children[info['ppid']].append(pid)
+
+    def remove(self, pid):
+        """remove process pid (its children are kept), returns its info (None if unknown)"""
+        info = self.ps_info.pop(pid, None)
+        if info is not None:
+            siblings = self.children.get(info['ppid'], [])
+            if pid in siblings:
+                siblings.remove(pid)
+            self.indexes = {}
+        return info
+
+    def index(self, field):
+        """pids by field value (built once per field)"""
+        if field == 'ppid':
+            return self.children
+        if field not in self.indexes:
+            index = {}
+            for pid,info in self.ps_info.items():
+                value = info[field]
+                if value not in index:
+                    index[value] = []
+                index[value].append(pid)
+            self.indexes[field] = index
+        return self.indexes[field]
+
+    def pgrep(self, argv, external=False, tags=None):
+        """matched pids of built-in pgrep on snapshot processes
+           or of pgrep command if external or options not supported by built-in
+           tags: filled with matched pattern of pids (several patterns)"""
+        matcher = Pgrep(argv)
+        pids = pgrep_command(argv, matcher, self, external)
+        if pids is not None:
+            return pids
+        pids = matcher.match(self)
+        if tags is not None:
+            tags.update(matcher.tags)
+        return pids
+
+    def ancestors(self, pids):
+        """ancestors of pids (parent first), each ancestor once"""
+        ancestors = []
+        seen = set(pids)
+        for pid in pids:
             while pid in self.ps_info:
+                pid = self.ps_info[pid]['ppid']
+                if pid in seen or pid not in self.ps_info:
+                    break
+                seen.add(pid)
+                ancestors.append(pid)
+        return ancestors
+
+    def descendants(self, pids):
+        """descendants of pids (tree order), each descendant once"""
+        descendants = []
+        pids = list(pids)
+        selected = set(pids)
+        seen = set()
+        stack = []
+        for pid in reversed(pids):
+            stack.extend(reversed(self.children.get(pid, [])))
+        while stack:
+            pid = stack.pop()
+            if pid in seen:
+                continue
+            seen.add(pid)
+            if pid not in selected:
+                descendants.append(pid)
+            stack.extend(reversed(self.children.get(pid, [])))
+        return descendants
+
+    @profiled('build_tree')
+    def subtree(self, pids, below=None, above=None):
+        """process tree of pids with parents and children
+           below/above: levels of children/parents of pids (default all)
+           returns (pids_tree, top_parents), pids_tree: children displayed of pid"""
+        pids_tree = {}
+        top_parents = []
+        self.children2tree(pids, pids_tree, below)
+        if above is not None:  # pids displayed under other pids: no parents walk
+            children = set()
+            for pid in pids_tree:
+                children.update(pids_tree[pid])
+            pids = [pid for pid in pids if pid not in children]
+        self.get_parents(pids, pids_tree, top_parents, above)
+        return (pids_tree, top_parents)
+
+    def get_parents(self, pids, pids_tree, top_parents, above=None):
+        """add parents of pids (at most above levels) to pids_tree/top_parents
+           walk stops at pids already walked (top parent known)"""
+        top = {}        # top parent of walked pids
+        members = {}    # set of pids_tree[ppid]
+        tops = set(top_parents)
+        for pid in pids:
+            if pid not in self.ps_info:
+                continue
+            path = []
+            last_ppid = None
+            while pid in self.ps_info and pid not in top:
+                if above is not None and len(path) >= above:  # top parent
+                    top[pid] = pid
+                    last_ppid = pid
+                    break
                 ppid = self.ps_info[pid]['ppid']
-                if ppid not in self.pids_tree:
-                    self.pids_tree[ppid] = []
-                if pid not in self.pids_tree[ppid]:
-                    self.pids_tree[ppid].append(pid)
+                if ppid not in pids_tree:
+                    pids_tree[ppid] = []
+                if ppid not in members:
+                    members[ppid] = set(pids_tree[ppid])
+                if pid not in members[ppid]:
+                    members[ppid].add(pid)
+                    pids_tree[ppid].append(pid)
+                path.append(pid)
                 last_ppid = pid
                 pid = ppid
-            if last_ppid not in self.top_parents:
-                self.top_parents.append(last_ppid)
+            if pid in top:
+                last_ppid = top[pid]
+            for walked in path:
+                top[walked] = last_ppid
+            if last_ppid not in tops:
+                tops.add(last_ppid)
+                top_parents.append(last_ppid)
+
+    def children2tree(self, pids, pids_tree, below=None):
+        """add children of pids to pids_tree (iterative)
+           below: levels of children under pids, walk stops at last level"""
+        if below is not None:
+            selected = set(pids)
+            stack = [(pid, 0) for pid in pids]
+            while stack:
+                (pid, level) = stack.pop()
+                if pid in pids_tree or pid not in self.children or level >= below:
+                    continue
+                pids_tree[pid] = list(self.children[pid])
+                for child in self.children[pid]:
+                    if child in selected:
+                        stack.append((child, 0))
+                    else:
+                        stack.append((child, level + 1))
+            return
+        stack = list(pids)
+        while stack:
+            pid = stack.pop()
+            if pid in pids_tree or pid not in self.children:
+                continue
+            pids_tree[pid] = list(self.children[pid])
+            stack.extend(self.children[pid])
+
+
+def row_values(row):
+    """values of process source row (lazy sources rows: (values, raw))"""
+    if isinstance(row, tuple):
+        return row[0]
+    return row
 
-    # recursive
-    def children2tree(self, pids):
-        """build children tree"""
+
+class RowsSource(object):
+    """rows already read from a process source (other attributes of source)"""
+
+    def __init__(self, source, rows):
+        self.source = source
+        self.rows = rows
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def read(self, ps_fields):
+        """rows given, list emptied (raw data of rows released once parsed)"""
+        rows = self.rows[:]
+        del self.rows[:]
+        return rows
+
+
+class Skeleton(object):
+    """
+    Process tree skeleton of process source read as a stream (bounded memory):
+    pid/ppid integer arrays sorted by pid and by ppid, fields of processes parsed
+    only for pgrep matching by chunks, processes displayed read again by snapshot()
+    skel = Skeleton(source='proc')
+    snap = skel.snapshot(skel.pgrep(['sshd']))
+    """
+
+    def __init__(self, ps_fields=None, source=None, chunk=1024):
+        self.ps_fields = ps_fields or get_fields()
+        self.fields = field_indexes(self.ps_fields)
+        self.source = get_source(source, self.ps_fields)
+        self.chunk = chunk       # processes matched at once
+        self.pids = None         # pids sorted
+        self.ppids = None        # parent of pids
+        self.child_pids = None   # children of pids[i]: child_pids[first[i]:first[i+1]]
+        self.first = None
+
+    def stream(self):
+        """rows of source read one by one (at once if source cannot stream)"""
+        if hasattr(self.source, 'stream'):
+            return self.source.stream(self.ps_fields)
+        return iter(self.source.read(self.ps_fields))
+
+    @profiled('read skeleton')
+    def read(self, matcher=None):
+        """
+        read pid/ppid of processes (threads skipped), returns pids matched by matcher
+        arrays sorted once at end if source not in pid order
+        """
+        from array import array
+        mypid = None
+        if getattr(self.source, 'live', False):
+            mypid = str(os.getpid())
+        spid = self.fields.get('spid')
+        pids = array('i')
+        ppids = array('i')
+        matched = []
+        rows = []
+        ordered = True
+        for row in self.stream():
+            values = row_values(row)
+            if values[0] == mypid or (spid and values[spid] != values[0]):
+                continue
+            pid = int(values[0])
+            ppid = int(values[1])
+            if ppid == pid:
+                ppid = -1
+            if pids and pids[-1] > pid:
+                ordered = False
+            pids.append(pid)
+            ppids.append(ppid)
+            if matcher:
+                rows.append(row)
+                if len(rows) >= self.chunk:
+                    matched += self.match(matcher, rows)
+                    rows = []
+        if rows:
+            matched += self.match(matcher, rows)
+        if not ordered:  # (pid, ppid) packed in one integer sorted at once
+            packed = sorted([(pid << 32) | (ppids[i] & 0xffffffff) for i, pid in enumerate(pids)])
+            del pids[:], ppids[:]
+            for value in packed:
+                pids.append(value >> 32)
+                ppids.append(((value & 0xffffffff) ^ 0x80000000) - 0x80000000)
+        self.pids = pids
+        self.ppids = ppids
+        self.index_children()
+        return matched
+
+    def index_children(self):
+        """children arrays grouped by parent position (counting sort, pid order kept)"""
+        from array import array
+        parents = array('i', [-1]) * len(self.pids)
+        first = array('i', [0]) * (len(self.pids) + 1)
+        for i, ppid in enumerate(self.ppids):
+            parent = self.position(ppid)
+            parents[i] = parent
+            if parent >= 0:
+                first[parent + 1] += 1
+        total = 0
+        for i, count in enumerate(first):
+            total += count
+            first[i] = total
+        fill = array('i', first)
+        self.child_pids = array('i', [0]) * total
+        for i, parent in enumerate(parents):
+            if parent >= 0:
+                self.child_pids[fill[parent]] = self.pids[i]
+                fill[parent] += 1
+        self.first = first
+
+    def match(self, matcher, rows):
+        """pids of rows matched (newest/oldest: all matched rows kept for final match)"""
+        if matcher.newest is None:
+            return matcher.match(Snapshot(self.ps_fields, RowsSource(self.source, rows)))
+        chunk = Snapshot(self.ps_fields, RowsSource(self.source, list(rows)))
+        newest = matcher.newest
+        matcher.newest = None
+        matched = set(matcher.match(chunk))
+        matcher.newest = newest
+        return [row for row in rows if row_values(row)[0] in matched]
+
+    def pgrep(self, argv, external=False, tags=None):
+        """matched pids of built-in pgrep on processes streamed while skeleton read
+           or of pgrep command (see Snapshot.pgrep)"""
+        matcher = Pgrep(argv)
+        pids = pgrep_command(argv, matcher, self, external)
+        if pids is not None:
+            self.read()
+            return pids
+        matched = self.read(matcher)
+        if matcher.newest is not None:
+            matched = matcher.match(Snapshot(self.ps_fields, RowsSource(self.source, matched)))
+        if tags is not None:
+            tags.update(matcher.tags)
+        return matched
+
+    def position(self, pid):
+        """index of pid (int) in pids, -1 if not found"""
+        import bisect
+        idx = bisect.bisect_left(self.pids, pid)
+        if idx < len(self.pids) and self.pids[idx] == pid:
+            return idx
+        return -1
+
+    def parent(self, pid):
+        """parent of pid (int), None if not found"""
+        idx = self.position(pid)
+        if idx < 0:
+            return None
+        return self.ppids[idx]
+
+    def children(self, pid):
+        """children of pid (int)"""
+        idx = self.position(pid)
+        if idx < 0:
+            return []
+        return self.child_pids[self.first[idx]:self.first[idx+1]]
+
+    def family(self, pids):
+        """pids with their ancestors and descendants (int)"""
+        family = set()
+        for pid in pids:
+            while pid is not None and pid > 0 and pid not in family:
+                family.add(pid)
+                pid = self.parent(pid)
+        stack = list(pids)
+        while stack:
+            for child in self.children(stack.pop()):
+                if child not in family:
+                    family.add(child)
+                    stack.append(child)
+        return family
+
+    @profiled('read displayed')
+    def snapshot(self, pids=None, pid_zero=True):
+        """
+        Snapshot of processes displayed for pids (ancestors, descendants), all if None
+        read again from source: /proc/<pid> of processes or source rows of processes
+        """
+        keep = None
+        if pids is not None:
+            if self.pids is None:
+                self.read()
+            keep = self.family([int(pid) for pid in pids if pid.isdigit()])
+        rows = []
+        if keep is not None and hasattr(self.source, 'read_pid'):
+            threads = 'spid' in self.ps_fields
+            for pid in sorted(keep):
+                proc = self.source.read_pid(str(pid), self.ps_fields)
+                if proc:
+                    rows.append(proc)
+                    if threads:
+                        rows += self.source.read_threads(str(pid), self.ps_fields)
+        else:
+            for row in self.stream():
+                if keep is None or int(row_values(row)[0]) in keep:
+                    rows.append(row)
+        return Snapshot(self.ps_fields, RowsSource(self.source, rows), pid_zero)
+
+
+def process_starts(pids):
+    """
+    start time of running processes (identity against pid reuse)
+    from /proc or ps command, zombies and exited processes missing,
+    None for all pids if start time not available
+    """
+    starts = {}
+    if os.path.isfile('/proc/self/stat'):
         for pid in pids:
-            if pid in self.pids_tree:
+            stat = readfile('/proc/' + pid + '/stat')
+            rpar = stat.rfind(')')
+            if rpar < 0:
                 continue
-            if pid in self.children:
-                self.pids_tree[pid] = self.children[pid]
-                self.children2tree(self.children[pid])
+            stat = stat[rpar+2:].split()
+            if stat[0] != 'Z':
+                starts[pid] = stat[19]
+        return starts
+    if not pids:
+        return starts
+    err, out = runcmd('ps -o pid= -o stat= -o lstart= -p ' + ','.join(pids))
+    if err and not out:
+        for pid in pids:
+            starts[pid] = None
+        return starts
+    for line in out.splitlines():
+        values = line.split(None, 2)
+        if len(values) == 3 and not values[1].startswith('Z'):
+            starts[values[0]] = values[2]
+    return starts
+
+
+class Killer:
+    """
+    Kill processes trees:
+    process identity (start time) checked before signal, signal sent through pidfd if available
+    signals sent by batches of processes of same depth top-down or bottom-up
+    optionally tree frozen first (SIGSTOP) to catch new children
+    with timeout: tree rescanned until empty, TERM escalated to KILL after timeout
+    """
+
+    def __init__(self, ptree, sig=15, order='bottom-up', freeze=False, timeout=0):
+        """processes identity recorded from displayed tree (ptree.selected_pids)"""
+        self.ptree = ptree
+        self.sig = sig
+        self.order = order
+        self.freeze = freeze
+        self.timeout = timeout
+        self.interval = 0.1     # rescan interval
+        self.depth = {}         # depth of process in killed tree
+        self.pids = []          # processes top-down
+        self.add(list(reversed(ptree.selected_pids)), ptree.ps_info)
+        self.starts = process_starts(self.pids)
+
+    def add(self, pids, ps_info):
+        """add pids (parents first) to killed tree"""
+        for pid in pids:
+            if pid in self.depth:
+                continue
+            ppid = ps_info[pid]['ppid']
+            self.depth[pid] = self.depth.get(ppid, -1) + 1
+            self.pids.append(pid)
+
+    def batches(self, pids, order=None):
+        """pids grouped by depth in order"""
+        batches = {}
+        for pid in pids:
+            depth = self.depth[pid]
+            if depth not in batches:
+                batches[depth] = []
+            batches[depth].append(pid)
+        depths = sorted(batches)
+        if (order or self.order) == 'bottom-up':
+            depths.reverse()
+        return [batches[depth] for depth in depths]
+
+    def signal(self, pids, sig, order=None):
+        """send signal to processes still having recorded identity, returns pids signalled"""
+        import signal
+        sent = []
+        for batch in self.batches(pids, order):
+            pidfds = {}
+            if hasattr(os, 'pidfd_open'):  # pidfd refers to process even if pid reused
+                for pid in batch:
+                    try:
+                        pidfds[pid] = os.pidfd_open(int(pid))
+                    except OSError:
+                        continue
+            starts = process_starts(batch)
+            try:
+                for pid in batch:
+                    if pid not in starts or starts[pid] != self.starts.get(pid, starts[pid]):
+                        continue  # exited or pid reused
+                    try:
+                        if pid in pidfds:
+                            signal.pidfd_send_signal(pidfds[pid], sig)
+                        else:
+                            os.kill(int(pid), sig)
+                    except ProcessLookupError:
+                        continue
+                    except PermissionError:
+                        print('kill ' + pid + ': Permission error')
+                        continue
+                    sent.append(pid)
+            finally:
+                for pidfd in pidfds.values():
+                    os.close(pidfd)
+        return sent
+
+    def rescan(self):
+        """processes of tree still running with same identity and their new children"""
+        snapshot = Snapshot(self.ptree.ps_fields, self.ptree.source)
+        starts = process_starts([pid for pid in self.pids if pid in snapshot.ps_info])
+        alive = [pid for pid in self.pids if pid in starts and
+                 starts[pid] == self.starts.get(pid, starts[pid])]
+        new = [pid for pid in snapshot.descendants(alive) if pid not in self.depth]
+        self.add(new, snapshot.ps_info)
+        self.starts.update(process_starts(new))
+        return alive + [pid for pid in new if pid in self.starts]
+
+    def stop(self):
+        """freeze tree with SIGSTOP (top-down), until no new children; returns stopped pids"""
+        import signal
+        stopped = self.signal(self.pids, signal.SIGSTOP, 'top-down')
+        tried = set(self.pids)
+        while True:
+            new = [pid for pid in self.rescan() if pid not in tried]
+            if not new:
+                return stopped
+            tried.update(new)
+            stopped += self.signal(new, signal.SIGSTOP, 'top-down')
+
+    def kill(self):
+        """kill tree, rescan and escalate until empty if timeout, returns pids still running"""
+        import signal
+        stopped = []
+        if self.freeze:
+            stopped = self.stop()
+        sig = self.sig
+        signalled = set(self.signal(self.pids, sig))
+        if stopped and sig != signal.SIGKILL:
+            self.signal(stopped, signal.SIGCONT)
+        if not self.timeout:
+            return []
+        deadline = time.time() + self.timeout
+        while True:
+            time.sleep(self.interval)
+            pids = self.rescan()
+            if not pids:
+                return []
+            if time.time() > deadline:
+                if sig == signal.SIGKILL:
+                    print('still running: ' + ' '.join(pids))
+                    return pids
+                sig = signal.SIGKILL
+                signalled = set()
+                deadline = time.time() + self.timeout
+                print('kill -KILL ' + ' '.join(pids))
+            pids = [pid for pid in pids if pid not in signalled]
+            signalled.update(self.signal(pids, sig))
+
+
+class Proctree:
+    """
+    Manage process tree of pids
+    Proctree([ 'pid1', 'pid2' ])
+    """
+
+    # pylint: disable=R0913
+    def __init__(self, use_uid=False, use_ascii=False, use_color=False,
+                 pid_zero=True, opt_fields=None, threads=False, source=None,
+                 extra_fields=None, snapshot=None, sum_fields=None, collapse=None,
+                 sort=None, top=None, below=None, above=None, fold=False, groups=False,
+                 low_memory=False):
+        """constructor, processes read from source unless snapshot given
+           sum_fields: fields totals of subtrees displayed (procs: processes count)
+           collapse: (field, threshold) subtrees with field total below threshold folded
+           sort: children sorted by field (subtree total if in sum_fields), -field: descending
+           top: number of children displayed per process
+           below/above: levels of children/parents of selected processes displayed
+           fold: identical siblings without children displayed N*[comm]
+           groups: processes in other cgroup/pid namespace than parent labelled @cgroup
+           low_memory: only processes displayed loaded (skeleton of source read as a stream)"""
+        self.pids = []
+        self.selected_pids = []  # pids and their children
+        self.pids_tree = {}
+        self.top_parents = []
+        self.selected = set()    # set of self.pids
+        self.marks = None        # watch changes marks of pids
+        self.threads = threads   # display threads: 'expand' (or True) / 'fold'
+        self.sum_fields = list(sum_fields or [])
+        self.collapse = collapse
+        if collapse and collapse[0] not in self.sum_fields:
+            self.sum_fields.append(collapse[0])
+        self.sort = None         # (field, reverse)
+        if sort:
+            self.sort = (sort.lstrip('-'), sort.startswith('-'))
+            if self.sort[0] == 'procs' and 'procs' not in self.sum_fields:
+                self.sum_fields.append('procs')
+        self.top = top
+        self.below = below
+        self.above = above
+        self.fold = fold
+        self.groups = groups
+        self.memberships = {}    # (cgroup path, label, pidns) by pid
+        self.tags = {}           # matched pattern by pid (several pgrep patterns)
+        self.keep = set()        # matched pids and ancestors (never hidden by top)
+        self.totals = {}         # subtree totals of sum_fields (+ processes count) by pid
+        self.collapsed = set()   # pids with folded children
+        self.treedisp = Treedisplay(use_ascii, use_color)
+        self.ps_fields = self.get_fields(opt_fields, use_uid)
+        self.opt_fields = self.ps_fields[4:]  # displayed fields
+        extra_fields = list(extra_fields or []) + \
+            [field for field in self.sum_fields if field != 'procs']
+        if self.sort and self.sort[0] != 'procs':
+            extra_fields.append(self.sort[0])
+        if threads:
+            extra_fields.append('spid')
+        if groups and os.path.exists('/proc/self/cgroup'):  # else no labels
+            extra_fields += ['cgroup', 'pidns']
+        if os.environ.get('PGT_COMM'):
+            for field in extra_fields or []:
+                if field not in self.ps_fields and not (field == 'user' and use_uid):
+                    self.ps_fields.append(field)
+        self.skeleton = None     # low memory: snapshot loaded when pids selected
+        self.pid_zero = pid_zero
+        if snapshot is None and low_memory:
+            self.skeleton = Skeleton(self.ps_fields, source)
+            self.snapshot = None
+            self.source = self.skeleton.source
+            return
+        if snapshot is None:
+            snapshot = Snapshot(self.ps_fields, source, pid_zero)
+        self.use_snapshot(snapshot)
+
+    def use_snapshot(self, snapshot):
+        """processes of tree from snapshot"""
+        self.snapshot = snapshot
+        self.ps_info = snapshot.ps_info
+        self.children = snapshot.children
+        self.fields = snapshot.fields
+        self.source = snapshot.source
+
+    def get_fields(self, opt_fields=None, use_uid=False):
+        """ Get ps fields from OS / optionnal fields """
+        return get_fields(opt_fields, use_uid)
+
+    def index(self, field):
+        """pids by field value (built once per field)"""
+        return self.snapshot.index(field)
+
+    def pgrep(self, argv, external=False):
+        """select pids with built-in pgrep on loaded processes
+           or with pgrep command if external or options not supported by built-in
+           matched pattern of pids kept in tags (several patterns)"""
+        self.tags = {}
+        if self.snapshot is None:
+            return self.skeleton.pgrep(argv, external, self.tags)
+        return self.snapshot.pgrep(argv, external, self.tags)
 
     def build_tree(self):
         """build process tree"""
-        self.children2tree(self.pids)
-        self.get_parents()
+        (self.pids_tree, self.top_parents) = self.snapshot.subtree(self.pids, self.below,
+                                                                   self.above)
 
-    def print_proc(self, pid, pre, print_it, last):
-        """display process information with indent/tree/colors"""
+    def proc_line(self, pid, pre, print_it, last):
+        """process information with indent/tree/colors
+           returns (next_p, print_it, line), line None if not printed"""
         next_p = ''
         ppre = pre
-        if pid in self.pids:
+        if pid in self.selected:
             print_it = True
             ppre = self.treedisp.selected + pre[1:]
-        if print_it:
-            self.selected_pids.insert(0, pid)
-            if pre == ' ':  # head of hierarchy
-                curr_p = next_p = ' '
-            elif last:  # last child
-                curr_p = self.treedisp.lastchild
-                next_p = '  '
-            else:  # not last child
-                curr_p = self.treedisp.child
-                next_p = self.treedisp.notchild
-            ps_info = self.treedisp.colorize('pid', pid.ljust(5)) + \
-                      self.treedisp.colorize('user', ' (' + self.ps_info[pid]['user'] + ') ') + \
-                      self.treedisp.colorize('comm', '[' + self.ps_info[pid]['comm'] + '] ')
-            ps_info += ' '.join(
-                [self.treedisp.colorize(f, self.ps_info[pid][f]) for f in self.ps_fields[4:]]
-            )
-            ps_info += ' ' + self.ps_info[pid]['args']
-            output = ppre + curr_p + ps_info
-            print(output)
-        return (next_p, print_it)
-
-    # recursive
+        if not print_it:
+            return (next_p, print_it, None)
+        if pre == ' ':  # head of hierarchy
+            curr_p = next_p = ' '
+        elif last:  # last child
+            curr_p = self.treedisp.lastchild
+            next_p = '  '
+        else:  # not last child
+            curr_p = self.treedisp.child
+            next_p = self.treedisp.notchild
+        line = [ppre, curr_p] + self.info_line(pid, self.ps_info[pid], '[]')
+        if pid in self.totals:
+            line[-3:-3] = [' ', self.treedisp.prefix['total'], self.total_text(pid),
+                           self.treedisp.reset]
+        if pid in self.tags and pid in self.selected:
+            line[-3:-3] = [' ', self.treedisp.prefix['pattern'],
+                           self.treedisp.selected + self.tags[pid], self.treedisp.reset]
+        if self.groups and pid != '0':
+            text = self.group_text(pid)
+            if text:
+                line[-3:-3] = [' ', self.treedisp.prefix['group'], text, self.treedisp.reset]
+        if self.marks is not None:
+            line.insert(0, self.treedisp.mark(self.marks.get(pid, ' ')))
+        return (next_p, print_it, ''.join(line))
+
+    def info_line(self, ident, info, brackets):
+        """colored line items of process/thread info: ident (user) [comm] fields args"""
+        colors = self.treedisp.prefix
+        reset = self.treedisp.reset
+        line = [colors['pid'], ident.ljust(5), reset,
+                colors['user'], ' (', info['user'], ') ', reset,
+                colors['comm'], brackets[0], info['comm'], brackets[1] + ' ', reset]
+        sep = ''
+        for field, color in self.treedisp.field_colors(self.opt_fields):
+            line += [sep, color, info[field], reset]
+            sep = ' '
+        line += [' ', info['args'], '\n']
+        return line
+
+    def membership(self, pid):
+        """(cgroup path, label, pid namespace) of process, root cgroup if not available"""
+        if pid not in self.memberships:
+            info = self.ps_info.get(pid)
+            if pid == '0' or info is None or 'cgroup' not in self.fields:
+                self.memberships[pid] = ('/', '/', None)
+            else:
+                path = (cgroup_paths(info['cgroup']) + ['/'])[0]
+                pidns = info.get('pidns')
+                if pidns == '-':  # not readable
+                    pidns = None
+                self.memberships[pid] = (path, cgroup_label(path), pidns)
+        return self.memberships[pid]
+
+    def group_text(self, pid):
+        """@cgroup label / pidns:id of process in other cgroup / pid namespace than parent"""
+        _, label, pidns = self.membership(pid)
+        _, plabel, ppidns = self.membership(self.ps_info[pid]['ppid'])
+        text = ''
+        if label != plabel:
+            text = '@' + label
+        if None not in (pidns, ppidns) and pidns != ppidns:
+            text += ' pidns:' + pidns
+        return text.lstrip()
+
+    def total_text(self, pid):
+        """subtree totals of pid: <Σ field=total ... +N folded>"""
+        total = self.totals[pid]
+        text = '<' + self.treedisp.total
+        for i, field in enumerate(self.sum_fields):
+            text += ' ' + field + '=' + format_number(total[i])
+        if pid in self.collapsed:
+            text += ' +' + str(total[-1] - 1) + ' folded'
+        return text + '>'
+
+    def aggregate(self, pids):
+        """subtree totals of sum_fields (+ processes count) in one bottom-up pass of tree
+           for matched processes and descendants (subtrees fully in tree)
+           collapsed: subtrees with total below threshold without matched process below"""
+        totals = {}
+        collapsed = set()
+        above = set()  # pids having matched processes below
+        index = None
+        if self.collapse:
+            index = self.sum_fields.index(self.collapse[0])
+        stack = [(pid, False, pid in self.selected) for pid in pids]
+        while stack:
+            (pid, visited, full) = stack.pop()
+            children = self.pids_tree.get(pid, [])
+            if not visited:
+                stack.append((pid, True, full))
+                for child in children:
+                    stack.append((child, False, full or child in self.selected))
+                continue
+            if not full:
+                continue
+            info = self.ps_info[pid]
+            total = [1] * (len(self.sum_fields) + 1)
+            for i, field in enumerate(self.sum_fields):
+                if field != 'procs':
+                    total[i] = 0
+                    if field in self.fields:
+                        total[i] = field_number(info[field])
+            if pid == '0':  # ps header
+                total = [0] * len(total)
+            for child in children:
+                child_total = totals[child]
+                for i in range(len(total)):
+                    total[i] += child_total[i]
+                if child in self.selected or child in above:
+                    above.add(pid)
+            totals[pid] = total
+            if index is not None and children and pid not in above and \
+               total[index] < self.collapse[1]:
+                collapsed.add(pid)
+        self.totals = totals
+        self.collapsed = collapsed
+
+    def sort_key(self):
+        """key function of sort field: subtree total, number or string"""
+        field = self.sort[0]
+        if field in self.sum_fields:
+            index = self.sum_fields.index(field)
+            return lambda pid: self.totals.get(pid, [0] * (index + 1))[index]
+        if field not in self.fields:
+            return lambda pid: 0
+        if field in NUMERIC_FIELDS:
+            return lambda pid: field_number(self.ps_info[pid][field])
+        return lambda pid: self.ps_info[pid][field]
+
+    def order(self, children):
+        """children sorted, only top first kept (partial selection) with matched paths
+           returns (children, number of hidden children)"""
+        import heapq
+        if self.top and self.top < len(children):
+            if not self.sort:
+                shown = children[:self.top]
+            elif self.sort[1]:
+                shown = heapq.nlargest(self.top, children, self.sort_key())
+            else:
+                shown = heapq.nsmallest(self.top, children, self.sort_key())
+            kept = set(shown)
+            kept_paths = [pid for pid in children if pid in self.keep and pid not in kept]
+            if kept_paths:
+                shown += kept_paths
+                if self.sort:
+                    shown.sort(key=self.sort_key(), reverse=self.sort[1])
+            return (shown, len(children) - len(shown))
+        if self.sort:
+            return (sorted(children, key=self.sort_key(), reverse=self.sort[1]), 0)
+        return (children, 0)
+
+    def more_line(self, hidden, pre):
+        """line of number of children hidden by top"""
+        line = pre + self.treedisp.lastchild + self.treedisp.prefix['total'] + \
+            '... +' + str(hidden) + self.treedisp.reset + '\n'
+        if self.marks is not None:
+            line = ' ' + line
+        return line
+
+    def thread_items(self, pid):
+        """threads of pid to display: thread infos (expand)
+           or (count, comm) by thread name (fold)"""
+        threads = self.snapshot.threads.get(pid)
+        if not threads:
+            return []
+        if self.threads != 'fold':
+            return threads
+        counts = {}
+        names = []
+        for thread in threads:
+            comm = thread['comm']
+            if comm not in counts:
+                counts[comm] = 0
+                names.append(comm)
+            counts[comm] += 1
+        return [(counts[comm], comm, '{}') for comm in names]
+
+    def thread_line(self, pid, thread, pre, last):
+        """thread line under its process pid {comm}, folded threads: N*{comm}
+           (or folded processes N*[comm])"""
+        if last:
+            line = [pre, self.treedisp.lastchild]
+        else:
+            line = [pre, self.treedisp.child]
+        if isinstance(thread, tuple):
+            (count, comm, brackets) = thread
+            comm = brackets[0] + comm + brackets[1]
+            if count > 1:
+                comm = str(count) + '*' + comm
+            line += [self.treedisp.prefix['comm'], comm, self.treedisp.reset, '\n']
+        else:
+            line += self.info_line(thread['spid'], thread, '{}')
+        if self.marks is not None:
+            line.insert(0, self.treedisp.mark(' '))
+        return ''.join(line)
+
+    def walk_init(self, pids):
+        """subtrees totals and matched paths needed by walk of tree from pids"""
+        if self.sum_fields:
+            self.aggregate(pids)
+        if self.top:
+            self.keep = set(self.snapshot.ancestors(self.pids)) | self.selected
+
+    def walk_children(self, pid, fold=False):
+        """children of pid walked: (children, number of hidden children)
+           fold: identical children (N, comm, '[]') instead of pids"""
+        children = self.pids_tree.get(pid, [])
+        if pid in self.collapsed:
+            return ([], 0)
+        hidden = 0
+        if len(children) > 1 and (self.sort or self.top):
+            (children, hidden) = self.order(children)
+        if fold and len(children) > 1:
+            children = self.fold_children(children)
+        return (children, hidden)
+
+    def fold_children(self, children):
+        """children without children and same comm grouped in (count, comm, '[]')
+           at first one position (not matched processes)"""
+        groups = {}
+        items = []
+        for pid in children:
+            if pid in self.selected or self.pids_tree.get(pid) and pid not in self.collapsed or \
+               self.threads and pid in self.snapshot.threads:
+                items.append(pid)
+                continue
+            comm = self.ps_info[pid]['comm']
+            if comm not in groups:
+                groups[comm] = [pid]
+                items.append(groups[comm])
+            else:
+                groups[comm].append(pid)
+        folded = []
+        for item in items:
+            if isinstance(item, list) and len(item) > 1:
+                folded.append((len(item), self.ps_info[item[0]]['comm'], '[]'))
+            elif isinstance(item, list):
+                folded.append(item[0])
+            else:
+                folded.append(item)
+        return folded
+
+    def tree_lines(self, pids, print_it=True, pre=' '):
+        """generate wonderful process tree lines
+           tree walked with explicit stack, processes fields parsed when displayed"""
+        self.selected = set(self.pids)
+        self.walk_init(pids)
+        selected_pids = []
+        stack = []
+        for idx in range(len(pids)-1, -1, -1):
+            stack.append((pids[idx], pre, print_it, idx == len(pids)-1, None))
+        while stack:
+            (pid, pre, print_it, last, thread) = stack.pop()
+            if isinstance(thread, int):
+                yield self.more_line(thread, pre)
+                continue
+            if thread is not None:
+                yield self.thread_line(pid, thread, pre, last)
+                continue
+            (next_p, print_children, line) = self.proc_line(pid, pre, print_it, last)
+            if line is not None:
+                selected_pids.append(pid)
+                yield line
+            (children, hidden) = self.walk_children(pid, self.fold and print_children)
+            if hidden and print_children:
+                stack.append((pid, pre+next_p, print_children, True, hidden))
+            for idx in range(len(children)-1, -1, -1):
+                last = idx == len(children)-1 and not hidden
+                if isinstance(children[idx], tuple):  # folded processes
+                    stack.append((pid, pre+next_p, print_children, last, children[idx]))
+                else:
+                    stack.append((children[idx], pre+next_p, print_children, last, None))
+            if line is not None and self.threads:  # threads first under their process
+                threads = self.thread_items(pid)
+                for idx in range(len(threads)-1, -1, -1):
+                    stack.append((pid, pre+next_p, print_children,
+                                  idx == len(threads)-1 and not children and not hidden,
+                                  threads[idx]))
+        selected_pids.reverse()
+        self.selected_pids[0:0] = selected_pids
+
+    @profiled('render', int)
     def _print_tree(self, pids, print_it=True, pre=' '):
-        """display wonderful process tree"""
-        for idx, pid in enumerate(pids):
-            (next_p, print_children) = self.print_proc(pid, pre, print_it, idx == len(pids)-1)
-            if pid in self.pids_tree:
-                self._print_tree(self.pids_tree[pid], print_children, pre+next_p)
-
-    def print_tree(self, pids=None, child_only=False, sig=0, confirmed=False):
-        """display full or children only process tree"""
-        if pids == []:
-            return
+        """display wonderful process tree, returns number of lines"""
+        return write_lines(self.tree_lines(pids, print_it, pre))
+
+    def record_fields(self):
+        """fields of process records (sum_<field>: subtree totals)"""
+        fields = ['pid', 'ppid', 'user', 'comm'] + self.opt_fields + ['args'] + \
+                 ['depth', 'parent', 'matched', 'path'] + \
+                 ['sum_' + field for field in self.sum_fields]
+        if self.groups:
+            fields += ['cgroup', 'pidns']
+        if self.tags:
+            fields.append('pattern')
+        if self.marks is not None:
+            fields.append('change')
+        return fields
+
+    def tree_records(self, pids, print_it=True):
+        """generate process records of tree (same walk as tree_lines)
+           with depth, parent, matched flag and path from root (list of pids)
+           pid 0 (ps header) is not a process record"""
+        self.selected = set(self.pids)
+        self.walk_init(pids)
+        fields = ['pid', 'ppid', 'user', 'comm'] + self.opt_fields + ['args']
+        selected_pids = []
+        stack = []
+        for idx in range(len(pids)-1, -1, -1):
+            stack.append((pids[idx], print_it, []))
+        while stack:
+            (pid, print_it, path) = stack.pop()
+            matched = pid in self.selected
+            print_it = print_it or matched
+            if print_it:
+                selected_pids.append(pid)
+            if print_it and pid != '0':
+                info = self.ps_info[pid]
+                record = {}
+                for field in fields:
+                    record[field] = info[field]
+                record['depth'] = len(path)
+                record['parent'] = None
+                if path:
+                    record['parent'] = path[-1]
+                record['matched'] = matched
+                record['path'] = path + [pid]
+                total = self.totals.get(pid)
+                for i, field in enumerate(self.sum_fields):
+                    record['sum_' + field] = None
+                    if total:
+                        record['sum_' + field] = format_number(total[i])
+                if self.groups:
+                    record['cgroup'], _, record['pidns'] = self.membership(pid)
+                if self.tags:
+                    record['pattern'] = self.tags.get(pid)
+                if self.marks is not None:
+                    record['change'] = self.marks.get(pid)
+                yield record
+            (children, _) = self.walk_children(pid)
+            if children:
+                if pid != '0':
+                    path = path + [pid]
+                for idx in range(len(children)-1, -1, -1):
+                    stack.append((children[idx], print_it, path))
+        selected_pids.reverse()
+        self.selected_pids[0:0] = selected_pids
+
+    @profiled('render', int)
+    def _print_records(self, pids, print_it=True, output='json'):
+        """display process records as json (array), ndjson (1 record per line) or csv
+           returns number of records"""
+        import json
+        records = self.tree_records(pids, print_it)
+        count = 0
+        if output == 'csv':
+            import csv
+            fields = self.record_fields()
+            writer = csv.writer(sys.stdout, lineterminator='\n')
+            writer.writerow(fields)
+            for record in records:
+                record['matched'] = str(record['matched']).lower()
+                record['path'] = '/'.join(record['path'])
+                writer.writerow([record[field] for field in fields])
+                count += 1
+        elif output == 'ndjson':
+            count = write_lines(json.dumps(record) + '\n' for record in records)
+        else:
+            sys.stdout.write('[')
+            count = write_lines(json_items(records))
+            sys.stdout.write('\n]\n')
+        return count
+
+    def select(self, pids=None):
+        """select pids (default whole tree) and build tree"""
         if pids:
             self.pids = pids
         else:
@@ -368,29 +2955,88 @@ class Proctree:
             else:
                 self.pids = ['1']
         self.build_tree()
+
+    def tree(self, pids=None, child_only=False):
+        """generate full or children only process tree lines"""
+        if pids == []:
+            return iter([])
+        self.select(pids)
+        return self.tree_lines(self.top_parents, not child_only)
+
+    def print_tree(self, pids=None, child_only=False, sig=0, confirmed=False, output='text',
+                   **kill_options):
+        """display full or children only process tree
+           output: text tree or json/ndjson/csv records
+           kill_options: order, freeze, timeout of kill (see Killer)"""
+        if pids == [] and output == 'text':
+            return
+        if self.snapshot is None:  # low memory: processes displayed loaded
+            self.use_snapshot(self.skeleton.snapshot(pids, self.pid_zero))
+        if sig:  # whole subtrees killed
+            self.below = None
+            self.above = None
+        if pids == []:
+            self.pids = []
+        else:
+            self.select(pids)
         if sig:
-            self.kill_with_children(sig=sig, confirmed=confirmed)
+            self.kill_with_children(sig=sig, confirmed=confirmed, **kill_options)
+        elif output != 'text':
+            self._print_records(self.top_parents, not child_only, output)
         else:
             self._print_tree(self.top_parents, not child_only)
 
-    def kill_with_children(self, sig=15, confirmed=False):
-        """kill processes and children with signal"""
+    @profiled('kill')
+    def kill_with_children(self, sig=15, confirmed=False, order='bottom-up', freeze=False,
+                           timeout=0):
+        """kill processes and children with signal
+           processes identity recorded before confirmation, not signalled if pid reused
+           whole subtrees killed (not folded or limited to top children)"""
+        self.collapse = None
+        self.top = None
+        self.fold = False
         self._print_tree(self.top_parents, False)
         if not self.selected_pids:
             return
         print("kill "+" ".join(self.selected_pids))
+        if not getattr(self.source, 'live', True):  # saved snapshot: preview only
+            print('processes of ' + self.source.name + ' not killed')
+            return
+        killer = Killer(self, sig, order, freeze, timeout)
         if not confirmed:
             answer = ask('Confirm (y/[n]) ? ')
             if answer != 'y':
                 return
-        for pid in self.selected_pids:
-            try:
-                os.kill(int(pid), sig)
-            except ProcessLookupError:
-                continue
-            except PermissionError:
-                print('kill ' + pid + ': Permission error')
-                continue
+        killer.kill()
+
+def write_lines(lines):
+    """write lines to stdout by chunks, returns number of lines"""
+    out = []
+    size = 0
+    count = 0
+    for line in lines:
+        out.append(line)
+        size += len(line)
+        if size > OUTPUT_CHUNK:
+            sys.stdout.write(''.join(out))
+            count += len(out)
+            out = []
+            size = 0
+    sys.stdout.write(''.join(out))
+    return count + len(out)
+
+def json_items(records):
+    """json array items of records"""
+    import json
+    sep = '\n'
+    for record in records:
+        yield sep + json.dumps(record)
+        sep = ',\n'
+
+def stdout_closed():
+    """stdout reader exited (pgtree | head): discard remaining output"""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
 
 def colored(opt):
     """colored output or not"""
@@ -416,48 +3062,518 @@ def wrap_text(opt):
         after = ''
     return after
 
+def depth_option(options, option):
+    """levels number option, None if not set"""
+    if option in options:
+        return int(options[option])
+    return None
+
+def host_list(hosts):
+    """hosts of comma separated list or @file (one host per line)"""
+    if hosts.startswith('@'):
+        return [host for host in readfile(hosts[1:]).split() if not host.startswith('#')]
+    return hosts.split(',')
+
 def pgtree(options, psfields, pgrep_args):
     """ Display process tree from options """
+    extra_fields = []
+    if '-p' not in options and pgrep_args:
+        extra_fields = Pgrep(pgrep_args).fields
+    if '--delta' in options:  # process identity: pid and start time
+        extra_fields = extra_fields + ['lstart']
+    source = options.get('--source')
+    if '--hosts' in options:
+        source = HostsSource(host_list(options['--hosts']), options.get('--transport'),
+                             float(options.get('--host-timeout') or 10))
+    ttl = float(options.get('--cache') or os.environ.get('PGT_CACHE_TTL') or 0)
+    if ttl > 0 and not [opt for opt in ('-W', '-k', '-K', '--low-memory') if opt in options]:
+        source = CachedSource(source, ttl)
+    sum_fields = None
+    if '--sum' in options:
+        sum_fields = options['--sum'].split(',')
+    collapse = None
+    if '--collapse' in options:
+        field, threshold = options['--collapse'].rsplit(':', 1)
+        collapse = (field, float(threshold))
     ptree = Proctree(use_uid='-I' in options,
                      use_ascii='-a' in options,
                      use_color=colored(options['-C']),
                      pid_zero='-1' not in options,
                      opt_fields=psfields,
-                     threads='-T' in options)
+                     threads=options.get('--threads', '-T' in options),
+                     source=source,
+                     extra_fields=extra_fields,
+                     sum_fields=sum_fields,
+                     collapse=collapse,
+                     sort=options.get('--sort'),
+                     top=int(options.get('--top', 0)),
+                     below=depth_option(options, '--below'),
+                     above=depth_option(options, '--above'),
+                     fold='--fold' in options,
+                     groups='--cgroups' in options or '--cgroup' in options,
+                     low_memory='--low-memory' in options)
+    if '--record' in options:
+        ptree.snapshot.save(options['--record'])
 
     found = None
     if '-p' in options:
-        if "-w" in pgrep_args:
-            err, out = runcmd("ps -T -o spid= -p "+options['-p'])
-            found = out.replace(' ','').splitlines()
-        else:
-            found = options['-p'].split(',')
-    elif pgrep_args and pgrep_args!=["-w"]:
-        found = ptree.pgrep(pgrep_args)
+        found = options['-p'].split(',')
+    elif pgrep_args:
+        found = ptree.pgrep(pgrep_args, external='-E' in options)
+    if '--delta' in options:
+        found = delta_pids(ptree, found, options['--delta']) or []
     return (ptree, found)
 
+def tree_changes(old, new):
+    """
+    mark added (+) and reparented (~) pids of new snapshot,
+    exited (-) processes displayed in old snapshot are kept in new tree
+    """
+    marks = {}
+    for pid,info in new.ps_info.items():
+        if pid not in old.ps_info:
+            marks[pid] = '+'
+        elif old.ps_info[pid]['ppid'] != info['ppid']:
+            marks[pid] = '~'
+    exited = {}
+    for pid in old.selected_pids:
+        if pid in new.ps_info:
+            continue
+        marks[pid] = '-'
+        exited[pid] = old.ps_info[pid]
+    if exited:
+        new.use_snapshot(new.snapshot.added(exited))
+    return marks
+
+def delta_changes(previous, new):
+    """
+    mark added (+), reparented (~) and exited (-) processes since previous snapshot,
+    processes identified by pid and start time (reused pid: added), exited processes
+    kept in new tree, pids compared as sets: walk/display proportional to changes
+    """
+    old_info = previous.ps_info
+    new_info = new.ps_info
+    marks = {}
+    for pid in set(new_info) - set(old_info):
+        marks[pid] = '+'
+    exited = {}
+    for pid in set(old_info) - set(new_info):
+        if old_info[pid]['pid'] == pid:  # not ps header
+            marks[pid] = '-'
+            exited[pid] = old_info[pid]
+    check_start = 'lstart' in previous.fields and 'lstart' in new.fields
+    for pid in set(new_info) & set(old_info):
+        old = old_info[pid]
+        info = new_info[pid]
+        if old['pid'] != pid or info['pid'] != pid:
+            continue
+        if check_start and '?' not in (old['lstart'], info['lstart']) and \
+           old['lstart'] != info['lstart']:
+            marks[pid] = '+'
+        elif old['ppid'] != info['ppid']:
+            marks[pid] = '~'
+    if exited:
+        new.use_snapshot(new.snapshot.added(exited))
+    return marks
+
+def delta_pids(ptree, found, path):
+    """
+    roots of subtrees changed since last snapshot of file path (under found pids if not None)
+    path replaced by current snapshot (single snapshot kept), None if no previous snapshot
+    """
+    previous = None
+    if os.path.isfile(path):
+        previous = Snapshot(ptree.ps_fields, FileSource(path))
+    saved = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.' +
+                         str(os.getpid()))
+    if path.endswith('.gz'):
+        saved += '.gz'
+    ptree.snapshot.save(saved)
+    os.rename(saved, path)
+    if previous is None:
+        sys.stderr.write('pgtree: snapshot saved to ' + path + ', changes shown next run\n')
+        return None
+    ptree.marks = delta_changes(previous, ptree)
+    roots = []
+    for pid, mark in ptree.marks.items():
+        if mark == '~' or ptree.marks.get(ptree.ps_info[pid]['ppid']) != mark:
+            roots.append(pid)
+    if found is not None:
+        scope = set(found) | set(ptree.snapshot.descendants(found))
+        roots = [pid for pid in roots if pid in scope]
+    return sorted(roots, key=pid_key)
+
+def paint(lines, previous):
+    """
+    write screen lines (no wrap), only lines changed since previous screen
+    """
+    out = []
+    for row, line in enumerate(lines):
+        if row < len(previous) and previous[row] == line:
+            continue
+        out.append('\033[%d;1H%s\033[K' % (row+1, line))
+    if len(lines) < len(previous):
+        out.append('\033[%d;1H\033[J' % (len(lines)+1))
+    sys.stdout.write(''.join(out))
+    sys.stdout.flush()
+
+def proc_event(what, ids):
+    """(event, pid, ppid) of netlink proc connector event, threads events ignored"""
+    if what == 0x1 and ids[2] == ids[3]:           # PROC_EVENT_FORK: parent pid/tgid, child
+        return [('fork', str(ids[3]), str(ids[1]))]
+    if what in (0x2, 0x200):                       # PROC_EVENT_EXEC, PROC_EVENT_COMM
+        return [('exec', str(ids[1]), None)]
+    if what == 0x80000000 and ids[0] == ids[1]:   # PROC_EVENT_EXIT
+        return [('exit', str(ids[1]), None)]
+    return []
+
+class ProcEvents(object):
+    """
+    process fork/exec/exit events from Linux netlink proc connector
+    needs root or CAP_NET_ADMIN, read() returns [('resync', None, None)] if events lost
+    """
+    name = 'netlink'
+
+    def __init__(self):
+        """subscribe to proc connector multicast group"""
+        import socket
+        import struct
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, 11)  # CONNECTOR
+        self.socket.bind((0, 1))  # CN_IDX_PROC group
+        listen = struct.pack('=IIIIHHI', 1, 1, 0, 0, 4, 0, 1)  # cn_msg PROC_CN_MCAST_LISTEN
+        self.socket.send(struct.pack('=IHHII', 16 + len(listen), 3, 0, 0, 0) + listen)
+
+    def read(self, timeout=None):
+        """pending events, wait up to timeout (None: until events)"""
+        import select
+        import socket
+        import struct
+        events = []
+        while not events:
+            if not select.select([self.socket], [], [], timeout)[0]:
+                return events
+            while True:
+                try:
+                    data = self.socket.recv(65536, socket.MSG_DONTWAIT)
+                except socket.error:
+                    if sys.exc_info()[1].errno == errno.ENOBUFS:
+                        return [('resync', None, None)]
+                    break
+                offset = 0
+                # nlmsghdr (16) + cn_msg (20) + proc_event what/cpu/timestamp (16) + ids
+                while offset + 68 <= len(data):
+                    length = struct.unpack_from('=I', data, offset)[0]
+                    what = struct.unpack_from('=I', data, offset + 36)[0]
+                    events += proc_event(what, struct.unpack_from('=IIII', data, offset + 52))
+                    offset += max(length, 68)
+            if timeout is not None:
+                break
+        return events
+
+
+class ProcPoller(object):
+    """process fork/exit events from /proc pids diff every interval (netlink fallback)"""
+    name = 'poll'
+
+    def __init__(self, root='/proc', interval=0.1):
+        """constructor, root: proc filesystem directory"""
+        self.root = root
+        self.interval = interval
+        self.pids = self.list_pids()
+
+    def list_pids(self):
+        """current pids"""
+        return set([pid for pid in os.listdir(self.root) if pid.isdigit()])
+
+    def read(self, timeout=None):
+        """events since last read, wait up to timeout (None: until events)"""
+        start = time.time()
+        while True:
+            pids = self.list_pids()
+            events = [('exit', pid, None) for pid in self.pids - pids] + \
+                     [('fork', pid, None) for pid in sorted(pids - self.pids, key=int)]
+            self.pids = pids
+            if events or (timeout is not None and time.time() - start >= timeout):
+                return events
+            time.sleep(self.interval)
+
+def process_events(backend='auto', interval=0.1):
+    """events from netlink proc connector if permitted (auto/netlink), else /proc diff (poll)"""
+    if backend != 'poll':
+        try:
+            return ProcEvents()
+        except (AttributeError, IOError, OSError):
+            if backend == 'netlink':
+                print('Error: netlink proc connector not available (root needed)')
+                sys.exit(1)
+    return ProcPoller(interval=interval)
+
+
+class EventWatch(object):
+    """
+    process tree following process events applied to the loaded snapshot
+    processes marked +/-/~ until next repaint, repaint only if displayed tree changed
+    """
+
+    def __init__(self, ptree, found, events, pgrep_args=None, child_only=False, log=None):
+        """found: selected pids, selected again with pgrep_args on fork/exec events
+           log: file where events of displayed processes are written with timestamps"""
+        self.ptree = ptree
+        self.found = found
+        self.events = events
+        self.pgrep_args = pgrep_args
+        self.child_only = child_only
+        self.log = log
+        self.logged = []      # (pid, log line) of events since last display
+        self.exited = []      # exited pids displayed once marked -
+        self.orphans = set()  # exited pids with children not yet reparented
+        self.displayed = set()
+        ptree.marks = {}
+
+    def lines(self):
+        """tree lines, events of displayed processes logged,
+           exited processes removed from snapshot once displayed"""
+        self.ptree.selected_pids = []
+        lines = [line.rstrip('\n') for line in self.ptree.tree(self.found, self.child_only)]
+        displayed = set(self.ptree.selected_pids)
+        for pid, line in self.logged:
+            if pid in displayed or pid in self.displayed:
+                self.log.write(line)
+        if self.logged:
+            self.log.flush()
+        self.logged = []
+        self.displayed = displayed
+        for pid in self.exited:
+            self.ptree.snapshot.remove(pid)
+        if self.found and self.exited:
+            self.found = [pid for pid in self.found if pid in self.ptree.ps_info]
+        self.exited = []
+        self.ptree.marks = {}
+        return lines
+
+    def log_line(self, event, pid, info):
+        """timestamped event line"""
+        now = time.time()
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)) + \
+            '.%03d %s %s ppid=%s (%s) [%s] %s\n' % (int(now % 1 * 1000), event, pid,
+                                                  info['ppid'], info['user'], info['comm'],
+                                                  info['args'])
+
+    def forked(self, pid, ppid):
+        """info of new process, copy of parent if already exited"""
+        snapshot = self.ptree.snapshot
+        info = snapshot.read_pid(pid)
+        if info is None and ppid in snapshot.ps_info:
+            parent = snapshot.ps_info[ppid]
+            if parent.raw is not None:
+                parent.load()
+            values = list(parent.values)
+            values[0:2] = [pid, ppid]
+            info = Psinfo(values, snapshot.fields)
+        return info
+
+    def reparent(self, pid):
+        """children of exited pid moved under their new parent, True if any moved"""
+        snapshot = self.ptree.snapshot
+        moved = False
+        for child in list(snapshot.children.get(pid, [])):
+            orphan = snapshot.read_pid(child)
+            if orphan is None:  # exit event follows
+                continue
+            if orphan['ppid'] == pid:  # exit event sent before reparent
+                self.orphans.add(pid)
+                continue
+            snapshot.insert(child, orphan)
+            self.ptree.marks[child] = '~'
+            moved = True
+        return moved
+
+    def apply(self, events):
+        """apply events to snapshot, True if snapshot or selection changed"""
+        snapshot = self.ptree.snapshot
+        marks = self.ptree.marks
+        if hasattr(snapshot.source, 'get_clock'):
+            snapshot.source.get_clock()
+        changed = False
+        for pid in list(self.orphans):
+            self.orphans.discard(pid)
+            changed = self.reparent(pid) or changed
+        select = False
+        for event, pid, ppid in events:
+            if event == 'resync':  # events lost: new snapshot
+                self.ptree.use_snapshot(Snapshot(self.ptree.ps_fields, snapshot.source))
+                self.ptree.marks = {}
+                self.exited = []
+                return True
+            info = snapshot.ps_info.get(pid)
+            if event == 'exit':
+                if info is None or marks.get(pid) == '-':
+                    continue
+                self.reparent(pid)
+                if pid in self.displayed or marks.get(pid) == '+':
+                    marks[pid] = '-'
+                    self.exited.append(pid)
+                else:
+                    snapshot.remove(pid)
+            else:
+                if event == 'fork':
+                    info = self.forked(pid, ppid)
+                elif info is not None:
+                    info = snapshot.read_pid(pid)
+                if info is None:
+                    continue
+                snapshot.insert(pid, info)
+                if event == 'fork':
+                    marks[pid] = '+'
+                select = self.pgrep_args is not None
+            if self.log:
+                self.logged.append((pid, self.log_line(event, pid, info)))
+            changed = True
+        if select:
+            found = self.ptree.pgrep(self.pgrep_args)
+            found += [pid for pid in self.found if marks.get(pid) == '-']
+            if found != self.found:
+                self.found = found
+        return changed
+
+    def run(self, header, interval=0.1):
+        """repaint tree when displayed processes changed, at most every interval"""
+        screen = []
+        sys.stdout.write("\033[H\033[2J")
+        changed = True
+        while True:
+            if changed:
+                lines = self.lines()
+                if lines != screen[2:] or not screen:
+                    lines = [header(), ''] + lines
+                    paint(lines, screen)
+                    screen = lines
+            changed = self.apply(self.events.read())
+            if changed and interval:  # events gathered until next repaint
+                time.sleep(interval)
+                self.apply(self.events.read(0))
+
+def event_watch(options, psfields, pgrep_args):
+    """follow process hierarchy from process events applied to first /proc snapshot"""
+    options['--source'] = ProcSource()
+    (ptree, found) = pgtree(options, psfields, pgrep_args)
+    if '-p' in options or '-E' in options or not pgrep_args:
+        pgrep_args = None  # selection not updated
+    interval = float(options.get('--interval') or 0.1)
+    events = process_events(options['--events'], interval)
+    log = None
+    if options.get('--event-log') == '-':
+        log = sys.stderr
+    elif options.get('--event-log'):
+        log = open(options['--event-log'], 'a')
+    watcher = EventWatch(ptree, found, events, pgrep_args, '-c' in options, log)
+    def header():
+        """watch header with last change time"""
+        return "Events (%s): " % events.name + ' '.join(sys.argv) + "    " + \
+               time.strftime("%c", time.localtime())
+    wrap_text(options['-w'])
+    try:
+        watcher.run(header, interval)
+    except KeyboardInterrupt:
+        pass
+
 def watch_pgtree(options, psfields, pgrep_args, sig):
-    """ follow process hierarchy """
+    """ follow process hierarchy
+        incremental: /proc source keeps processes infos, only changed lines repainted """
+    interval = float(options.get('--interval') or 2)
+    previous = None   # previous snapshot
+    screen = []       # previous screen lines
     while True:
         try:
             (ptree, found) = pgtree(options, psfields, pgrep_args)
+            options['--source'] = ptree.source
+            ptree.source.keep = True
             cur_time = time.strftime("%c", time.localtime())
-            sys.stdout.write("\033c")
-            wrap_text(options['-w'])
-            sys.stdout.write("Every 2.0s: " + ' '.join(sys.argv) + "    " + cur_time + "\n\n")
-            ptree.print_tree(pids=found, child_only='-c' in options, sig=sig,
-                     confirmed='-y' in options)
-            if time.sleep(2):
+            header = "Every %ss: " % interval + ' '.join(sys.argv) + "    " + cur_time
+            if sig or options['-w'] in ('n', 'no'):  # full repaint
+                sys.stdout.write("\033c")
+                wrap_text(options['-w'])
+                sys.stdout.write(header + "\n\n")
+                ptree.print_tree(pids=found, child_only='-c' in options, sig=sig,
+                                 confirmed='-y' in options, **kill_options(options))
+            else:
+                if not screen:
+                    sys.stdout.write("\033[H\033[2J")
+                    wrap_text(options['-w'])
+                ptree.marks = {}
+                if previous:
+                    ptree.marks = tree_changes(previous, ptree)
+                    if found:  # keep exited selected processes
+                        found = found + [p for p in previous.pids if ptree.marks.get(p) == '-']
+                lines = [header, '']
+                for line in ptree.tree(pids=found, child_only='-c' in options):
+                    lines.append(line.rstrip('\n'))
+                paint(lines, screen)
+                screen = lines
+                previous = ptree
+            if time.sleep(interval):
                 break
         except KeyboardInterrupt:
             break
 
 
+def kill_options(options):
+    """Killer options from command line options"""
+    return {'order': options.get('--kill-order', 'bottom-up'),
+            'freeze': '--kill-freeze' in options,
+            'timeout': float(options.get('--kill-timeout') or 0)}
+
+def run_pgtree(options, psfields, pgrep_args, sig, output):
+    """display, watch or kill process tree from options"""
+    if '--hosts' in options and sig:
+        print('Error: kill not supported with --hosts')
+        sys.exit(1)
+    if '--events' in options and not sig and '--hosts' not in options and \
+       ProcSource().available():
+        event_watch(options, psfields, pgrep_args)
+    elif '-W' in options:
+        watch_pgtree(options, psfields, pgrep_args, sig)
+    else:
+        (ptree, found) = pgtree(options, psfields, pgrep_args)
+        ptree.print_tree(pids=found, child_only='-c' in options, sig=sig,
+                         confirmed='-y' in options, output=output, **kill_options(options))
+
+def profile_run(profile, func, *args):
+    """
+    run func with stages timings summary on stderr
+    profile: text|json[,cprofile[:<file>]] cProfile functions stats on stderr or dumped to file
+    """
+    global PROFILER
+    PROFILER = Profiler()
+    output = 'text'
+    cprofile = None
+    for item in profile.split(','):
+        if item == 'json':
+            output = 'json'
+        elif item.startswith('cprofile'):
+            cprofile = item
+    prof = None
+    try:
+        if cprofile:
+            import cProfile
+            prof = cProfile.Profile()
+            prof.runcall(PROFILER.run, 'total', None, func, *args)
+        else:
+            PROFILER.run('total', None, func, *args)
+        PROFILER.run('flush', None, sys.stdout.flush)
+    finally:
+        PROFILER.report(output)
+        PROFILER = None
+        if prof and ':' in cprofile:
+            prof.dump_stats(cprofile.split(':', 1)[1])
+        elif prof:
+            import pstats
+            pstats.Stats(prof, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
+
 def main(argv):
     """pgtree command line"""
-    global PS_OPTION
     usage = """
-    usage: pgtree.py [-W] [-RIya] [-C <when>] [-O <psfield>] [-c|-k|-K] [-1|-p <pid1>,...|<pgrep args>]
+    usage: pgtree.py [-W] [-REIya] [-C <when>] [-O <psfield>] [-c|-k|-K] [-1|-p <pid1>,...|<pgrep args>]
 
     -I : use -o uid instead of -o user for ps command
          (if uid/user mapping is broken ps command can be stuck)
@@ -465,33 +3581,80 @@ def main(argv):
     -k : kill -TERM processes and children
     -K : kill -KILL processes and children
     -y : do not ask for confirmation to kill
-    -R : force use of internal pgrep
+    --kill-order=<order> : kill by depth bottom-up (default) or top-down
+    --kill-freeze : stop (SIGSTOP) processes before kill to catch new children
+    --kill-timeout=<seconds> : kill until no process left, -TERM escalated to -KILL after timeout
+    -R : force use of built-in pgrep (default), never fallback to pgrep command
+    -E : use external pgrep command instead of built-in pgrep
     -C : color preference : y/yes/always or n/no/never (default auto)
     -w : tty wrap text : y/yes or n/no (default y)
-    -W : watch and follow process tree every 2s
+    -W : watch and follow process tree every 2s (new/exited/reparented processes marked +/-/~)
+    --interval=<seconds> : watch interval (default 2, with --events minimum delay between repaints 0.1)
+    --events=<backend> : watch from process fork/exec/exit events instead of polling (implies -W)
+                   auto (default): netlink proc connector if permitted (root), else poll /proc pids
+    --event-log=<file> : log timestamped events of displayed processes in <file> (-: stderr)
     -a : use ascii characters
-    -T : display threads (ps -T)
+    -T : display threads under their process
+    --threads=<mode> : display threads expand (default with -T) or fold (N*{thread name})
     -O <psfield>[,psfield,...] : display multiple <psfield> instead of 'stime' in output
                    <psfield> must be valid with ps -o <psfield> command
+    --source=<source> : process source auto/proc/ps/file:<file>[@<n>] (default auto or PGT_SOURCE env)
+                   auto uses /proc on Linux if <psfield> available, else ps command
+                   file: snapshot <n> (0: first, -1: last) saved in <file> with --record (kill preview only)
+    --record=<file> : append processes snapshot to <file> (gzip if <file> ends with .gz, each refresh with -W)
+    --delta=<file> : display only subtrees changed since last snapshot of <file> (+ started, - exited,
+                   ~ reparented, processes identified by pid and start time), <file> replaced by snapshot
+    --format=<format> : output text/json/ndjson/csv (default text)
+                   json/ndjson/csv: process records with depth, parent, matched, path
+    --sum=<field>[,field,...] : display subtrees totals of numeric <field> (procs: processes count,
+                   nlwp: threads count, time in seconds)
+    --collapse=<field>:<min> : fold subtrees with <field> total below <min> (+N folded)
+    --sort=[-]<field> : sort children by <field> (subtree total if in --sum), -<field>: descending
+    --top=<n> : display only first <n> children of each process (with --sort: top <n>)
+    --below=<n> : display only <n> levels of children under selected processes
+    --above=<n> : display only <n> levels of parents above selected processes
+    --fold : fold identical sibling processes without children (N*[comm])
+    --cgroups : label processes in other cgroup/pid namespace than parent (@<cgroup> pidns:<id>)
+                   <cgroup>: container runtime:id or cgroup last path component
+    --cgroup=<cgroup>[,cgroup,...] : select processes of cgroups (path or label, implies --cgroups)
+    --hosts=<host>[,host,...] : merge processes of hosts read concurrently (pids as host:pid)
+                   <host>: localhost, saved snapshot file or host name (ps through transport)
+                   @<file>: hosts listed in <file>
+    --transport=<command> : command running ps on host (default ssh -o BatchMode=yes, PGT_TRANSPORT env)
+    --host-timeout=<seconds> : host not read within <seconds> displayed with error (default 10)
+    --low-memory : bounded memory for huge process tables (-T): only pid/ppid of processes kept
+                   while source is streamed, processes displayed read again (not with -W/--hosts/--record/--delta)
+    --cache=<seconds> : share processes snapshot between invocations within <seconds>
+                   (or PGT_CACHE_TTL env, not used with -W/-k/-K)
+    --clear-cache : invalidate OS capabilities and processes snapshots caches
+    --profile=<profile> : stages timings on stderr text/json[,cprofile[:<file>]] (or PGT_PROFILE env)
+                   cprofile: python functions profile on stderr or dumped to <file>
 
     by default display full process hierarchy (parents + children of selected processes)
 
     -p <pids> : select processes pids to display hierarchy (default 0)
     -1 : display hierachy children of pid 1 (not including pid 0)
     <pgrep args> : use pgrep to select processes (see pgrep -h)
+                   several patterns matched in one pass by built-in pgrep (pattern shown ►<pattern>)
+    --pattern-file=<file> : patterns listed in <file> (one per line)
 
     found pids are prefixed with ►     
     """
 
-    # allow options after pattern : pgtree mysearch -fc
-    if len(argv) > 1 and argv[0][0] != '-':
-        argv.append(argv.pop(0))
     if 'PGTREE' in os.environ:
         argv = os.environ["PGTREE"].split(' ') + argv
+    import getopt
     try:
-        opts, args = getopt.getopt(argv,
-                                   "W1IRckKfxvinoyaTp:u:U:g:G:P:s:t:F:O:C:w:",
-                                   ["ns=", "nslist="])
+        # options allowed after patterns : pgtree mysearch othersearch -fc
+        opts, args = getopt.gnu_getopt(argv,
+                                       "W1IREckKfxvinoyaTp:u:U:g:G:P:s:t:F:O:C:w:",
+                                       ["ns=", "nslist=", "source=", "interval=", "format=", "profile=",
+                                        "kill-order=", "kill-freeze", "kill-timeout=", "threads=",
+                                        "cache=", "clear-cache", "sum=", "collapse=", "sort=", "top=",
+                                        "below=", "above=", "fold", "cgroups", "cgroup=", "events=",
+                                        "event-log=", "hosts=", "transport=", "host-timeout=",
+                                        "record=", "pattern-file=", "delta=",
+                                        "low-memory"])
     except getopt.GetoptError:
         print(usage)
         sys.exit(2)
@@ -512,22 +3675,44 @@ def main(argv):
             psfields = arg.split(',')
         elif opt == "-R":
             os.environ["PGT_PGREP"] = ""
-        elif opt == "-T":
-            PS_OPTION += " -T"
-            pgrep_args.append("-w")
         elif opt in ("-f", "-x", "-v", "-i", "-n", "-o"):
             pgrep_args.append(opt)
-        elif opt in ("-u", "-U", "-g", "-G", "-P", "-s", "-t", "-F", "--ns", "--nslist"):
+        elif opt in ("-u", "-U", "-g", "-G", "-P", "-s", "-t", "-F", "--ns", "--nslist",
+                     "--cgroup", "--pattern-file"):
             pgrep_args += [opt, arg]
     pgrep_args += args
+    output = options.get('--format', 'text')
+    if output not in ('text', 'json', 'ndjson', 'csv') or \
+       options.get('--kill-order', 'bottom-up') not in ('bottom-up', 'top-down') or \
+       options.get('--threads', 'expand') not in ('expand', 'fold') or \
+       options.get('--events', 'auto') not in ('auto', 'netlink', 'poll') or \
+       not options.get('--cache', '0').replace('.', '', 1).isdigit() or \
+       not options.get('--host-timeout', '0').replace('.', '', 1).isdigit() or \
+       not options.get('--collapse', ':0').rpartition(':')[2].replace('.', '', 1).isdigit() or \
+       not options.get('--top', '0').isdigit() or ('--delta' in options and '-W' in options) or \
+       ('--low-memory' in options and [opt for opt in ('-W', '--hosts', '--record', '--delta')
+                                       if opt in options]) or \
+       not options.get('--below', '0').isdigit() or not options.get('--above', '0').isdigit():
+        print(usage)
+        sys.exit(2)
+    if '--events' in options:
+        options['-W'] = ''
+    if '--clear-cache' in options:
+        clear_cache()
+    if output != 'text':
+        options['-w'] = 'no'
     after = wrap_text(options['-w'])
-    if '-W' in options:
-        watch_pgtree(options, psfields, pgrep_args, sig)
-    else:
-        (ptree, found) = pgtree(options, psfields, pgrep_args)
-        ptree.print_tree(pids=found, child_only='-c' in options, sig=sig,
-                         confirmed='-y' in options)
-    sys.stdout.write(after)
+    profile = options.get('--profile', os.environ.get('PGT_PROFILE'))
+    try:
+        if profile:
+            profile_run(profile, run_pgtree, options, psfields, pgrep_args, sig, output)
+        else:
+            run_pgtree(options, psfields, pgrep_args, sig, output)
+        sys.stdout.write(after)
+    except IOError:
+        if sys.exc_info()[1].errno != errno.EPIPE:
+            raise
+        stdout_closed()
 
 
 if __name__ == '__main__':
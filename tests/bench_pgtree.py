@@ -0,0 +1,531 @@
+"""
+pgtree benchmarks on synthetic process tables (not run by pytest)
+python tests/bench_pgtree.py [-s shape,...] [-S source,...] [-n] [-m] [-i runs] [size ...]
+  -s : shapes (default mixed,wide,deep,threads,longargs)
+  -S : process sources timed per stage (default ps,proc,file)
+       file: snapshot file of synthetic table (--record format) read back
+  -n : no comparison with pgtree 1.x tree building/display
+  -m : only peak memory (tracemalloc) of one process subtree display, full snapshot
+       compared with --low-memory (skeleton of streamed source)
+  -i : only startup latency of <runs> invocations of pgtree script / python -m pgtree
+       cold (no compiled code, no capabilities cache) and warm
+stages timed: run_ps (synthetic ps output), read (source), get_psinfo,
+pgrep, build_tree, render (matched hierarchy), render_all (full tree)
+with throughput (processes/s) and peak memory (tracemalloc)
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import getopt
+import tempfile
+import subprocess
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from pgtree import pgtree  # pylint: disable=C0413
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = [1000, 10000, 100000]
+SHAPES = ['mixed', 'wide', 'deep', 'threads', 'longargs']
+STAGE_SOURCES = ['ps', 'proc', 'file']
+MAX_DEPTH = 10000  # deep shape: chains of MAX_DEPTH processes
+OPT_FIELDS = ['stime', '%cpu', 'nlwp']
+
+
+def synthetic_table(size, shape='mixed', seed=1):
+    """
+    synthetic process table (pid, ppid, user, comm, threads, args) of size processes
+    mixed: random tree, wide: all processes children of pid 1,
+    deep: chains of processes (shell job ladder), threads: 1 process out of 10
+    with up to 50 threads, longargs: 2KB command lines
+    thread ids follow the pid of their process
+    """
+    rand = random.Random(seed)
+    table = []
+    pid = 1
+    pids = []
+    for num in range(size):
+        if num == 0:
+            ppid = 0
+        elif shape == 'wide':
+            ppid = 1
+        elif shape == 'deep':
+            ppid = pids[-1]
+            if num % MAX_DEPTH == 0:
+                ppid = 1
+        else:
+            ppid = pids[rand.randint(max(0, num - 500), num - 1)]
+        comm = 'proc%d' % (pid % 97)
+        threads = 1
+        if shape == 'threads' and num % 10 == 3:
+            threads = rand.randint(2, 50)
+        args = '/usr/bin/' + comm + ' --option value%d' % pid
+        if shape == 'longargs':
+            args += ''.join([' --arg%d=%x' % (i, rand.getrandbits(64)) for i in range(80)])
+        table.append((pid, ppid, 'user%d' % (pid % 7), comm, threads, args))
+        pids.append(pid)
+        pid += threads
+    return table
+
+
+def opt_value(field, proc, tid=None):
+    """synthetic value of optional ps field"""
+    if field == 'spid':
+        return str(tid or proc[0])
+    if field == 'nlwp':
+        return str(proc[4])
+    if field == '%cpu':
+        return '%d.%d' % (proc[0] % 13, proc[0] % 10)
+    return '10:10'
+
+
+class SyntheticSource:
+    """process source reading synthetic process table"""
+
+    def __init__(self, size, shape='mixed', seed=1):
+        self.table = synthetic_table(size, shape, seed)
+
+    def read(self, ps_fields):
+        """[pid, ppid, user, comm, <opt fields>..., args] per process"""
+        return [[str(proc[0]), str(proc[1]), proc[2], proc[3]] +
+                [opt_value(field, proc) for field in ps_fields[4:]] + [proc[5]]
+                for proc in self.table]
+
+
+class Replay:
+    """source returning already read processes (time Snapshot without read)"""
+
+    def __init__(self, source, procs):
+        self.source = source
+        self.procs = procs
+        self.lazy = getattr(source, 'lazy', False)
+        self.live = False
+
+    def read(self, ps_fields):
+        """processes read by source"""
+        return self.procs
+
+    def parse(self, values, raw):
+        """source parsing"""
+        self.source.parse(values, raw)
+
+
+def ps_output(table, ps_fields):
+    """synthetic ps output as produced by PsSource.run_ps ps command
+       (ps -T rows for threads when spid in ps_fields)"""
+    spaced = [o for o in ps_fields[4:] if o in pgtree.OPT_WIDTHS]
+    tokens = [o for o in ps_fields[4:] if not o in pgtree.OPT_WIDTHS and o != 'spid']
+    lines = ['HEADER']
+    for proc in table:
+        threads = 1
+        if 'spid' in ps_fields:
+            threads = proc[4]
+        for tid in range(proc[0], proc[0] + threads):
+            ids = '%5d %5d ' % (proc[0], proc[1])
+            if 'spid' in ps_fields:
+                ids += '%5d ' % tid
+            lines.append('%-*s ' % (pgtree.USER_WIDTH, proc[2]) + ''.join(
+                ['%*s ' % (pgtree.OPT_WIDTHS[o], opt_value(o, proc, tid)) for o in spaced])
+                + ids + '%-*s ' % (pgtree.COMM_WIDTH, proc[3]) + ''.join(
+                ['%s ' % opt_value(o, proc, tid) for o in tokens]) + proc[5])
+    return '\n'.join(lines) + '\n'
+
+
+def write_proc(table, root):
+    """write /proc like tree of table processes in root directory"""
+    def write(path, data):
+        with open(os.path.join(root, path), 'w') as fd:
+            fd.write(data)
+    def read(path):
+        with open(os.path.join(root, path)) as fd:
+            return fd.read()
+    write('stat', 'cpu  1 2 3 4\nbtime 1700000000\n')
+    write('meminfo', 'MemTotal:       16000000 kB\n')
+    write('uptime', '100000.00 90000.00\n')
+    for pid, ppid, user, comm, threads, args in table:
+        uid = str(1000 + int(user[4:]))
+        stat = '%d (%s) S %d %d %d 0 -1 4194304 0 0 0 0 %d %d 0 0 20 0 %d 0 %d %d %d\n'
+        os.mkdir(os.path.join(root, str(pid)))
+        write('%d/stat' % pid, stat % (pid, comm, ppid, pid, pid, pid % 500, pid % 300,
+                                       threads, 5000 + pid, 1024 * 1024 * (pid % 100 + 1),
+                                       pid % 1000 + 10))
+        write('%d/status' % pid, 'Name:\t%s\nUid:\t%s\t%s\t%s\t%s\nGid:\t%s\t%s\t%s\t%s\n'
+              % ((comm,) + (uid,) * 8))
+        write('%d/cmdline' % pid, args.replace(' ', '\0') + '\0')
+        if threads > 1:
+            os.mkdir(os.path.join(root, '%d/task' % pid))
+            for tid in range(pid, pid + threads):
+                os.mkdir(os.path.join(root, '%d/task/%d' % (pid, tid)))
+                task = '%d/task/%d/' % (pid, tid)
+                write(task + 'stat',
+                      stat % (tid, comm, ppid, pid, pid, 0, 0, threads, 5000 + pid, 0, 0))
+                write(task + 'status', read(str(pid) + '/status'))
+                write(task + 'cmdline', read(str(pid) + '/cmdline'))
+
+
+class NullOutput:
+    """stdout counting written characters"""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        """count only"""
+        self.size += len(data)
+
+    def flush(self):
+        """nothing to flush"""
+
+
+class Stages:
+    """run pgtree stages on a source, each stage timed (and traced)"""
+
+    def __init__(self, name, source, ps_fields):
+        self.name = name
+        self.source = source
+        self.ps_fields = ps_fields
+        self.results = []
+
+    def stage(self, stage, func, *args):
+        """run stage, record (stage, seconds, peak bytes), returns func result"""
+        traced = tracemalloc and tracemalloc.is_tracing()
+        if traced:
+            tracemalloc.clear_traces()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        peak = None
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+        self.results.append((stage, elapsed, peak))
+        return result
+
+    def run(self):
+        """run all stages, returns (rows, [(stage, seconds, peak bytes), ...])"""
+        stdout = sys.stdout
+        if self.name == 'ps':
+            self.stage('run_ps', self.source.run_ps, self.ps_fields)
+        procs = self.stage('read', self.source.read, self.ps_fields)
+        snapshot = self.stage('get_psinfo', pgtree.Snapshot, self.ps_fields,
+                              Replay(self.source, procs))
+        found = self.stage('pgrep', snapshot.pgrep, ['-x', 'proc7'])
+        ptree = pgtree.Proctree(snapshot=snapshot, opt_fields=OPT_FIELDS,
+                                threads='spid' in self.ps_fields)
+        self.stage('build_tree', ptree.select, found)
+        sys.stdout = NullOutput()
+        try:
+            self.stage('render', ptree._print_tree, ptree.top_parents)
+            ptree = pgtree.Proctree(snapshot=snapshot, opt_fields=OPT_FIELDS,
+                                    threads='spid' in self.ps_fields)
+            self.stage('render_all', ptree.print_tree)
+        finally:
+            sys.stdout = stdout
+        return (len(procs), self.results)
+
+
+def stage_source(name, table, ps_fields, root):
+    """process source of synthetic table: ps command output, /proc tree or snapshot file"""
+    if name == 'ps':
+        return (pgtree.PsSource(), ps_output(table, ps_fields))
+    if name == 'file':
+        path = os.path.join(root, 'snapshot')
+        source = SyntheticSource(0)
+        source.table = table
+        pgtree.Snapshot(ps_fields, source).save(path)
+        return (pgtree.FileSource(path), None)
+    if not os.path.isdir(os.path.join(root, '1')):
+        write_proc(table, root)
+    return (pgtree.ProcSource(root), None)
+
+
+def bench_stages(size, shape, sources=None, memory=True):
+    """time each stage of ps/proc sources on synthetic table"""
+    table = synthetic_table(size, shape)
+    fields = pgtree.get_fields(OPT_FIELDS)
+    if shape == 'threads':
+        fields.append('spid')
+    root = tempfile.mkdtemp(prefix='pgtree_bench')
+    try:
+        for name in sources or STAGE_SOURCES:
+            source, output = stage_source(name, table, fields, root)
+            with patch('pgtree.pgtree.runcmd', return_value=(0, output)):
+                rows, results = Stages(name, source, fields).run()
+                peaks = [None] * len(results)
+                if memory and tracemalloc:
+                    tracemalloc.start()
+                    peaks = [result[2] for result in Stages(name, source, fields).run()[1]]
+                    tracemalloc.stop()
+            for (stage, elapsed, _), peak in zip(results, peaks):
+                line = '%-8s %-5s %7d procs %7d rows  %-10s %8.3fs' % (
+                    shape, name, size, rows, stage, elapsed)
+                if elapsed:
+                    line += ' %10d rows/s' % (rows / elapsed)
+                else:
+                    line += ' %17s' % ''
+                if peak is not None:
+                    line += ' %8.1f MB peak' % (peak / 1048576.0)
+                print(line)
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_memory(size, shape, sources=None):
+    """peak memory of one process subtree display: full snapshot / low memory mode"""
+    table = synthetic_table(size, shape)
+    threads = shape == 'threads'
+    fields = pgtree.get_fields(OPT_FIELDS)
+    if threads:
+        fields.append('spid')
+    proc = table[len(table) // 2]
+    pattern = ['-f', 'value%d( |$)' % proc[0]]
+    root = tempfile.mkdtemp(prefix='pgtree_bench')
+    def lines(cmd, status):
+        """synthetic ps output streamed line by line"""
+        start = 0
+        while start < len(output):
+            end = output.index('\n', start)
+            yield output[start:end]
+            start = end + 1
+        status.append(None)
+    try:
+        for name in sources or STAGE_SOURCES:
+            source, output = stage_source(name, table, fields, root)
+            results = []
+            for low_memory in (False, True):
+                with patch('pgtree.pgtree.runcmd', return_value=(0, output)), \
+                     patch('pgtree.pgtree.runcmd_lines', side_effect=lines):
+                    stdout = sys.stdout
+                    sys.stdout = StringIO()
+                    tracemalloc.start()
+                    try:
+                        ptree = pgtree.Proctree(source=source, opt_fields=OPT_FIELDS,
+                                                threads=threads, low_memory=low_memory)
+                        ptree.print_tree(ptree.pgrep(pattern), child_only=True)
+                        peak = tracemalloc.get_traced_memory()[1]
+                    finally:
+                        tracemalloc.stop()
+                        display = sys.stdout.getvalue()
+                        sys.stdout = stdout
+                results.append((peak, display, len(ptree.ps_info)))
+                del ptree
+            (peak, display, loaded), (low_peak, low_display, low_loaded) = results
+            print('%-8s %-5s %7d procs  full %8.1f MB peak %7d loaded  low-memory %8.1f MB peak'
+                  ' %5d loaded  %5.1fx  same output: %s' % (
+                      shape, name, size, peak / 1048576.0, loaded, low_peak / 1048576.0,
+                      low_loaded, peak / float(low_peak or 1), display == low_display))
+            if display != low_display:
+                sys.exit(1)
+    finally:
+        shutil.rmtree(root)
+
+
+class ReferenceProctree(pgtree.Proctree):
+    """tree building and display as in pgtree 1.x (recursive, list membership)"""
+
+    def print_proc(self, pid, pre, print_it, last):
+        """display process information with indent/tree/colors"""
+        next_p = ''
+        ppre = pre
+        if pid in self.pids:
+            print_it = True
+            ppre = self.treedisp.selected + pre[1:]
+        if print_it:
+            self.selected_pids.insert(0, pid)
+            if pre == ' ':  # head of hierarchy
+                curr_p = next_p = ' '
+            elif last:  # last child
+                curr_p = self.treedisp.lastchild
+                next_p = '  '
+            else:  # not last child
+                curr_p = self.treedisp.child
+                next_p = self.treedisp.notchild
+            ps_info = self.treedisp.colorize('pid', pid.ljust(5)) + \
+                      self.treedisp.colorize('user', ' (' + self.ps_info[pid]['user'] + ') ') + \
+                      self.treedisp.colorize('comm', '[' + self.ps_info[pid]['comm'] + '] ')
+            ps_info += ' '.join(
+                [self.treedisp.colorize(f, self.ps_info[pid][f]) for f in self.opt_fields]
+            )
+            ps_info += ' ' + self.ps_info[pid]['args']
+            output = ppre + curr_p + ps_info
+            print(output)
+        return (next_p, print_it)
+
+    def _print_tree(self, pids, print_it=True, pre=' '):
+        for idx, pid in enumerate(pids):
+            (next_p, print_children) = self.print_proc(pid, pre, print_it, idx == len(pids)-1)
+            if pid in self.pids_tree:
+                self._print_tree(self.pids_tree[pid], print_children, pre+next_p)
+
+    def build_tree(self):
+        self.children2tree(self.pids)
+        self.get_parents()
+
+    def get_parents(self):
+        last_ppid = None
+        for pid in self.pids:
+            if pid not in self.ps_info:
+                continue
+            while pid in self.ps_info:
+                ppid = self.ps_info[pid]['ppid']
+                if ppid not in self.pids_tree:
+                    self.pids_tree[ppid] = []
+                if pid not in self.pids_tree[ppid]:
+                    self.pids_tree[ppid].append(pid)
+                last_ppid = pid
+                pid = ppid
+            if last_ppid not in self.top_parents:
+                self.top_parents.append(last_ppid)
+
+    def children2tree(self, pids):
+        for pid in pids:
+            if pid in self.pids_tree:
+                continue
+            if pid in self.children:
+                self.pids_tree[pid] = self.children[pid]
+                self.children2tree(self.children[pid])
+
+
+def timed(func, *args):
+    """run func, return (result, elapsed seconds)"""
+    start = time.time()
+    result = func(*args)
+    return (result, time.time() - start)
+
+
+def captured(func, *args):
+    """run func, return (stdout output, elapsed seconds)"""
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        _, elapsed = timed(func, *args)
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    return (output, elapsed)
+
+
+def bench_render(size, shape, reference=True):
+    """display full colored tree, compare with reference"""
+    source = SyntheticSource(size, shape)
+    ptree = pgtree.Proctree(source=source, use_color=True, opt_fields=['stime', '%cpu'])
+    output, elapsed = captured(ptree.print_tree)
+    result = '%-8s %7d procs %7d lines  print_tree %8.3fs' % (
+        shape, size, output.count('\n'), elapsed)
+    if reference and (shape != 'deep' or size < sys.getrecursionlimit() // 2 - 100):
+        ref = ReferenceProctree(source=source, use_color=True, opt_fields=['stime', '%cpu'])
+        ref_output, ref_elapsed = captured(ref.print_tree)
+        same = ref_output == output and ref.selected_pids == ptree.selected_pids
+        result += '  reference %8.3fs  same output: %s' % (ref_elapsed, same)
+        if not same:
+            print(result)
+            sys.exit(1)
+    print(result)
+
+
+def bench_build_tree(size, shape, reference=True):
+    """build tree for 1 process out of 50 selected, compare with reference"""
+    source = SyntheticSource(size, shape)
+    ptree = pgtree.Proctree(source=source)
+    pids = [pid for pid in ptree.ps_info if pid != '0' and int(pid) % 50 == 7]
+    ptree.pids = pids
+    _, elapsed = timed(ptree.build_tree)
+    result = '%-8s %7d procs %5d selected  build_tree %8.3fs' % (
+        shape, size, len(pids), elapsed)
+    if reference and (shape != 'deep' or size < sys.getrecursionlimit() - 100):
+        ref = ReferenceProctree(source=source)
+        ref.pids = pids
+        _, ref_elapsed = timed(ref.build_tree)
+        same = ref.pids_tree == ptree.pids_tree and ref.top_parents == ptree.top_parents
+        result += '  reference %8.3fs  same output: %s' % (ref_elapsed, same)
+        if not same:
+            print(result)
+            sys.exit(1)
+    print(result)
+
+
+def invoke(cmd, env):
+    """run pgtree command, returns elapsed seconds"""
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(cmd, stdout=devnull, env=env, cwd=ROOT)
+    return time.time() - start
+
+
+def bench_startup(runs):
+    """latency of one-shot invocations (-p 1), cold: pgtree compiled code and capabilities
+       cache removed before each run (PYTHONPYCACHEPREFIX/PGT_CACHE_DIR), warm: kept"""
+    entries = [('script', ['pgtree/pgtree']),
+               ('module', [sys.executable, '-m', 'pgtree'])]
+    env = dict(os.environ)
+    for var in ('PGT_COMM', 'PGT_STIME', 'PGT_PGREP', 'PGT_CACHE_TTL', 'PYTHONDONTWRITEBYTECODE'):
+        env.pop(var, None)
+    tmp = tempfile.mkdtemp(prefix='pgtree_bench')
+    env['PYTHONPYCACHEPREFIX'] = os.path.join(tmp, 'pycache')
+    env['PGT_CACHE_DIR'] = os.path.join(tmp, 'cache')
+    compiled = os.path.join(tmp, 'pycache', ROOT.lstrip(os.sep), 'pgtree')
+    try:
+        for name, cmd in entries:
+            for mode in ('cold', 'warm'):
+                times = []
+                for run in range(runs + 1):
+                    if mode == 'cold' or run == 0:
+                        shutil.rmtree(compiled, True)
+                        shutil.rmtree(env['PGT_CACHE_DIR'], True)
+                    elapsed = invoke(cmd + ['-C', 'n', '-p', '1'], env)
+                    if run:  # first run compiles python library in cache prefix
+                        times.append(elapsed)
+                times.sort()
+                print('startup  %-7s %-5s %3d runs  min %6.3fs  median %6.3fs  max %6.3fs' % (
+                    name, mode, len(times), times[0], times[len(times) // 2], times[-1]))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main(argv):
+    """run benchmarks"""
+    opts, args = getopt.getopt(argv, 's:S:nmi:')
+    options = dict(opts)
+    if '-i' in options:
+        bench_startup(int(options['-i']))
+        return
+    sizes = [int(size) for size in args] or SIZES
+    shapes = SHAPES
+    if '-s' in options:
+        shapes = options['-s'].split(',')
+    sources = None
+    if '-S' in options:
+        sources = options['-S'].split(',')
+    os.environ.setdefault('PGT_COMM', 'ucomm')
+    os.environ.setdefault('PGT_STIME', 'stime')
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+    for size in sizes:
+        if '-m' in options:
+            for shape in shapes:
+                bench_memory(size, shape, sources)
+            continue
+        for shape in shapes:
+            bench_stages(size, shape, sources)
+        if '-n' in options:
+            continue
+        for shape in shapes:
+            bench_build_tree(size, shape)
+        for shape in shapes:
+            bench_render(size, shape)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,6 +1,14 @@
 """pgtree tests"""
+import io
+import json
 import os
+import shutil
+import signal
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import patch
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
@@ -9,20 +17,45 @@ import pgtree
 os.environ['PGT_COMM'] = 'ucomm'
 os.environ['PGT_STIME'] = 'stime'
 
+class ListSource:
+    """
+    fixed process list: procs (pid, ppid[, comm[, values of fields...]]) read as rows
+    [pid, ppid, user, comm, <ps fields values>..., args], default user 'root',
+    stime 'stime', args comm
+    """
+    def __init__(self, procs, fields=()):
+        self.procs = procs
+        self.fields = fields
+
+    def read(self, ps_fields):
+        """rows of processes"""
+        rows = []
+        for proc in self.procs:
+            comm = 'sh'
+            if len(proc) > 2:
+                comm = proc[2]
+            values = {'user': 'root', 'stime': 'stime', 'args': comm}
+            values.update(zip(self.fields, proc[3:]))
+            rows.append([proc[0], proc[1], values['user'], comm] +
+                        [values[field] for field in ps_fields[4:]] + [values['args']])
+        return rows
+
 class ProctreeTest(unittest.TestCase):
     """tests for pgtree"""
+    @patch.dict(os.environ, {"PGT_SOURCE": "ps"})
     @patch('os.kill')
     @patch('pgtree.pgtree.runcmd')
     def test_tree1(self, mock_runcmd, mock_kill):
         """test"""
-        ps_out = 4*(130*'-'+' ')
         print("tree: =======")
-        ps_out = 4*(130*'-'+' ') + "\n"
-        ps_out += f'{"1":>30} {"0":>30} {"root":<30} {"init":<130} {"Aug12":<50} /init\n'
-        ps_out += f'{"10":>30} {"1":>30} {"joknarf":<30} {"bash":<130} {"Aug12":<50} -bash\n'
-        ps_out += f'{"20":>30} {"10":>30} {"joknarf":<30} {"sleep":<130} {"10:10":<50} /bin/sleep 60\n'
-        ps_out += f'{"30":>30} {"10":>30} {"joknarf":<30} {"top":<130} {"10:10":<50} /bin/top\n'
-        ps_out += f'{"40":>30} {"1":>30} {"root":<30} {"bash":<130} {"11:01":<50} -bash'
+        width = pgtree.pgtree.COMM_WIDTH
+        user = pgtree.pgtree.USER_WIDTH
+        ps_out = f'{user*"-"} {10*"-"}   PID  PPID {width*"-"} COMMAND\n'
+        ps_out += f'{"root":<{user}} {"Aug12":>10} {"1":>5} {"0":>5} {"init":<{width}} /init\n'
+        ps_out += f'{"joknarf":<{user}} {"Aug12":>10} {"10":>5} {"1":>5} {"bash":<{width}} -bash\n'
+        ps_out += f'{"joknarf":<{user}} {"10:10":>10} {"20":>5} {"10":>5} {"sleep":<{width}} /bin/sleep 60\n'
+        ps_out += f'{"joknarf":<{user}} {"10:10":>10} {"30":>5} {"10":>5} {"top":<{width}} /bin/top\n'
+        ps_out += f'{"root":<{user}} {"11:01":>10} {"40":>5} {"1":>5} {"bash":<{width}} -bash'
         print(ps_out)
         mock_runcmd.return_value = 0, ps_out
         mock_kill.return_value = True
@@ -148,9 +181,38 @@ class ProctreeTest(unittest.TestCase):
     def test_ospgrep(self):
         """pgrep os"""
         print("test os pgrep")
-        pgtree.main(['-C','y','-w','n','-f', '-i', '-u', 'root', '-x', '-t', 'pts/1', 'bash'])
+        pgtree.main(['-E', '-C','y','-w','n','-f', '-i', '-u', 'root', '-x', '-t', 'pts/1', 'bash'])
         pgtree.main("-1")
 
+    def test_pgrep_options(self):
+        """built-in pgrep options on loaded process table"""
+        argv = ['-u', 'root,0', '-g', '0', '-s', '0', '-t', '?,pts/1', '-G', '0', '-U', 'root']
+        ptree = pgtree.Proctree(extra_fields=pgtree.pgtree.Pgrep(argv).fields)
+        comm = ptree.ps_info['1']['comm']
+        self.assertIn('1', ptree.pgrep(['-x', comm]))
+        self.assertIn('1', ptree.pgrep(['-P', '0']))
+        self.assertNotIn('1', ptree.pgrep(['-v', '-x', comm]))
+        self.assertEqual(ptree.pgrep(['-x', 'no_such_process']), [])
+        self.assertEqual(len(ptree.pgrep(['-n'])), 1)
+        self.assertEqual(len(ptree.pgrep(['-o'])), 1)
+        ptree.pgrep(argv)
+        pgtree.main(['-u', 'root', '-n', '--ns', '1', '--nslist', 'pid,net'])
+        with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            with self.assertRaises(SystemExit) as exited:
+                ptree.pgrep(['['])
+        self.assertEqual(exited.exception.code, 2)
+        self.assertTrue(stderr.getvalue().startswith('pgrep: regex error: '))
+        with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            with self.assertRaises(SystemExit) as exited:
+                ptree.pgrep(['-F', '/nonexistent/pgtree.pid'])
+        self.assertEqual(exited.exception.code, 1)
+        self.assertEqual(stderr.getvalue(), 'pgrep: pidfile not valid\n')
+        pidfile = tempfile.mkstemp()[1]
+        with open(pidfile, 'w') as pid:
+            pid.write('1\n')
+        self.assertEqual(ptree.pgrep(['-F', pidfile]), ['1'])
+        os.remove(pidfile)
+
     @patch.dict(os.environ, {"PGT_PGREP": "", "PGTREE": "-1"})
     def test_pgrep(self):
         """pgrep built-in"""
@@ -167,8 +229,21 @@ class ProctreeTest(unittest.TestCase):
         print("test watch built-in")
         mock_sleep.return_value = True
         pgtree.main(['-W', 'bash'])
+        mock_sleep.return_value = None
+        mock_sleep.side_effect = [None, True]
+        with patch('sys.stdout', new_callable=io.StringIO):
+            pgtree.main(['-W', '--interval=0.1', 'bash'])
+        mock_sleep.assert_called_with(0.1)
+
+    def test_tree_changes(self):
+        """added/exited/reparented processes between snapshots"""
+        old = pgtree.Proctree(source=ListSource([('1', '0'), ('2', '1'), ('3', '2'), ('4', '1')]))
+        old.print_tree(pids=['3', '4'])
+        new = pgtree.Proctree(source=ListSource([('1', '0'), ('2', '1'), ('4', '2'), ('5', '1')]))
+        self.assertEqual(pgtree.pgtree.tree_changes(old, new), {'3': '-', '4': '~', '5': '+'})
+        self.assertEqual(new.children['2'], ['4', '3'])
 
-    @patch.dict(os.environ, {"PGT_COMM": "", "PGT_STIME": ""})
+    @patch.dict(os.environ, {"PGT_COMM": "", "PGT_STIME": "", "PGT_SOURCE": "ps"})
     def test_simpleps(self):
         pgtree.main([])
 
@@ -180,5 +255,616 @@ class ProctreeTest(unittest.TestCase):
         except SystemExit:
             pass
 
+    @patch('pgtree.pgtree.runcmd')
+    def test_ps_widths(self, mock_runcmd):
+        """ps values filling their column read again with wider columns"""
+        import re
+        procs = [{'user': 'root', 'stime': 'Aug12', 'pid': '1', 'ppid': '0', 'ucomm': 'init',
+                  'rss': '1024', 'args': '/init'},
+                 {'user': 'a_very_long_user_name_over_32_chars', 'stime': 'Aug12',
+                  'pid': '10', 'ppid': '1', 'ucomm': 'rcu_tasks_rude_kthread',
+                  'rss': '0', 'args': '[rcu_tasks_rude_kthread]'}]
+        commands = []
+        def ps(cmd):
+            """ps output with values truncated to header width"""
+            commands.append(cmd)
+            columns = re.findall(r'-o (\S+)=(-*)', cmd)
+            lines = [' '.join([dashes for _, dashes in columns]) + ' COMMAND']
+            for proc in procs:
+                lines.append(' '.join(['%-*.*s' % (len(dashes), len(dashes) or 99, proc[field])
+                                       for field, dashes in columns]) + ' ' + proc['args'])
+            return 0, '\n'.join(lines)
+        mock_runcmd.side_effect = ps
+        ps_fields = ['pid', 'ppid', 'user', 'ucomm', 'stime', 'rss']
+        snapshot = pgtree.Snapshot(ps_fields, pgtree.pgtree.PsSource())
+        self.assertEqual(len(commands), 2)
+        self.assertEqual(snapshot.ps_info['10']['user'], procs[1]['user'])
+        self.assertEqual(snapshot.ps_info['10']['comm'], procs[1]['ucomm'])
+        self.assertEqual(snapshot.ps_info['10']['stime'], 'Aug12')
+        self.assertEqual(snapshot.ps_info['1']['rss'], '1024')
+        self.assertEqual(snapshot.ps_info['10']['args'], procs[1]['args'])
+
     def test_threads(self):
         pgtree.main(["-T"])
+
+    @patch.dict(os.environ, {"PGT_COMM": "comm", "PGT_STIME": "stime"})
+    def test_thread_tree(self):
+        """threads under their process, expanded or folded by name"""
+        source = ListSource([('1', '0', 'sh', '1'), ('2', '1', 'sh', '2'),
+                             ('2', '1', 'worker', '5'), ('2', '1', 'worker', '6'),
+                             ('2', '1', 'io', '7'), ('3', '2', 'sh', '3')], ['spid'])
+        ptree = pgtree.Proctree(source=source, threads=True)
+        self.assertEqual(ptree.ps_fields[-1], 'spid')
+        self.assertEqual(sorted(ptree.ps_info), ['0', '1', '2', '3'])
+        self.assertEqual([t['spid'] for t in ptree.snapshot.threads['2']], ['5', '6', '7'])
+        lines = list(ptree.tree(['2'], child_only=True))
+        self.assertEqual([line.split(' (')[0].rstrip()[-1] for line in lines], ['2', '5', '6', '7', '3'])
+        self.assertIn('{worker}', lines[1])
+        ptree = pgtree.Proctree(source=source, threads='fold')
+        lines = list(ptree.tree(['2'], child_only=True))
+        self.assertEqual([line.split('─')[-1] for line in lines[1:3]], ['2*{worker}\n', '{io}\n'])
+        self.assertEqual(ptree.selected_pids, ['3', '2'])
+
+    @unittest.skipUnless(os.path.isfile('/proc/self/stat'), "no /proc")
+    def test_procsource(self):
+        """/proc source same as ps source"""
+        fields = ['%cpu', 'rss', 'nlwp', 'etime']
+        ptree = pgtree.Proctree(source='proc', opt_fields=fields)
+        ptree_ps = pgtree.Proctree(source='ps', opt_fields=fields)
+        self.assertIsInstance(ptree.source, pgtree.pgtree.ProcSource)
+        for field in ('pid', 'ppid', 'user', 'nlwp'):
+            self.assertEqual(ptree.ps_info['1'][field], ptree_ps.ps_info['1'][field])
+        pgtree.main(['--source=proc', '-I', '-O', 'stime,vsz,%mem,time,pgid,sid', 'init'])
+        tmp = tempfile.mkdtemp()  # kernel comm kept (15 chars), rss of status like ps
+        os.mkdir(tmp + '/1')
+        with open(tmp + '/1/stat', 'w') as stat:
+            stat.write('1 (systemd-journal) S 0 1 1 0 -1 0 0 0 0 0 1 1 0 0 20 0 1 0 5 1000 100\n')
+        with open(tmp + '/1/status', 'w') as status:
+            status.write('Name:\tsystemd-journal\nUid:\t0\t0\t0\t0\nGid:\t0\t0\t0\t0\n'
+                         'VmRSS:\t    2048 kB\n')
+        with open(tmp + '/1/cmdline', 'w') as cmdline:
+            cmdline.write('/usr/lib/systemd/systemd-journald\0')
+        ptree = pgtree.Proctree(source=pgtree.pgtree.ProcSource(tmp), opt_fields=['rss'])
+        self.assertEqual(ptree.ps_info['1']['comm'], 'systemd-journal')
+        self.assertEqual(ptree.ps_info['1']['rss'], '2048')
+        self.assertEqual(ptree.ps_info['1']['args'], '/usr/lib/systemd/systemd-journald')
+        hertz = os.sysconf('SC_CLK_TCK')  # args escaped, etime and %cpu truncated like ps
+        with open(tmp + '/uptime', 'w') as uptime:
+            uptime.write('20.5 10.0\n')
+        for pid, cmd in (('2', b'sh\0-c\0echo a\nb\tc \xc3\xa9\xff\0'),
+                         ('3', b'caf\xc3\xa9\0\xe2\x80\xa8\xc2\x9b\0')):
+            os.mkdir(tmp + '/' + pid)
+            with open(tmp + '/' + pid + '/stat', 'w') as stat:
+                stat.write(f'{pid} (sh) S 1 1 1 0 -1 0 0 0 0 0 {30 * hertz} 0 0 0 20 0 1 0 '
+                           f'{hertz // 2} 1000 100\n')
+            with open(tmp + '/' + pid + '/cmdline', 'wb') as cmdline:
+                cmdline.write(cmd)
+        ptree = pgtree.Proctree(source=pgtree.pgtree.ProcSource(tmp),
+                                opt_fields=['etime', '%cpu'])
+        self.assertEqual(ptree.ps_info['2']['args'], 'sh -c echo a b?c ???')
+        self.assertEqual(ptree.ps_info['3']['args'], 'caf\xe9 ??')
+        self.assertEqual(ptree.ps_info['2']['etime'], '00:20')
+        self.assertEqual(ptree.ps_info['2']['%cpu'], '150')
+        with open(tmp + '/3/cmdline', 'wb') as cmdline:  # cut to fit ps line of 128KiB
+            cmdline.write(b'x' * 200000)
+        source = pgtree.pgtree.ProcSource(tmp)
+        values, raw = [proc for proc in source.read(['pid', 'ppid', 'user', 'ucomm'])
+                       if proc[0][0] == '3'][0]
+        source.parse(values, raw)
+        self.assertEqual(len(values[-1]), 131072 - 6 - 6 - 33 - 17)
+        shutil.rmtree(tmp)
+
+    def test_sourcefail(self):
+        """unknown source / unsupported fields"""
+        with self.assertRaises(SystemExit):
+            pgtree.Proctree(source='nosource')
+        with self.assertRaises(SystemExit):
+            pgtree.Proctree(source='proc', opt_fields=['abcd'])
+
+    def test_psinfo(self):
+        """compact process record"""
+        fields = {'pid': 0, 'ppid': 1, 'user': 2, 'comm': 3, 'args': 4}
+        info = pgtree.pgtree.Psinfo(['10', '1', 'root', 'bash', '-bash'], fields)
+        self.assertEqual(info['user'], 'root')
+        self.assertEqual(info.get('%cpu', '-'), '-')
+        self.assertIn('comm', info)
+        info['ppid'] = '-1'
+        self.assertEqual(info, {'pid': '10', 'ppid': '-1', 'user': 'root',
+                                'comm': 'bash', 'args': '-bash'})
+        self.assertNotEqual(info, None)
+
+    def test_deep_tree(self):
+        """tree of chained processes deeper than recursion limit"""
+        class ChainSource:
+            """pid n child of pid n-1"""
+            def read(self, ps_fields):
+                return [[str(pid), str(pid - 1), 'root', 'sh', 'stime', 'sh']
+                        for pid in range(1, sys.getrecursionlimit() + 500)]
+        ptree = pgtree.Proctree(source=ChainSource())
+        ptree.pids = ['10', '20', '10']
+        ptree.build_tree()
+        self.assertEqual(ptree.top_parents, ['0'])
+        self.assertEqual(ptree.pids_tree['19'], ['20'])
+        self.assertEqual(len(ptree.pids_tree), sys.getrecursionlimit() + 500)
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            ptree._print_tree(ptree.top_parents, False)
+        self.assertEqual(stdout.getvalue().count('\n'), sys.getrecursionlimit() + 490)
+        self.assertEqual(ptree.selected_pids[-1], '10')
+
+    @unittest.skipUnless(os.path.isfile('/proc/self/stat'), "no /proc")
+    def test_lazy(self):
+        """fields parsed only for displayed processes"""
+        ptree = pgtree.Proctree(source='proc')
+        comm = ptree.ps_info['1']['comm']
+        found = ptree.pgrep(['-x', comm])
+        self.assertIsNotNone(ptree.ps_info['1'].raw)
+        with patch('sys.stdout', new_callable=io.StringIO):
+            ptree.print_tree(pids=found, child_only=True)
+        self.assertIsNone(ptree.ps_info['1'].raw)
+        parsed = [pid for pid,info in ptree.ps_info.items() if info.raw is None]
+        self.assertEqual(sorted(parsed, key=int), sorted(ptree.selected_pids + ['0'], key=int))
+
+    def test_records(self):
+        """json/ndjson/csv process records"""
+        source = ListSource([(pid, ppid, 'sh', 'sh ' + pid)
+                             for pid, ppid in [('1', '0'), ('2', '1'), ('3', '2'), ('4', '1')]],
+                            ['args'])
+        ptree = pgtree.Proctree(source=source)
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            ptree.print_tree(pids=['2'], output='ndjson')
+        records = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([r['pid'] for r in records], ['1', '2', '3'])
+        self.assertEqual(records[2], {'pid': '3', 'ppid': '2', 'user': 'root', 'comm': 'sh',
+                                      'stime': 'stime', 'args': 'sh 3', 'depth': 2,
+                                      'parent': '2', 'matched': False, 'path': ['1', '2', '3']})
+        self.assertTrue(records[1]['matched'])
+        self.assertEqual(ptree.selected_pids, ['3', '2', '1', '0'])
+        ptree = pgtree.Proctree(source=source)
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            ptree.print_tree(pids=['2'], child_only=True, output='json')
+        self.assertEqual(json.loads(stdout.getvalue()), records[1:])
+        ptree = pgtree.Proctree(source=source)
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            ptree.print_tree(output='csv')
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(lines[0], 'pid,ppid,user,comm,stime,args,depth,parent,matched,path')
+        self.assertEqual(lines[4], '4,1,root,sh,stime,sh 4,1,1,false,1/4')
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            pgtree.main(['--format=json', '-x', 'nomatchxx'])
+        self.assertEqual(json.loads(stdout.getvalue()), [])
+        with self.assertRaises(SystemExit):
+            pgtree.main(['--format=xml'])
+
+    def test_snapshot(self):
+        """queries on one snapshot"""
+        snap = pgtree.Snapshot(source=ListSource([('1', '0', 'init'), ('2', '1', 'sshd'),
+                                                  ('3', '2', 'bash'), ('4', '3', 'sleep'),
+                                                  ('5', '1', 'bash')]))
+        matched = snap.pgrep(['-x', 'bash'])
+        self.assertEqual(matched, ['3', '5'])
+        self.assertEqual(snap.ancestors(matched), ['2', '1', '0'])
+        self.assertEqual(snap.descendants(['2']), ['3', '4'])
+        self.assertEqual(snap.descendants(['1', '3']), ['2', '4', '5'])
+        (pids_tree, top_parents) = snap.subtree(['3'])
+        self.assertEqual(top_parents, ['0'])
+        self.assertEqual(pids_tree['1'], ['2'])
+        self.assertEqual(pids_tree['3'], ['4'])
+        self.assertEqual(snap.children['1'], ['2', '5'])
+        ptree = pgtree.Proctree(snapshot=snap)
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            ptree.print_tree(pids=matched, child_only=True)
+        self.assertEqual(stdout.getvalue().count('\n'), 3)
+        self.assertIs(ptree.ps_info, snap.ps_info)
+
+    @patch.dict(os.environ, {"PGT_COMM": "comm", "PGT_STIME": "stime"})
+    def test_aggregate(self):
+        """subtrees totals, subtrees below threshold folded"""
+        source = ListSource([('1', '0', 'sh', '10'), ('2', '1', 'sh', '100'), ('3', '2', 'sh', '50'),
+                             ('4', '2', 'sh', '5'), ('5', '1', 'sh', '1'), ('6', '5', 'sh', '2')],
+                            ['rss'])
+        ptree = pgtree.Proctree(source=source, sum_fields=['procs', 'rss'])
+        self.assertEqual(ptree.ps_fields[-1], 'rss')
+        lines = list(ptree.tree(['2']))
+        self.assertNotIn('1', ptree.totals)  # ancestor: not full subtree
+        self.assertEqual(ptree.totals['2'], [3, 155, 3])
+        self.assertIn('<Σ procs=3 rss=155>', lines[2])
+        ptree = pgtree.Proctree(source=source, use_ascii=True, collapse=('rss', 10))
+        lines = list(ptree.tree(['1', '6']))
+        self.assertEqual(ptree.totals['1'], [168, 6])
+        self.assertEqual(ptree.collapsed, set())  # matched 6 below 5
+        self.assertEqual(len(lines), 7)
+        lines = list(ptree.tree(['1']))
+        self.assertEqual(ptree.collapsed, set(['5']))
+        self.assertIn('<sum rss=3 +1 folded>', lines[-1])
+        self.assertEqual(len(lines), 6)
+
+    @patch.dict(os.environ, {"PGT_COMM": "comm", "PGT_STIME": "stime"})
+    def test_sort_top(self):
+        """children sorted by field or subtree total, top children kept with matched paths"""
+        source = ListSource([('1', '0', 'sh', '10'), ('2', '1', 'sh', '5'), ('3', '2', 'sh', '50'),
+                             ('5', '1', 'sh', '9'), ('10', '1', 'sh', '20'), ('11', '1', 'sh', '1')],
+                            ['rss'])
+        def children(ptree, pids=None):
+            """first level children displayed (hidden count line included)"""
+            return [line.split('─')[1].split()[0] for line in ptree.tree(pids)
+                    if line[1:].startswith(' ├─') or line[1:].startswith(' └─')]
+        def proctree(**options):
+            """tree of root 1"""
+            return pgtree.Proctree(source=source, pid_zero=False, **options)
+        self.assertEqual(children(proctree(sort='-pid')), ['11', '10', '5', '2'])
+        self.assertEqual(children(proctree(sort='-rss', top=2)), ['10', '5', '...'])
+        ptree = proctree(sort='-rss', top=2, sum_fields=['rss'])
+        self.assertEqual(children(ptree), ['2', '10', '...'])
+        ptree = proctree(sort='rss', top=1)
+        self.assertEqual(children(ptree, ['1', '10']), ['11', '10', '...'])
+
+    def test_depth_fold(self):
+        """levels below/above selected processes, identical siblings folded"""
+        source = ListSource([('1', '0', 'init'), ('2', '1', 'sh'), ('3', '2', 'sleep'),
+                             ('4', '2', 'sleep'), ('5', '2', 'sleep'), ('6', '2', 'sleep'),
+                             ('7', '6', 'cat'), ('8', '7', 'sh')])
+        ptree = pgtree.Proctree(source=source, fold=True)
+        lines = list(ptree.tree(['2']))
+        self.assertEqual(len(lines), 7)
+        self.assertTrue(lines[3].endswith('─3*[sleep]\n'))
+        self.assertIn('─6 ', lines[4])
+        ptree = pgtree.Proctree(source=source, below=1)
+        ptree.select(['2'])
+        self.assertIn('2', ptree.pids_tree)
+        self.assertNotIn('6', ptree.pids_tree)  # walk stopped
+        ptree = pgtree.Proctree(source=source, above=1)
+        ptree.select(['8'])
+        self.assertEqual(ptree.top_parents, ['7'])
+        ptree = pgtree.Proctree(source=source, above=0, below=0)
+        ptree.select(['8', '2'])
+        self.assertEqual(ptree.top_parents, ['8', '2'])
+        ptree = pgtree.Proctree(source=source, above=0)
+        ptree.select(['8', '2'])
+        self.assertEqual(ptree.top_parents, ['2'])
+
+    def test_cgroups(self):
+        """subtrees in other cgroup/pid namespace labelled, selection by cgroup"""
+        docker = '0::/system.slice/docker-' + 'a' * 64 + '.scope'
+        source = ListSource([('1', '0', 'sh', '0::/init.scope', '1'),
+                             ('2', '1', 'sh', '0::/user.slice', '1'),
+                             ('3', '2', 'sh', '0::/user.slice', '1'), ('4', '1', 'sh', docker, '9'),
+                             ('5', '4', 'sh', docker, '9'), ('6', '1', 'sh', '-', '-')],
+                            ['cgroup', 'pidns'])
+        self.assertEqual(pgtree.pgtree.cgroup_paths('4:memory:/a/b,3:cpu,cpuacct:/c,1:pids:/'),
+                         ['/a/b', '/c'])
+        self.assertEqual(pgtree.pgtree.cgroup_label(docker), 'docker:aaaaaaaaaaaa')
+        self.assertEqual(pgtree.pgtree.cgroup_label('/kubepods/pod1/' + 'b' * 64),
+                         'container:bbbbbbbbbbbb')
+        with patch('os.path.exists', return_value=True):
+            ptree = pgtree.Proctree(source=source, groups=True)
+        self.assertIn('cgroup', ptree.fields)
+        self.assertEqual(ptree.group_text('2'), '@user.slice')
+        self.assertEqual(ptree.group_text('3'), '')
+        self.assertEqual(ptree.group_text('4'), '@docker:aaaaaaaaaaaa pidns:9')
+        self.assertEqual(ptree.group_text('5'), '')
+        self.assertEqual(ptree.group_text('6'), '@/')
+        lines = list(ptree.tree(['4']))
+        self.assertIn('@docker:aaaaaaaaaaaa pidns:9 sh', lines[2])
+        self.assertEqual(ptree.pgrep(['--cgroup', 'docker:aaaaaaaaaaaa']), ['4', '5'])
+        self.assertEqual(ptree.pgrep(['--cgroup', '/user.slice,/']), ['2', '3', '6'])
+        records = list(ptree.tree_records(['5']))
+        self.assertEqual(records[-1]['pidns'], '9')
+        source = pgtree.pgtree.ProcSource()
+        if source.available():
+            self.assertTrue(source.membership(str(os.getpid()), 'pidns').isdigit())
+
+    def test_events(self):
+        """process events applied to snapshot, netlink events, /proc pids diff"""
+        class TableSource:
+            """process table changed by test, processes read one by one"""
+            table = {'1': ('0', 'init'), '2': ('1', 'sh'), '3': ('2', 'sleep')}
+            def row(self, pid):
+                ppid, comm = self.table[pid]
+                return [pid, ppid, 'root', comm, 'stime', comm]
+            def read(self, ps_fields):
+                return [self.row(pid) for pid in sorted(self.table, key=int)]
+            def read_pid(self, pid, ps_fields):
+                if pid in self.table:
+                    return (self.row(pid), None)
+                return None
+        source = TableSource()
+        ptree = pgtree.Proctree(source=source)
+        log = io.StringIO()
+        watcher = pgtree.pgtree.EventWatch(ptree, ptree.pgrep(['sh']), [], ['sh'], log=log)
+        self.assertEqual(len(watcher.lines()), 4)
+        source.table['4'] = ('2', 'cat')
+        source.table['5'] = ('1', 'sh')
+        self.assertTrue(watcher.apply([('fork', '4', '2'), ('fork', '5', '1')]))
+        self.assertEqual(watcher.found, ['2', '5'])
+        self.assertTrue(watcher.apply([('exec', '2', None)]))
+        self.assertEqual(ptree.children['1'], ['2', '5'])  # exec kept in place
+        del source.table['3']
+        self.assertTrue(watcher.apply([('fork', '6', '3'), ('exit', '6', None),
+                                       ('exit', '3', None)]))
+        lines = watcher.lines()
+        self.assertEqual([line[0] for line in lines], [' ', ' ', ' ', '-', '-', '+', '+'])
+        self.assertIn('─6 ', lines[4])  # short lived child seen (copy of parent)
+        self.assertNotIn('3', ptree.ps_info)
+        self.assertEqual(len(log.getvalue().splitlines()), 6)
+        self.assertIn(' fork 4 ppid=2 (root) [cat] cat', log.getvalue())
+        source.table['4'] = ('1', 'cat')
+        del source.table['2']
+        watcher.apply([('exit', '2', None)])
+        self.assertEqual(ptree.marks, {'2': '-', '4': '~'})
+        self.assertEqual(pgtree.pgtree.proc_event(1, (10, 10, 11, 11)), [('fork', '11', '10')])
+        self.assertEqual(pgtree.pgtree.proc_event(1, (10, 10, 12, 11)), [])  # thread
+        self.assertEqual(pgtree.pgtree.proc_event(0x80000000, (11, 11, 0, 17)),
+                         [('exit', '11', None)])
+        root = tempfile.mkdtemp()
+        os.mkdir(root + '/10')
+        poller = pgtree.pgtree.ProcPoller(root, 0.01)
+        os.mkdir(root + '/11')
+        os.rmdir(root + '/10')
+        self.assertEqual(poller.read(), [('exit', '10', None), ('fork', '11', None)])
+        self.assertEqual(poller.read(0), [])
+        shutil.rmtree(root)
+
+    def test_hosts(self):
+        """processes of hosts merged in one forest, host timeout"""
+        tmp = tempfile.mkdtemp()
+        with open(tmp + '/snap1', 'w') as saved:
+            json.dump({'fields': ['pid', 'ppid', 'user', 'comm', 'stime'],
+                       'rows': [['1', '0', 'root', 'init', '10:00', '/init'],
+                                ['2', '1', 'root', 'sshd', '10:00', 'sshd -D']]}, saved)
+        source = pgtree.pgtree.HostsSource([tmp + '/snap1', 'host2', tmp + '/snap1'],
+                                           transport="sh -c 'eval \"$1\"'", timeout=10)
+        ptree = pgtree.Proctree(source=source)
+        self.assertEqual(ptree.children['0'], ['snap1', 'host2'])
+        self.assertEqual(ptree.ps_info['snap1']['args'], '2 processes')
+        self.assertEqual(ptree.ps_info['snap1:2']['ppid'], 'snap1:1')
+        self.assertIn('host2:1', ptree.ps_info)
+        self.assertEqual(ptree.pgrep(['sshd'])[0], 'snap1:2')
+        self.assertEqual(ptree.pgrep(['-x', 'host2']), [])  # host nodes not matched
+        lines = list(ptree.tree(['snap1:2']))
+        self.assertIn('└─snap1:2 ', lines[-1])
+        self.assertEqual(pgtree.pgtree.runcmd_timeout('sleep 5', 0.2), ('timeout', ''))
+        with patch('sys.stderr', new_callable=io.StringIO):
+            source = pgtree.pgtree.HostsSource(['host3'], transport='sleep 5;', timeout=0.2)
+            ptree = pgtree.Proctree(source=source)
+        self.assertEqual(ptree.ps_info['host3']['args'], 'timeout')
+        release, written = threading.Event(), threading.Event()
+        class LateHosts(pgtree.pgtree.HostsSource):
+            """slow host read after timeout"""
+            def host_source(self, host, ps_fields):
+                if host == 'slow':
+                    release.wait(5)
+                    written.set()
+                return ListSource([('1', '0', 'init')])
+        source = LateHosts(['fast', 'slow'], timeout=0.05)
+        with patch('sys.stderr', new_callable=io.StringIO):
+            results = source.read_hosts(['pid', 'ppid', 'user', 'ucomm'])
+        release.set()
+        written.wait(5)
+        time.sleep(0.05)
+        self.assertEqual(list(results), ['fast'])  # late result not written
+        self.assertEqual(source.errors, {'slow': 'timeout'})
+        source = ListSource([('1', '0', 'init', '10:00', '/init'),
+                             ('2', '1', 'sshd', '10:00', 'sshd -D', 'nobody')],
+                            ['stime', 'args', 'user'])
+        pgtree.Snapshot(['pid', 'ppid', 'user', 'ucomm', 'stime'], source).save(
+            tmp + '/snap2.gz')
+        ptree = pgtree.Proctree(source=pgtree.pgtree.HostsSource([tmp + '/snap2.gz']))
+        self.assertEqual(ptree.pgrep(['-u', 'nobody']), ['snap2.gz:2'])
+        self.assertEqual(ptree.pgrep(['sshd']), ['snap2.gz:2'])
+        self.assertEqual(ptree.ps_info['snap2.gz:2']['ppid'], 'snap2.gz:1')
+        lines = list(ptree.tree(['snap2.gz:2']))
+        self.assertIn('└─snap2.gz:1 ', lines[-2])
+        shutil.rmtree(tmp)
+
+    def test_record(self):
+        """snapshots appended to file (gzip), read back as process source"""
+        class GrowingSource(ListSource):
+            """process list growing at each read"""
+            def read(self, ps_fields):
+                self.procs.append((str(len(self.procs) + 1), '3', 'sleep\t1'))
+                return ListSource.read(self, ps_fields)
+        fields = ['pid', 'ppid', 'user', 'ucomm', 'stime']
+        tmp = tempfile.mkdtemp()
+        for path in (tmp + '/snap', tmp + '/snap.gz'):
+            source = GrowingSource([('1', '0', 'init'), ('2', '1', 'sshd'), ('3', '2', 'bash')])
+            pgtree.Snapshot(fields, source).save(path)
+            pgtree.Snapshot(fields, source).save(path)
+            first = pgtree.Snapshot(fields, 'file:' + path + '@0')
+            last = pgtree.Snapshot(fields, 'file:' + path)
+            self.assertEqual(len(first.ps_info), 5)  # with pid 0 header
+            self.assertEqual(len(last.children['3']), 2)
+            self.assertEqual(last.ps_info['4']['args'], 'sleep 1')
+        with open(tmp + '/snap') as saved:
+            self.assertEqual(saved.readline(), '#pgtree-snapshot 1\n')
+        snap = pgtree.Snapshot(fields[:4] + ['etime'], 'file:' + tmp + '/snap.gz')
+        self.assertEqual(snap.ps_info['2']['etime'], '?')
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            pgtree.main(['-C', 'n', '--source=file:' + tmp + '/snap', '-K', '-y', 'sshd'])
+        self.assertIn('kill 5 4 3 2\nprocesses of file-snap not killed', stdout.getvalue())
+        shutil.rmtree(tmp)
+
+    def test_delta(self):
+        """changed subtrees since previous snapshot, pid reuse detected by start time"""
+        source = ListSource([('1', '0', 'init', 'a'), ('2', '1', 'sshd', 'a'),
+                             ('3', '2', 'bash', 'b'), ('4', '1', 'cron', 'a'),
+                             ('5', '3', 'sleep', 'c')], ['lstart'])
+        path = tempfile.mkdtemp() + '/delta'
+        ptree = pgtree.Proctree(source=source, extra_fields=['lstart'])
+        with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            self.assertIsNone(pgtree.pgtree.delta_pids(ptree, None, path))
+        self.assertIn('snapshot saved to', stderr.getvalue())
+        source.procs = [('1', '0', 'init', 'a'), ('2', '1', 'sshd', 'a'),
+                        ('3', '2', 'bash', 'd'), ('5', '1', 'sleep', 'c'),
+                        ('6', '3', 'vi', 'd')]
+        ptree = pgtree.Proctree(source=source, extra_fields=['lstart'])
+        self.assertEqual(pgtree.pgtree.delta_pids(ptree, None, path), ['3', '4', '5'])
+        self.assertEqual(ptree.marks, {'3': '+', '4': '-', '5': '~', '6': '+'})
+        self.assertEqual(ptree.children['1'], ['2', '5', '4'])  # exited kept
+        ptree = pgtree.Proctree(source=source, extra_fields=['lstart'])
+        self.assertEqual(pgtree.pgtree.delta_pids(ptree, None, path), [])
+        with open(path) as saved:
+            self.assertEqual(saved.read().count('#pgtree-snapshot'), 1)  # previous replaced
+        source.procs = source.procs[:-1]
+        ptree = pgtree.Proctree(source=source, extra_fields=['lstart'])
+        self.assertEqual(pgtree.pgtree.delta_pids(ptree, ['2'], path), ['6'])  # exited under 2
+        ptree = pgtree.Proctree(source=source, extra_fields=['lstart'])
+        self.assertEqual(pgtree.pgtree.delta_pids(ptree, ['2'], path), [])
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_low_memory(self):
+        """skeleton of streamed processes, only displayed processes loaded"""
+        source = ListSource([(pid, ppid, comm, '%02d:00' % (10 - int(pid)))
+                             for pid, ppid, comm in [('1', '0', 'init'), ('2', '1', 'sshd'),
+                                                     ('3', '2', 'bash'), ('4', '3', 'vi'),
+                                                     ('5', '1', 'cron'), ('6', '5', 'bash'),
+                                                     ('7', '1', 'vi')]], ['etime'])
+        skel = pgtree.pgtree.Skeleton(source=source, chunk=2)
+        self.assertEqual(skel.pgrep(['-x', 'bash']), ['3', '6'])
+        self.assertEqual(list(skel.children(1)), [2, 5, 7])
+        self.assertEqual(skel.parent(4), 3)
+        snap = skel.snapshot(['3'])
+        self.assertEqual(sorted(snap.ps_info), ['0', '1', '2', '3', '4'])
+        skel = pgtree.pgtree.Skeleton(source=ListSource(source.procs[::-1]))  # not in pid order
+        skel.read()
+        self.assertEqual(list(skel.pids), [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(list(skel.children(1)), [2, 5, 7])
+        self.assertEqual(list(skel.children(4)), [])
+        skel = pgtree.pgtree.Skeleton(['pid', 'ppid', 'user', 'ucomm', 'etime'], source, 2)
+        self.assertEqual(skel.pgrep(['-n', 'bash']), ['6'])  # newest of chunks
+        for args in (['-x', 'vi'], ['-v', 'sshd'], ['cron']):
+            ptree = pgtree.Proctree(source=source)
+            found = ptree.pgrep(args)
+            with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                ptree.print_tree(found)
+            ptree = pgtree.Proctree(source=source, low_memory=True)
+            self.assertIsNone(ptree.snapshot)
+            with patch('sys.stdout', new_callable=io.StringIO) as low_stdout:
+                ptree.print_tree(ptree.pgrep(args))
+            self.assertEqual(low_stdout.getvalue(), stdout.getvalue())
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            pgtree.main(['-C', 'n', '-c', '--low-memory', '-p', str(os.getppid())])
+        self.assertIn(str(os.getppid()), stdout.getvalue())
+        with self.assertRaises(SystemExit):
+            pgtree.main(['--low-memory', '-W'])
+
+    def test_patterns(self):
+        """several patterns matched in one pass, matched pattern tagged"""
+        ptree = pgtree.Proctree(source=ListSource([('1', '0', 'init'), ('2', '1', 'nginx'),
+                                                   ('3', '2', 'php-fpm'), ('4', '1', 'Redis-server'),
+                                                   ('5', '1', 'nginx-debug')]))
+        self.assertEqual(ptree.pgrep(['nginx', 'php-fpm', 'redis']), ['2', '3', '5'])
+        self.assertEqual(ptree.tags, {'2': 'nginx', '3': 'php-fpm', '5': 'nginx'})
+        self.assertEqual(ptree.pgrep(['-x', '-i', 'nginx', 'redis-server']), ['2', '4'])
+        self.assertEqual(ptree.tags['4'], 'redis-server')
+        self.assertEqual(ptree.pgrep(['-x', 'ngin.', 'php-f(p)m']), ['2', '3'])
+        self.assertEqual(ptree.tags, {'2': 'ngin.', '3': 'php-f(p)m'})
+        self.assertEqual(ptree.pgrep(['init']), ['1'])
+        self.assertEqual(ptree.tags, {})
+        self.assertEqual(ptree.pgrep(['(?i)redis', 'init']), ['1', '4'])  # inline flags
+        self.assertEqual(ptree.tags['4'], '(?i)redis')
+        self.assertEqual(ptree.pgrep(['-x', '(?i)REDIS-server']), ['4'])
+        self.assertEqual(ptree.pgrep(['nginx', r'(p)h\1']), ['2', '3', '5'])  # backreference
+        self.assertEqual(ptree.tags['3'], r'(p)h\1')
+        tmp = tempfile.mkdtemp()
+        with open(tmp + '/patterns', 'w') as patterns:
+            patterns.write('# web\nphp-fpm\nRedis\n')
+        found = ptree.pgrep(['--pattern-file', tmp + '/patterns'])
+        self.assertEqual(found, ['3', '4'])
+        lines = list(ptree.tree(found))
+        self.assertIn('[php-fpm] stime ►php-fpm php-fpm', lines[3])
+        self.assertEqual(list(ptree.tree_records(found))[-1]['pattern'], 'Redis')
+        shutil.rmtree(tmp)
+
+    def test_cache(self):
+        """processes snapshot cache within ttl, capabilities cache, invalidation"""
+        class CountSource:
+            """fixed process list counting reads"""
+            name = 'count'
+            reads = 0
+            def read(self, ps_fields):
+                CountSource.reads += 1
+                return [[pid, ppid, 'root', 'sh', 'stime', 'sh'] for pid, ppid in [('1', '0')]]
+        tmp = tempfile.mkdtemp()
+        env = {"XDG_RUNTIME_DIR": tmp, "PGT_CACHE_DIR": tmp, "PGT_COMM": "comm"}
+        with patch.dict(os.environ, env):
+            source = pgtree.pgtree.CachedSource(CountSource(), ttl=60)
+            self.assertEqual(source.directory, tmp + '/pgtree')
+            pgtree.Snapshot(['pid', 'ppid', 'user', 'comm', 'stime'], source)
+            snap = pgtree.Snapshot(['pid', 'ppid', 'user', 'comm', 'stime'], source)
+            self.assertTrue(source.hit)
+            self.assertEqual(CountSource.reads, 1)
+            self.assertEqual(snap.ps_info['1']['args'], 'sh')
+            pgtree.Snapshot(['pid', 'ppid', 'user', 'comm', 'etime'], source)
+            self.assertEqual(CountSource.reads, 2)
+            with open(pgtree.pgtree.caps_file(), 'w') as caps:
+                caps.write('PGT_STIME=start\nPGT_PGREP=\n')
+            with patch.dict(os.environ, {"PGT_STIME": ""}):
+                del os.environ['PGT_STIME']
+                self.assertTrue(pgtree.pgtree.load_caps())
+                self.assertEqual(os.environ['PGT_STIME'], 'start')
+            del os.environ['PGT_COMM']
+            os.remove(pgtree.pgtree.caps_file())
+            pgtree.pgtree.capabilities()  # probed and cached
+            self.assertIn('PGT_COMM', os.environ)
+            with open(pgtree.pgtree.caps_file()) as caps:
+                self.assertEqual([line.split('=')[0] for line in caps],
+                                 ['PGT_COMM', 'PGT_STIME', 'PGT_PGREP'])
+            os.remove(pgtree.pgtree.caps_file())
+            with patch.dict(os.environ, {"PGT_COMM": "fname"}):  # SunOS preset
+                del os.environ['PGT_STIME'], os.environ['PGT_PGREP']
+                pgtree.pgtree.capabilities()  # other keys still probed
+                self.assertEqual(os.environ['PGT_COMM'], 'fname')
+                self.assertIn('PGT_STIME', os.environ)
+                self.assertIn('PGT_PGREP', os.environ)
+            pgtree.pgtree.clear_cache()
+            self.assertEqual(sorted(os.listdir(tmp)), ['pgtree'])
+            self.assertEqual(os.listdir(tmp + '/pgtree'), [])
+            self.assertFalse(pgtree.pgtree.load_caps())
+        shutil.rmtree(tmp)
+
+    def test_profile(self):
+        """stages timings summary"""
+        with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            pgtree.main(['--profile=json', '-C', 'n', 'bash'])
+        stages = json.loads(stderr.getvalue())['stages']
+        self.assertEqual(stages[0]['stage'], 'total')
+        self.assertIn('build_tree', [stage['stage'] for stage in stages])
+        self.assertIsNone(pgtree.pgtree.PROFILER)
+        with patch.dict(os.environ, {"PGT_PROFILE": "text,cprofile"}):
+            with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                pgtree.main(['-C', 'n', 'bash'])
+        self.assertIn('render', stderr.getvalue())
+        self.assertIn('function calls', stderr.getvalue())
+
+    @unittest.skipUnless(os.path.isfile('/proc/self/stat'), "no /proc")
+    def test_killer(self):
+        """kill tree checking identity, escalation to KILL"""
+        proc = subprocess.Popen(['sh', '-c', 'trap "" TERM; sleep 60 & sleep 60 & wait'])
+        time.sleep(0.3)
+        ptree = pgtree.Proctree(source='proc')
+        with patch('sys.stdout', new_callable=io.StringIO):
+            ptree.select([str(proc.pid)])
+            ptree._print_tree(ptree.top_parents, False)
+        self.assertEqual(len(ptree.selected_pids), 3)
+        killer = pgtree.pgtree.Killer(ptree, 15, 'top-down', freeze=True, timeout=0.5)
+        pid = str(proc.pid)
+        self.assertEqual(killer.batches(killer.pids), [[pid], ptree.pids_tree[pid]])
+        start = killer.starts[pid]
+        killer.starts[pid] = 'reused'
+        self.assertEqual(killer.signal([pid], signal.SIGCONT), [])
+        killer.starts[pid] = start
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(killer.kill(), [])
+        self.assertIn('kill -KILL', stdout.getvalue())
+        self.assertEqual(proc.wait(), -9)
+
+    @patch('pgtree.pgtree.stdout_closed')
+    @patch('pgtree.pgtree.Proctree.print_tree')
+    def test_brokenpipe(self, mock_print_tree, mock_closed):
+        """stop quietly when stdout closed"""
+        mock_print_tree.side_effect = IOError(32, 'Broken pipe')
+        pgtree.main(['-C', 'n'])
+        mock_closed.assert_called_once()
+        mock_print_tree.side_effect = IOError(5, 'I/O error')
+        with self.assertRaises(IOError):
+            pgtree.main(['-C', 'n'])